@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# budget -- one cpu budget for worker processes, feature threads, ffmpeg and BLAS/OpenCV threads
+import contextlib
+import json
+import os
+import multiprocessing as mp
+
+from quat.log import *
+
+# the budget of the current process (inherited by worker processes)
+BUDGET_ENV = "PIXELMODELS_CPU_BUDGET"
+BLAS_ENV = [
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+
+def usable_cpus():
+    """
+    cpus this process is allowed to run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(mp.cpu_count()))
+
+
+def cpu_budget(cpus=None, processes=None, pin=False):
+    """
+    splits `cpus` (None: all usable cpus) into `processes` worker processes (None: one per cpu),
+    each process gets `cpus // processes` threads for the per-frame feature calculation and for ffmpeg,
+    BLAS and OpenCV use one thread, because the feature threads already use all cores of a process,
+    with `pin` each worker process (and its ffmpeg children) is pinned to its own cpus
+    """
+    available = usable_cpus()
+    cpus = len(available) if cpus is None else max(1, min(cpus, len(available)))
+    processes = cpus if processes is None else max(1, min(processes, cpus))
+    threads = max(1, cpus // processes)
+    return {
+        "cpus": cpus,
+        "processes": processes,
+        "feature_threads": threads,
+        "ffmpeg_threads": threads,
+        "blas_threads": 1,
+        "pin": pin,
+        "cpu_sets": [available[i * threads:(i + 1) * threads] for i in range(processes)] if pin else None,
+    }
+
+
+def current_budget():
+    """
+    budget of the current process, None in case no budget was applied
+    """
+    if BUDGET_ENV not in os.environ:
+        return None
+    return json.loads(os.environ[BUDGET_ENV])
+
+
+def apply_budget(budget, worker_index=None):
+    """
+    applies the `budget` to the current process (and the processes it starts),
+    with pinning the process is bound to the cpu set of `worker_index`
+    """
+    if budget is None:
+        return
+    os.environ[BUDGET_ENV] = json.dumps(budget)
+    for name in BLAS_ENV:
+        # only effective for processes that load BLAS afterwards, e.g. spawned processes
+        os.environ[name] = str(budget["blas_threads"])
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(budget["blas_threads"])
+    except ImportError:
+        pass
+    try:
+        import cv2
+        cv2.setNumThreads(budget["blas_threads"])
+    except ImportError:
+        pass
+    if budget["pin"] and worker_index is not None and hasattr(os, "sched_setaffinity"):
+        cpus = budget["cpu_sets"][worker_index % len(budget["cpu_sets"])]
+        os.sched_setaffinity(0, cpus)
+        lInfo(f"worker {worker_index} pinned to cpus {cpus}")
+
+
+@contextlib.contextmanager
+def scoped_budget(budget):
+    """
+    applies the `budget` to the current process (without pinning) within a with block, afterwards the
+    environment, BLAS and OpenCV threads of the process are restored, e.g. for a batch run in the main process
+    """
+    if budget is None:
+        yield
+        return
+    environment = {name: os.environ.get(name) for name in [BUDGET_ENV] + BLAS_ENV}
+    limiter = None
+    try:
+        from threadpoolctl import threadpool_limits
+        # stores the current limits, thus they can be restored
+        limiter = threadpool_limits(budget["blas_threads"])
+    except ImportError:
+        pass
+    cv2_threads = None
+    try:
+        import cv2
+        cv2_threads = cv2.getNumThreads()
+    except ImportError:
+        pass
+    try:
+        apply_budget(budget)
+        yield
+    finally:
+        for name, value in environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        if limiter is not None:
+            limiter.restore_original_limits()
+        if cv2_threads is not None:
+            import cv2
+            cv2.setNumThreads(cv2_threads)
+
+
+def feature_threads():
+    """
+    threads for the per-frame feature calculation of one video
+    """
+    budget = current_budget()
+    if budget is None:
+        return max(mp.cpu_count() // 2, 1)
+    return budget["feature_threads"]
+
+
+def ffmpeg_threads():
+    """
+    ffmpeg threads of the budget, None lets ffmpeg decide
+    """
+    budget = current_budget()
+    if budget is None:
+        return None
+    return budget["ffmpeg_threads"]
+
+
+def ffmpeg_options():
+    """
+    ffmpeg options of the budget, e.g. for ffmpeg-python input or output streams
+    """
+    threads = ffmpeg_threads()
+    return {} if threads is None else {"threads": threads}
+
+
+def init_worker(budget, counter):
+    """
+    initializer of worker pools, each worker gets the next worker index of the shared `counter`
+    """
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    apply_budget(budget, worker_index)
+
+
+def report_budget(budget, folder=None):
+    """
+    logs the `budget` and stores it as thread_budget.json in `folder`
+    """
+    if budget is None:
+        return
+    lInfo(f"cpu budget: {budget['cpus']} cpus, {budget['processes']} processes with {budget['feature_threads']} feature threads, "
+          f"{budget['ffmpeg_threads']} ffmpeg threads and {budget['blas_threads']} BLAS/OpenCV threads" + (", pinned" if budget["pin"] else ""))
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "thread_budget.json"), "w") as bfp:
+            json.dump(budget, bfp, indent=4)
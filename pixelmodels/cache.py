@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# cache -- content addressed cache of features and predictions, shared by all models
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from importlib.metadata import version as package_version
+
+from quat.log import *
+from quat.utils.assertions import *
+
+# size of the blocks used for the partial content hash
+HASH_BLOCK_SIZE = 1024 * 1024
+# version of the cache layout, part of all keys
+CACHE_VERSION = 1
+# stores of the content cache
+CACHE_STORES = ["features", "predictions"]
+
+_CONTENT_HASHES = {}
+
+
+def quat_version():
+    """
+    installed quat version, part of the feature keys, because feature implementations may change
+    """
+    try:
+        return package_version("quat")
+    except Exception:
+        return "unknown"
+
+
+def content_hash(filename, block_size=HASH_BLOCK_SIZE):
+    """
+    fast partial content hash of a file: file size and first, middle and last block,
+    thus moved, renamed or copied videos have the same hash
+    """
+    stat = os.stat(filename)
+    memo_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if memo_key in _CONTENT_HASHES:
+        return _CONTENT_HASHES[memo_key]
+    h = hashlib.sha1(str(stat.st_size).encode())
+    with open(filename, "rb") as fp:
+        for offset in sorted(set([0, max(stat.st_size // 2 - block_size // 2, 0), max(stat.st_size - block_size, 0)])):
+            fp.seek(offset)
+            h.update(fp.read(block_size))
+    _CONTENT_HASHES[memo_key] = h.hexdigest()
+    return _CONTENT_HASHES[memo_key]
+
+
+def model_hash(model_base_path):
+    """
+    hash of all files of a model folder (serialized models, flattened forests, info.json)
+    """
+    h = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(model_base_path)):
+        dirs.sort()
+        for f in sorted(files):
+            filename = os.path.join(root, f)
+            h.update(os.path.relpath(filename, model_base_path).encode())
+            h.update(content_hash(filename).encode())
+    return h.hexdigest()
+
+
+def feature_parameters(feature):
+    """
+    parameters of a (not yet used) feature instance, e.g. the used function of an ImageFeature or the
+    parameter of a CuboidRow feature
+    """
+    parameters = {"class": type(feature).__name__}
+    for k, v in sorted(vars(feature).items()):
+        if callable(v):
+            parameters[k] = getattr(v, "__name__", type(v).__name__)
+        elif isinstance(v, (int, float, str, bool)) or v is None:
+            parameters[k] = v
+    return parameters
+
+
+def _key(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def path_size(path):
+    """
+    size in bytes of a file or of all files of a folder
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def parse_size(size):
+    """
+    parses a size with an optional unit, e.g. 500M, 20G, 1T, or 1024 (bytes)
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = str(size).strip().upper().rstrip("B")
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class CacheIndex:
+    """
+    access index of a content cache (SQLite database), stores size, last access and number of hits
+    of each cache entry, so that eviction and statistics require no directory scans
+    """
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self._filename = os.path.join(folder, "index.sqlite")
+        with self._connect() as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    store TEXT,
+                    key TEXT,
+                    path TEXT,
+                    size INTEGER,
+                    last_access REAL,
+                    hits INTEGER,
+                    PRIMARY KEY (store, key)
+                )
+            """)
+
+    def _connect(self):
+        con = sqlite3.connect(self._filename, timeout=60)
+        con.execute("PRAGMA busy_timeout = 60000")
+        return con
+
+    def add(self, store, key, path, size):
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, COALESCE((SELECT hits FROM entries WHERE store = ? AND key = ?), 0))",
+                (store, key, path, size, time.time(), store, key)
+            )
+
+    def touch(self, store, key):
+        with self._connect() as con:
+            con.execute("UPDATE entries SET last_access = ?, hits = hits + 1 WHERE store = ? AND key = ?", (time.time(), store, key))
+
+    def size(self, store):
+        with self._connect() as con:
+            return con.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE store = ?", (store,)).fetchone()[0]
+
+    def stats(self):
+        """
+        returns per store: number of entries, size in bytes, hits, oldest last access
+        """
+        with self._connect() as con:
+            rows = con.execute(
+                "SELECT store, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), MIN(last_access) FROM entries GROUP BY store"
+            ).fetchall()
+        return {
+            r[0]: {"entries": r[1], "size": r[2], "hits": r[3], "oldest_access": r[4]} for r in rows
+        }
+
+    def evict(self, store, budget, policy="lru"):
+        """
+        removes entries of a store until its size is within the `budget` (bytes),
+        `policy` lru: least recently used first, lfu: least frequently used first
+        returns number of removed entries and bytes
+        """
+        order = {"lru": "last_access", "lfu": "hits, last_access"}
+        msg_assert(policy in order, f"eviction policy {policy} is not supported, use one of {list(order.keys())}")
+        total = self.size(store)
+        removed, removed_size = 0, 0
+        if total <= budget:
+            return removed, removed_size
+        with self._connect() as con:
+            for key, path, size in con.execute(f"SELECT key, path, size FROM entries WHERE store = ? ORDER BY {order[policy]}", (store,)).fetchall():
+                if total <= budget:
+                    break
+                remove_path(path)
+                con.execute("DELETE FROM entries WHERE store = ? AND key = ?", (store, key))
+                total -= size
+                removed += 1
+                removed_size += size
+        return removed, removed_size
+
+    def rebuild(self, folder):
+        """
+        adds all entries of the cache `folder` that are not indexed (e.g. created by an older version),
+        this is the only operation that scans the cache folder
+        """
+        for store in CACHE_STORES:
+            for path in glob.glob(os.path.join(folder, store, "*", "*")):
+                if path.endswith(".tmp"):
+                    continue
+                key = os.path.splitext(os.path.basename(path))[0]
+                with self._connect() as con:
+                    exists = con.execute("SELECT 1 FROM entries WHERE store = ? AND key = ?", (store, key)).fetchone()
+                if exists is None:
+                    self.add(store, key, path, path_size(path))
+
+
+def load_budgets(folder):
+    """
+    returns the stored byte budgets per store of a cache folder (see `pixelmodels_cache prune --save`)
+    """
+    filename = os.path.join(folder, "budgets.json")
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as fp:
+        return json.load(fp)
+
+
+class ContentCache:
+    """
+    content addressed cache stored in `folder`:
+    - features: keyed by the content hash of the video(s), the feature name and parameters, the processing context
+      (e.g. crop size) and the quat version, shared by all models
+    - predictions: keyed by the content hash of the video(s), the hash of the model and prediction options
+    """
+    def __init__(self, folder):
+        self._folder = folder
+        self._index = CacheIndex(folder)
+        # e.g. {"features": 10 * 1024 ** 3, "policy": "lru"}, enforced after each stored entry
+        self._budgets = load_budgets(folder)
+
+    def _stored(self, store, key, path):
+        self._index.add(store, key, path, path_size(path))
+        if store in self._budgets:
+            self._index.evict(store, self._budgets[store], self._budgets.get("policy", "lru"))
+
+    def _path(self, kind, key):
+        return os.path.join(self._folder, kind, key[:2], key)
+
+    def feature_key(self, videos, featurename, feature, context):
+        return _key({
+            "version": CACHE_VERSION,
+            "videos": [content_hash(v) for v in videos],
+            "feature": featurename,
+            "parameters": feature_parameters(feature),
+            "context": context,
+            "quat": quat_version(),
+        })
+
+    def load_feature(self, key, featurename, feature):
+        """
+        loads the cached values into `feature`, returns True if the values are cached
+        """
+        folder = self._path("features", key)
+        if not os.path.isdir(folder):
+            return False
+        loaded = feature.load(folder, "cached", featurename)
+        if loaded:
+            self._index.touch("features", key)
+        return loaded
+
+    def store_feature(self, key, featurename, feature):
+        folder = self._path("features", key)
+        os.makedirs(folder, exist_ok=True)
+        stored = feature.store(folder, "cached", featurename)
+        self._stored("features", key, folder)
+        return stored
+
+    def prediction_key(self, videos, model_base_path, options):
+        return _key({
+            "version": CACHE_VERSION,
+            "videos": [content_hash(v) for v in videos],
+            "model": model_hash(model_base_path),
+            "options": options,
+        })
+
+    def load_prediction(self, key):
+        """
+        returns the cached prediction or None
+        """
+        filename = self._path("predictions", key) + ".json"
+        if not os.path.isfile(filename):
+            return None
+        with open(filename) as fp:
+            prediction = json.load(fp)
+        self._index.touch("predictions", key)
+        return prediction
+
+    def store_prediction(self, key, prediction):
+        filename = self._path("predictions", key) + ".json"
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # write and rename, so that concurrent readers never see partial files
+        with open(filename + f".{os.getpid()}.tmp", "w") as fp:
+            json.dump(prediction, fp)
+        os.replace(filename + f".{os.getpid()}.tmp", filename)
+        self._stored("predictions", key, filename)
+
+
+def open_cache(cache_folder):
+    """
+    returns the content cache for `cache_folder`, None if no cache folder is given
+    """
+    if cache_folder is None:
+        return None
+    return ContentCache(cache_folder)
+
+
+def cached_prediction(cache_folder, videos, model_base_path, options, predict):
+    """
+    returns the memoized prediction for the videos, model and options, otherwise `predict()` is called and its result
+    is stored
+    """
+    cache = open_cache(cache_folder)
+    if cache is None:
+        return predict()
+    key = cache.prediction_key(videos, model_base_path, options)
+    prediction = cache.load_prediction(key)
+    if prediction is not None:
+        lInfo(f"use cached prediction for {videos}")
+        return prediction
+    prediction = predict()
+    cache.store_prediction(key, prediction)
+    return prediction
+
+
+def cleanup_orphans(folders, max_age_hours=24, pattern="*"):
+    """
+    removes files and folders (direct children of the given folders matching `pattern`) that were not modified
+    for `max_age_hours`, e.g. crop files of crashed runs in `tmp/nofu/crop` or encodings in `./compressibility`,
+    returns the number of removed bytes
+    """
+    removed_size = 0
+    deadline = time.time() - max_age_hours * 3600
+    for folder in folders:
+        for path in glob.glob(os.path.join(folder, pattern)):
+            if os.path.getmtime(path) < deadline:
+                lInfo(f"remove orphan {path}")
+                removed_size += path_size(path)
+                remove_path(path)
+    return removed_size
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='manage the content addressed cache (see --cache_folder) and temporary files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("cache_folder", type=str, help="cache folder")
+
+    subparsers = parser.add_subparsers(
+        help='sub commands',
+        dest="command"
+    )
+    subparsers.add_parser(
+        'stats',
+        help='print number of entries, size and hits per store',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    prune = subparsers.add_parser(
+        'prune',
+        help='evict entries until each store is within its budget and remove orphaned temporary files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    for store in CACHE_STORES:
+        prune.add_argument(f"--{store}_budget", type=str, default=None, help=f"maximal size of the {store} store, e.g. 50G (None: no limit)")
+    prune.add_argument("--policy", type=str, default="lru", choices=["lru", "lfu"], help="eviction policy, least recently or least frequently used first")
+    prune.add_argument("--save", action="store_true", help="store the budgets, so that they are enforced whenever a new entry is cached")
+    prune.add_argument("--rebuild_index", action="store_true", help="scan the cache folder once to index entries that are not indexed yet")
+    prune.add_argument("--orphans", type=str, nargs="*", default=[], help="temporary folders to clean up, e.g. tmp/nofu/crop tmp/nofu/windows compressibility")
+    prune.add_argument("--max_age_hours", type=float, default=24, help="orphaned temporary files older than this are removed")
+
+    a = vars(parser.parse_args())
+    index = CacheIndex(a["cache_folder"])
+
+    if a["command"] == "stats":
+        stats = index.stats()
+        stats["budgets"] = load_budgets(a["cache_folder"])
+        print(json.dumps(stats, indent=4))
+
+    if a["command"] == "prune":
+        if a["rebuild_index"]:
+            index.rebuild(a["cache_folder"])
+        # unfinished writes of crashed runs
+        cleanup_orphans(glob.glob(os.path.join(a["cache_folder"], "predictions", "*")), a["max_age_hours"], "*.tmp")
+        budgets = load_budgets(a["cache_folder"])
+        budgets["policy"] = a["policy"]
+        for store in CACHE_STORES:
+            if a[f"{store}_budget"] is not None:
+                budgets[store] = parse_size(a[f"{store}_budget"])
+        if a["save"]:
+            with open(os.path.join(a["cache_folder"], "budgets.json"), "w") as fp:
+                json.dump(budgets, fp, indent=4)
+        for store in CACHE_STORES:
+            if store in budgets:
+                removed, removed_size = index.evict(store, budgets[store], budgets["policy"])
+                lInfo(f"{store}: removed {removed} entries, {removed_size / 1024 ** 2:.1f} MiB")
+        removed_size = cleanup_orphans(a["orphans"], a["max_age_hours"])
+        lInfo(f"orphans: removed {removed_size / 1024 ** 2:.1f} MiB")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import datetime
+import hashlib
+import json
 import os
 import shutil
 
@@ -13,6 +15,7 @@ from quat.ff.convert import (
     convert_to_avpvs_and_crop
 )
 from quat.ml.mlcore import load_serialized
+from quat.parallel import run_parallel
 from quat.video import *
 from quat.utils.fileutils import get_filename_without_extension
 from quat.utils.assertions import *
@@ -23,11 +26,31 @@ from quat.visual.image import *
 
 import ffmpeg
 
+from pixelmodels.budget import feature_threads
+from pixelmodels.cache import open_cache
+from pixelmodels.convert import convert_and_crop
+from pixelmodels.pooling import pool_features
+from pixelmodels.frames import (
+    iterate_planar_frames,
+    feature_planes,
+    check_planes,
+    prepare_planes,
+    calc_planar
+)
+from pixelmodels.forest import (
+    load_forest,
+    forest_predict,
+    forest_tree_values,
+    features_to_matrix,
+    flat_model_filename
+)
+
 MODEL_BASE_PATH = os.path.abspath(os.path.dirname(__file__) + "/models")
 CENTER_CROP = 360  # default is 360
 
 
 import tempfile
+import time
 
 class CompressibilityFeature(Feature):
     # TODO: move to quat
@@ -217,8 +240,8 @@ def extract_mode0_features(video):
     mode0_features = {  # numbers are important here
         "framerate": float(meta["streams"][0]["avg_frame_rate"]),
         "bitrate": float(meta["streams"][0]["bit_rate"]) / 1024,  # kbit/s
-        "bitdepth": 8 if meta["streams"][0]["bits_per_raw_sample"] == "unknown" else int(meta["bits_per_raw_sample"]),
-        "codec": unify_video_codec(meta["codec"]),
+        "bitdepth": 8 if meta["streams"][0].get("bits_per_raw_sample", "unknown") == "unknown" else int(meta["streams"][0]["bits_per_raw_sample"]),
+        "codec": unify_video_codec(meta["streams"][0]["codec_name"]),
         "resolution": int(meta["streams"][0]["height"]) * int(meta["streams"][0]["width"]),
     }
     # mode0 extended features
@@ -232,10 +255,14 @@ def extract_mode0_features(video):
     return mode0_features
 
 
-def __filter_to_be_calculated_features(video, all_feat, featurenames, features_temp_folder):
+def __filter_to_be_calculated_features(video, all_feat, featurenames, features_temp_folder, cache=None, cache_videos=None, cache_context=None):
     """
     filters from the given featurenames , the features in all_feat that still need to be calculated,
-    here also a loading of already calculated feature values is performed
+    here also a loading of already calculated feature values is performed,
+    in case of a content `cache` (see `pixelmodels.cache`) features that are not stored in `features_temp_folder`
+    are loaded from the cache, the keys are based on `cache_videos` and `cache_context`
+
+    returns features to calculate, all features, cache keys of all features
     """
     msg_assert(len(list(set(all_feat.keys()) & featurenames)) > 0, "feature set empty")
     msg_assert(len(list(set(featurenames - all_feat.keys()))) == 0, "feature set comtains features that are not defined")
@@ -243,36 +270,51 @@ def __filter_to_be_calculated_features(video, all_feat, featurenames, features_t
     for featurename in featurenames:
         features[featurename] = all_feat[featurename]
 
-    features_to_calculate = set([f for f in features.keys() if not features[f].load(features_temp_folder + "/" + f, video, f)])
-    return features_to_calculate, features
+    cache_keys = {}
+    if cache is not None:
+        # keys are based on the parameters of the unused feature instances
+        cache_keys = {f: cache.feature_key(cache_videos, f, features[f], cache_context) for f in features}
+
+    def load(f):
+        if features[f].load(features_temp_folder + "/" + f, video, f):
+            return True
+        return cache is not None and cache.load_feature(cache_keys[f], f, features[f])
+
+    features_to_calculate = set([f for f in features.keys() if not load(f)])
+    return features_to_calculate, features, cache_keys
 
 
-def __store_and_pool_features(video, features, meta, features_temp_folder):
+def __store_and_pool_features(video, features, meta, features_temp_folder, cache=None, cache_keys={}):
     """
-    stores `features` for a given `video` in the folder `features_temp_folder`, in case meta is true,
-    such features will be extended by mode0 meta-data based features
+    stores `features` for a given `video` in the folder `features_temp_folder`, or only in the content `cache`
+    in case there is one (no second copy outside of the cache budget),
+    in case meta is true, such features will be extended by mode0 meta-data based features
     """
     feature_files = []
     for f in features:
-        feature_files.append(features[f].store(features_temp_folder + "/" + f, video, f))
+        if cache is not None:
+            feature_files.append(cache.store_feature(cache_keys[f], f, features[f]))
+        else:
+            feature_files.append(features[f].store(features_temp_folder + "/" + f, video, f))
 
     pooled_features = {}
     per_frame_features = {}
+    to_pool = {}
     for f in features:
         values = features[f].get_values()
         # TODO: this handling should be done by advanced_pooling...
         if len(values) == 1:
             if type(values[0]) == dict:
-                flattened = {
+                pooled_features.update({
                     f + "_" + x: values[0][x] for x in values[0]
-                }
-                pooled_features = dict(flattened, **pooled_features)
+                })
             else:
-                pooled_features = dict({f: values[0]}, **pooled_features)
+                pooled_features[f] = values[0]
         else: # stats=True, minimal=False
-            #pooled_features = dict(advanced_pooling(values, name=f, stats=False, minimal=True), **pooled_features)
-            pooled_features = dict(advanced_pooling(values, name=f), **pooled_features)
-        per_frame_features = dict({f:values}, **per_frame_features)
+            to_pool[f] = values
+        per_frame_features[f] = values
+    # all features are pooled at once, with the names and statistics of advanced_pooling
+    pooled_features.update(pool_features(to_pool))
 
     full_features = {
         "video_name": video,
@@ -287,60 +329,333 @@ def __store_and_pool_features(video, features, meta, features_temp_folder):
     return pooled_features, full_features
 
 
-def extract_features_no_ref(video, temp_folder="./tmp", features_temp_folder="./tmp/features", featurenames=None, modelname="nofu", meta=False):
+def _numeric_values(value):
+    """
+    flattens a per-frame feature value (number, list or dictionary) to a float array
+    """
+    if isinstance(value, dict):
+        return np.concatenate([_numeric_values(value[k]) for k in sorted(value.keys())] + [np.zeros(0)])
+    try:
+        return np.asarray(value, dtype=np.float64).ravel()
+    except (TypeError, ValueError):
+        return np.zeros(0)
+
+
+class ConvergenceMonitor:
+    """
+    tracks running statistics (mean and standard deviation) of the per-frame feature values to stop
+    the frame processing early, once all statistics changed less than `tolerance` (relative)
+    for `patience` consecutive checks (every `check_interval` frames) and at least `min_coverage`
+    of all frames are processed,
+    a scene cut (mean absolute luma difference of consecutive frames above `cut_threshold`)
+    resets the running statistics and the convergence, so that the statistics of the new scene
+    have to converge again and changes of the content are not missed
+    """
+    def __init__(self, number_frames, tolerance=0.01, min_coverage=0.3, check_interval=10, patience=2, cut_threshold=30.0):
+        self._number_frames = number_frames
+        self._tolerance = tolerance
+        self._min_coverage = min_coverage
+        self._check_interval = check_interval
+        self._patience = patience
+        self._cut_threshold = cut_threshold
+        self._stats = {}
+        self._last_check = {}
+        self._stable_checks = 0
+        self._last_frame = None
+        self.frames = 0
+        self.scene_cuts = 0
+
+    def _is_scene_cut(self, frame):
+        small = np.asarray(frame[::8, ::8], dtype=np.float32)
+        if small.ndim == 3:
+            small = small.mean(axis=2)
+        cut = self._last_frame is not None and np.abs(small - self._last_frame).mean() > self._cut_threshold
+        self._last_frame = small
+        return cut
+
+    def _update_stats(self, f, value):
+        # Welford's online algorithm per element, non-finite values (e.g. missing values) are skipped,
+        # otherwise a single NaN value would stay in the mean for good
+        count, mean, m2 = self._stats.get(f, (None, None, None))
+        if mean is None or mean.shape != value.shape:
+            count, mean, m2 = np.zeros(value.shape), np.zeros(value.shape), np.zeros(value.shape)
+        valid = np.isfinite(value)
+        value = np.where(valid, value, 0)
+        count = count + valid
+        delta = np.where(valid, value - mean, 0)
+        mean = mean + delta / np.maximum(count, 1)
+        m2 = m2 + np.where(valid, delta * (value - mean), 0)
+        self._stats[f] = (count, mean, m2)
+
+    def _changed(self):
+        changed = False
+        for f, (count, mean, m2) in self._stats.items():
+            # elements without any finite value have a non-finite statistic, they never count as converged
+            mean = np.where(count > 0, mean, np.nan)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                current = np.concatenate([mean, np.sqrt(m2 / count)])
+            last = self._last_check.get(f)
+            if last is None or last.shape != current.shape or not np.all(np.isfinite(current)) or np.any(np.abs(current - last) > self._tolerance * (np.abs(last) + 1e-9)):
+                changed = True
+            self._last_check[f] = current
+        return changed
+
+    def update(self, frame, values):
+        """
+        adds the feature `values` (dictionary featurename: value) of one `frame`,
+        returns True in case the processing can be stopped
+        """
+        self.frames += 1
+        if self._is_scene_cut(frame):
+            self.scene_cuts += 1
+            self._stable_checks = 0
+            self._stats = {}
+            self._last_check = {}
+        for f in values:
+            self._update_stats(f, _numeric_values(values[f]))
+
+        if self.frames % self._check_interval != 0:
+            return False
+        self._stable_checks = 0 if self._changed() else self._stable_checks + 1
+        return self._stable_checks >= self._patience and self.frames >= self._min_coverage * self._number_frames
+
+
+def early_stop_settings(tolerance=None, min_coverage=0.3):
+    """
+    returns the `early_stop` parameters for the feature extraction, None (no early stopping) if tolerance is None
+    """
+    if tolerance is None:
+        return None
+    return {"tolerance": tolerance, "min_coverage": min_coverage}
+
+
+def count_frames(video):
+    """
+    returns the number of frames of a video (as estimated by OpenCV)
+    """
+    cap = cv2.VideoCapture(video)
+    number_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return number_frames
+
+
+# features that are calculated from the whole video, thus they can not be calculated in chunks
+UNCHUNKED_FEATURES = {"compressibility"}
+# frames before each chunk that are processed (and discarded) to initialize stateful features
+CHUNK_WARM_UP = 10
+
+
+def chunk_ranges(number_frames, chunks, min_frames=30):
+    """
+    splits `number_frames` frames in at most `chunks` ranges [start, end) of at least `min_frames` frames,
+    the end of the last range is None (all remaining frames, the frame count of a container can be estimated)
+    """
+    chunks = max(1, min(chunks, number_frames // min_frames))
+    bounds = [number_frames * i // chunks for i in range(chunks + 1)]
+    return [(bounds[i], bounds[i + 1] if i + 1 < chunks else None) for i in range(chunks)]
+
+
+def set_feature_values(feature, values):
+    """
+    replaces the per-frame values of a feature instance, e.g. with values calculated in other processes,
+    the `Feature` base class of quat has only a getter (`get_values`)
+    """
+    if hasattr(feature, "set_values"):
+        feature.set_values(values)
+        return
+    feature._values = list(values)
+
+
+def extract_chunk_no_ref(video_avpvs_crop, featurenames, start, end, warm_up=CHUNK_WARM_UP):
+    """
+    calculates the no-reference `featurenames` for the frames `start` to `end` (exclusive, None: all frames)
+    of the intra coded `video_avpvs_crop`, the `warm_up` frames before `start` are also processed to initialize
+    stateful (e.g. temporal) features, their values are discarded,
+    returns the per-frame values of each feature
+    """
+    all_feat = all_no_ref_features()
+    features = {f: all_feat[f] for f in featurenames}
+    first = max(0, start - warm_up)
+    offsets = {f: 0 for f in features}
+    cap = cv2.VideoCapture(video_avpvs_crop)
+    i = 0
+    # the crop is intra coded (ffvhuff), thus seeking to a frame is exact and requires no decoding of the previous frames
+    if first > 0 and cap.set(cv2.CAP_PROP_POS_FRAMES, first) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == first:
+        i = first
+    else:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    # e.g. containers without seek support, frames are skipped without color conversion
+    while i < first and cap.grab():
+        i += 1
+    while end is None or i < end:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if i == start:
+            offsets = {f: len(features[f].get_values()) for f in features}
+        for f in features:
+            features[f].calc(frame)
+        i += 1
+    cap.release()
+    lInfo(f"handled frames {start}-{i} of {video_avpvs_crop}")
+    return {f: list(features[f].get_values()[offsets[f]:]) for f in features}
+
+
+def extract_chunked_no_ref(video_avpvs_crop, features, featurenames, chunks, warm_up=CHUNK_WARM_UP):
+    """
+    calculates the no-reference `featurenames` of `video_avpvs_crop` in `chunks` parallel processes,
+    the per-frame values of all chunks are merged (in frame order) into `features`
+    """
+    ranges = chunk_ranges(count_frames(video_avpvs_crop), chunks)
+    lInfo(f"calculate {featurenames} in {len(ranges)} chunks of {video_avpvs_crop}")
+    items = [[video_avpvs_crop, featurenames, start, end] for start, end in ranges]
+    if len(items) > 1 and not mp.current_process().daemon:
+        chunk_values = run_parallel(
+            items=items,
+            function=extract_chunk_no_ref,
+            arguments=[warm_up],
+            num_cpus=len(items),
+            multi_item=True
+        )
+    else:
+        # e.g. inside batch worker processes, that can not start further processes
+        chunk_values = [extract_chunk_no_ref(*item, warm_up) for item in items]
+    for f in featurenames:
+        set_feature_values(features[f], [x for values in chunk_values for x in values[f]])
+
+
+def extract_features_no_ref(video, temp_folder="./tmp", features_temp_folder="./tmp/features", featurenames=None, modelname="nofu", meta=False, early_stop=None, cache_folder=None, planar=False, crop_first=False, chunks=1):
     """
     extract no-reference features for a given video.
     use `temp_folder` for storing temporary files,
     store features in `features_temp_folder`
     only perform calculation for the given `featurenames` (if such names are valid)
     if meta is true, also include mode0 features
+    in case of `early_stop` (dictionary of `ConvergenceMonitor` parameters) the frame processing stops
+    when the feature statistics converged, Important: then the pooled features are based on the processed frames
+    and are stored in a separate subfolder of `features_temp_folder`
+    in case of a `cache_folder` the features are stored in the content addressed cache (see `pixelmodels.cache`)
+    instead of `features_temp_folder`, thus they are bounded by the cache budget
+    if `planar` is true, the frames are decoded at native bit depth as planes (see `pixelmodels.frames`),
+    luma features use the luma plane, Important: these features are stored in a separate subfolder of `features_temp_folder`
+    if `crop_first` is true, only the source lines of the center crop are scaled (see `pixelmodels.convert`),
+    these features are also stored in a separate subfolder of `features_temp_folder`
+    with `chunks` > 1 the frames are split in chunks that are calculated in parallel processes (see `extract_chunked_no_ref`),
+    stateful features are initialized with CHUNK_WARM_UP frames before each chunk, Important: features with a longer state
+    can differ from the sequential calculation, therefore these features are stored in a separate subfolder of `features_temp_folder`
     """
     msg_assert(featurenames is not None, "featurenames are required to be defined", f"featurenames ok")
     msg_assert(os.path.isfile(video), f"{video} does not exists", f"{video} exists")
 
     lInfo(f"handle : {video} for {modelname}")
+    if early_stop is not None:
+        # early stopped features must not be mixed with the features of all frames
+        features_temp_folder = os.path.join(features_temp_folder, "early_stop")
+    if planar:
+        # features of luma planes at native bit depth differ slightly from the features of 8 bit colour frames
+        features_temp_folder = os.path.join(features_temp_folder, "planar")
+    if crop_first:
+        # the crop before scale conversion is equal within a tolerance, not exactly
+        features_temp_folder = os.path.join(features_temp_folder, "crop_first")
+    if chunks > 1 and (early_stop is not None or planar or len(set(featurenames) & UNCHUNKED_FEATURES) > 0):
+        lWarn(f"chunks can not be used with early stopping, planar frames or the features {UNCHUNKED_FEATURES}, all frames are processed sequentially")
+        chunks = 1
+    if chunks > 1:
+        features_temp_folder = os.path.join(features_temp_folder, f"chunks_{chunks}")
 
     all_feat = all_no_ref_features()
-    features_to_calculate, features = __filter_to_be_calculated_features(video, all_feat, featurenames, features_temp_folder)
+    cache = open_cache(cache_folder)
+    features_to_calculate, features, cache_keys = __filter_to_be_calculated_features(
+        video, all_feat, featurenames, features_temp_folder,
+        cache, [video], {"kind": "no_ref", "crop": CENTER_CROP, "early_stop": early_stop, "planar": planar, "crop_first": crop_first, "chunks": chunks}
+    )
     i = 0
 
     lInfo(f"calculate missing features {features_to_calculate} for {video}")
     if features_to_calculate != set():
         # convert to avpvs (rescale) and crop
         # assumes UHD-1/4K 60 fps video, yuv422p10le
-        video_avpvs_crop = convert_to_avpvs_and_crop(
+        video_avpvs_crop = convert_and_crop(
             video,
             f"{temp_folder}/crop/",
+            crop_first=crop_first,
             ccheight=CENTER_CROP
         )
 
-        for frame in iterate_by_frame(video_avpvs_crop, convert=False, openCV=True):
-            for f in features_to_calculate:
-                x = features[f].calc(frame)
-                lInfo(f"handle frame {i} of {video}: {f} -> {x}")
-            i += 1
-        os.remove(video_avpvs_crop)
+        try:
+            monitor = None
+            if early_stop is not None:
+                monitor = ConvergenceMonitor(count_frames(video_avpvs_crop), **early_stop)
+
+            if chunks > 1:
+                extract_chunked_no_ref(video_avpvs_crop, features, sorted(features_to_calculate), chunks)
+                frames = []
+            elif planar:
+                planes = feature_planes(features_to_calculate, "bgr")
+                check_planes(features, planes)
+                frames = iterate_planar_frames(video_avpvs_crop)
+            else:
+                frames = iterate_by_frame(video_avpvs_crop, convert=False, openCV=True)
 
-    pooled_features, full_features = __store_and_pool_features(video, features, meta, features_temp_folder)
+            for frame in frames:
+                values = {}
+                for f in features_to_calculate:
+                    if planar:
+                        x = calc_planar(features, f, planes, frame)
+                    else:
+                        x = features[f].calc(frame)
+                    values[f] = x
+                    lInfo(f"handle frame {i} of {video}: {f} -> {x}")
+                i += 1
+                if monitor is not None and monitor.update(frame.luma() if planar else frame, values):
+                    lInfo(f"feature values converged, stop after {i} frames of {video} ({monitor.scene_cuts} scene cuts)")
+                    break
+        finally:
+            # also in case of errors, otherwise the temp folder grows
+            os.remove(video_avpvs_crop)
+
+    pooled_features, full_features = __store_and_pool_features(video, features, meta, features_temp_folder, cache, cache_keys)
     return pooled_features, full_features
 
 
-def extract_features_full_ref(dis_video, ref_video, temp_folder="./tmp", features_temp_folder="./tmp/features", featurenames=None, modelname="fume", meta=False):
+def extract_features_full_ref(dis_video, ref_video, temp_folder="./tmp", features_temp_folder="./tmp/features", featurenames=None, modelname="fume", meta=False, early_stop=None, cache_folder=None, planar=False, crop_first=False):
     """
     extract full-reference features for a given dis_video and ref_video.
     use `temp_folder` for storing temporary files,
     store features in `features_temp_folder`
     only perform calculation for the given `featurenames` (if such names are valid)
     if meta is true, also include mode0 features
+    in case of `early_stop` (dictionary of `ConvergenceMonitor` parameters) the frame processing stops
+    when the feature statistics converged, Important: then the pooled features are based on the processed frames
+    and are stored in a separate subfolder of `features_temp_folder`
+    in case of a `cache_folder` the features are stored in the content addressed cache (see `pixelmodels.cache`)
+    instead of `features_temp_folder`, thus they are bounded by the cache budget
+    if `planar` is true, the frames are decoded at native bit depth as planes (see `pixelmodels.frames`),
+    luma features use the luma plane, Important: these features are stored in a separate subfolder of `features_temp_folder`
+    if `crop_first` is true, only the source lines of the center crop are scaled (see `pixelmodels.convert`),
+    these features are also stored in a separate subfolder of `features_temp_folder`
     """
     msg_assert(featurenames is not None, "featurenames are required to be defined", f"featurenames ok")
     msg_assert(os.path.isfile(dis_video), f"{dis_video} does not exists", f"{dis_video} exists")
     msg_assert(os.path.isfile(ref_video), f"{ref_video} does not exists", f"{ref_video} exists")
 
     lInfo(f"handle : {dis_video} for {modelname}")
+    if early_stop is not None:
+        # early stopped features must not be mixed with the features of all frames
+        features_temp_folder = os.path.join(features_temp_folder, "early_stop")
+    if planar:
+        # features of luma planes at native bit depth differ slightly from the features of 8 bit colour frames
+        features_temp_folder = os.path.join(features_temp_folder, "planar")
+    if crop_first:
+        # the crop before scale conversion is equal within a tolerance, not exactly
+        features_temp_folder = os.path.join(features_temp_folder, "crop_first")
 
     all_feat = all_features()
-    features_to_calculate, features = __filter_to_be_calculated_features(dis_video, all_feat, featurenames, features_temp_folder)
+    cache = open_cache(cache_folder)
+    features_to_calculate, features, cache_keys = __filter_to_be_calculated_features(
+        dis_video, all_feat, featurenames, features_temp_folder,
+        cache, [dis_video, ref_video], {"kind": "full_ref", "crop": CENTER_CROP, "early_stop": early_stop, "planar": planar, "crop_first": crop_first}
+    )
     i = 0
 
     lInfo(f"calculate missing features {features_to_calculate} for {dis_video}, {ref_video}")
@@ -359,55 +674,80 @@ def extract_features_full_ref(dis_video, ref_video, temp_folder="./tmp", feature
         lInfo(f"estimated src meta-data {width}x{height}@{framerate}:{pix_fmt}")
         dis_crop_folder = f"{temp_folder}/crop/{dis_basename}_dis/"
         ref_crop_folder = f"{temp_folder}/crop/{dis_basename}_ref/"
-        # convert dis and ref video to to avpvs (rescale) and crop
-        dis_video_avpvs_crop = convert_to_avpvs_and_crop(
-            dis_video, dis_crop_folder,
-            width=width,
-            height=height,
-            framerate=framerate,
-            pix_fmt=pix_fmt,
-            ccheight=CENTER_CROP
-        )
-        ref_video_avpvs_crop = convert_to_avpvs_and_crop(
-            ref_video, ref_crop_folder,
-            width=width,
-            height=height,
-            framerate=framerate,
-            pix_fmt=pix_fmt,
-            ccheight=CENTER_CROP
-        )
-        #'''
-        def get_frames(video_filename):
-            frames = []
-            cap = cv2.VideoCapture(video_filename)
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if ret != True:
-                    break
-                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frames.append(rgb_frame)
+        try:
+            # convert dis and ref video to to avpvs (rescale) and crop
+            dis_video_avpvs_crop = convert_and_crop(
+                dis_video, dis_crop_folder,
+                crop_first=crop_first,
+                width=width,
+                height=height,
+                framerate=framerate,
+                pix_fmt=pix_fmt,
+                ccheight=CENTER_CROP
+            )
+            ref_video_avpvs_crop = convert_and_crop(
+                ref_video, ref_crop_folder,
+                crop_first=crop_first,
+                width=width,
+                height=height,
+                framerate=framerate,
+                pix_fmt=pix_fmt,
+                ccheight=CENTER_CROP
+            )
+            #'''
+            def iterate_frames(video_filename):
+                # frames are decoded on demand, thus an early stop also saves the decoding of the remaining frames
+                cap = cv2.VideoCapture(video_filename)
+                try:
+                    while cap.isOpened():
+                        ret, frame = cap.read()
+                        if ret != True:
+                            break
+                        yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                finally:
+                    cap.release()
 
-            cap.release()
-            cv2.destroyAllWindows()
+            if planar:
+                # planar frames are streamed, only the current frame pair is kept in memory
+                planes = feature_planes(features_to_calculate, "rgb")
+                check_planes(features, planes, full_ref=True)
+                number_frames = count_frames(dis_video_avpvs_crop)
+                frames = zip(iterate_planar_frames(dis_video_avpvs_crop), iterate_planar_frames(ref_video_avpvs_crop))
+            else:
+                # rgb frames are streamed as well, the crop folders are removed after the frame loop
+                number_frames = count_frames(dis_video_avpvs_crop)
+                frames = zip(iterate_frames(dis_video_avpvs_crop), iterate_frames(ref_video_avpvs_crop))
+            #'''
+            def func(features, f, d_frame, r_frame):
+                if planar:
+                    return f, calc_planar(features, f, planes, d_frame, r_frame)
+                return f, features[f].calc_dis_ref(d_frame, r_frame)
 
-            return frames
+            monitor = None
+            if early_stop is not None:
+                monitor = ConvergenceMonitor(number_frames, **early_stop)
 
-        d_frames = get_frames(dis_video_avpvs_crop)
-        r_frames = get_frames(ref_video_avpvs_crop)
-        #'''
-        def func(features, f, d_frame, r_frame):
-            features[f].calc_dis_ref(d_frame, r_frame)
-
-        #'''
-        #for d_frame, r_frame in iterate_by_frame_two_videos(dis_video_avpvs_crop, ref_video_avpvs_crop, convert=False, openCV=True):
-        for d_frame, r_frame in zip(d_frames, r_frames):
-            pool = ThreadPool(processes=mp.cpu_count()//2)
-            starmap = [(features, f, d_frame, r_frame) for f in features_to_calculate]
-            pool.starmap_async(func, starmap)
-            pool.close()
-            pool.join()
-            #lInfo(f"Handled frame {i}....")
-            i += 1
+            #'''
+            #for d_frame, r_frame in iterate_by_frame_two_videos(dis_video_avpvs_crop, ref_video_avpvs_crop, convert=False, openCV=True):
+            for d_frame, r_frame in frames:
+                if planar:
+                    # each representation is converted once per frame, before the feature threads use it
+                    prepare_planes(d_frame, planes)
+                    prepare_planes(r_frame, planes)
+                pool = ThreadPool(processes=feature_threads())
+                starmap = [(features, f, d_frame, r_frame) for f in features_to_calculate]
+                values = pool.starmap_async(func, starmap)
+                pool.close()
+                pool.join()
+                #lInfo(f"Handled frame {i}....")
+                i += 1
+                if monitor is not None and monitor.update(d_frame.luma() if planar else d_frame, dict(values.get())):
+                    lInfo(f"feature values converged, stop after {i} frames of {dis_video} ({monitor.scene_cuts} scene cuts)")
+                    break
+        finally:
+            # also in case of errors, otherwise the temp folder grows
+            shutil.rmtree(dis_crop_folder, ignore_errors=True)
+            shutil.rmtree(ref_crop_folder, ignore_errors=True)
 
         #'''
         '''
@@ -433,53 +773,423 @@ def extract_features_full_ref(dis_video, ref_video, temp_folder="./tmp", feature
             i += 1
         '''
 
-        # remove temp files
-        shutil.rmtree(dis_crop_folder)
-        shutil.rmtree(ref_crop_folder)
-        # os.remove(dis_video_avpvs_crop)
-        # os.remove(ref_video_avpvs_crop)
-
-    pooled_features, full_features = __store_and_pool_features(dis_video, features, meta, features_temp_folder)
+    pooled_features, full_features = __store_and_pool_features(dis_video, features, meta, features_temp_folder, cache, cache_keys)
     return pooled_features, full_features
 
 
-def predict_video_score(features, model_base_path, clipping=True):
+def extract_features_multi(dis_video, ref_video=None, no_ref_featurenames=set(), full_ref_featurenames=set(), temp_folder="./tmp", features_temp_folder="./tmp/features", meta=False, early_stop=None, cache_folder=None, crop_first=False):
     """
-    based on the given features and model_base_path predict scores for all stored model types:
+    extract the no-reference features `no_ref_featurenames` (as `extract_features_no_ref`) and the
+    full-reference features `full_ref_featurenames` (as `extract_features_full_ref`) in one pass,
+    each video is converted and decoded once and each feature is calculated once per kind,
+    features are stored in the `no_ref` and `full_ref` subfolders of `features_temp_folder`
+
+    features in both sets (e.g. si or blur, used by nofu and fume) are calculated twice, because the
+    no-reference models are trained on BGR frames and the full-reference models on RGB frames, thus the
+    values differ for all color dependent features (also those based on a BGR gray conversion)
+
+    in case full-reference features are required, the dis_video is converted to the properties of the ref_video
+    (as for `extract_features_full_ref`), this is also used for the no-reference features
+    in case of a `cache_folder` the features are stored in the content addressed cache (see `pixelmodels.cache`)
+    instead of `features_temp_folder`, thus they are bounded by the cache budget
+    if `crop_first` is true, only the source lines of the center crop are scaled (see `pixelmodels.convert`)
+
+    returns pooled no-reference features, pooled full-reference features (both extended by mode0 features if meta is true)
+    """
+    msg_assert(os.path.isfile(dis_video), f"{dis_video} does not exists", f"{dis_video} exists")
+    full_ref = len(full_ref_featurenames) > 0
+    msg_assert(not full_ref or (ref_video is not None and os.path.isfile(ref_video)), f"full-reference features require an existing ref_video")
+
+    lInfo(f"handle : {dis_video} for {no_ref_featurenames | full_ref_featurenames}")
+    if early_stop is not None:
+        # early stopped features must not be mixed with the features of all frames
+        features_temp_folder = os.path.join(features_temp_folder, "early_stop")
+    if crop_first:
+        # the crop before scale conversion is equal within a tolerance, not exactly
+        features_temp_folder = os.path.join(features_temp_folder, "crop_first")
+    folders = {
+        "no_ref": os.path.join(features_temp_folder, "no_ref"),
+        "full_ref": os.path.join(features_temp_folder, "full_ref"),
+    }
+    cache = open_cache(cache_folder)
+    to_calculate = {}
+    features = {}
+    cache_keys = {}
+    if len(no_ref_featurenames) > 0:
+        # no-reference features of a reference aligned conversion are not equal to the features of `extract_features_no_ref`
+        cache_videos, kind = ([dis_video, ref_video], "no_ref_ref_aligned") if full_ref else ([dis_video], "no_ref")
+        to_calculate["no_ref"], features["no_ref"], cache_keys["no_ref"] = __filter_to_be_calculated_features(
+            dis_video, all_no_ref_features(), no_ref_featurenames, folders["no_ref"],
+            cache, cache_videos, {"kind": kind, "crop": CENTER_CROP, "early_stop": early_stop, "crop_first": crop_first}
+        )
+    if full_ref:
+        to_calculate["full_ref"], features["full_ref"], cache_keys["full_ref"] = __filter_to_be_calculated_features(
+            dis_video, all_features(), full_ref_featurenames, folders["full_ref"],
+            cache, [dis_video, ref_video], {"kind": "full_ref", "crop": CENTER_CROP, "early_stop": early_stop, "crop_first": crop_first}
+        )
+
+    lInfo(f"calculate missing features {to_calculate} for {dis_video}")
+    if any(len(x) > 0 for x in to_calculate.values()):
+        crop_folder = f"{temp_folder}/crop/{get_filename_without_extension(dis_video)}_multi/"
+        try:
+            if full_ref:
+                ffprobe_res = ffmpeg.probe(ref_video)
+                properties = {
+                    "width": ffprobe_res["streams"][0]["width"],
+                    "height": ffprobe_res["streams"][0]["height"],
+                    "framerate": ffprobe_res["streams"][0]["avg_frame_rate"],
+                    "pix_fmt": ffprobe_res["streams"][0]["pix_fmt"],
+                }
+                dis_video_avpvs_crop = convert_and_crop(dis_video, crop_folder + "dis/", crop_first=crop_first, ccheight=CENTER_CROP, **properties)
+                ref_video_avpvs_crop = convert_and_crop(ref_video, crop_folder + "ref/", crop_first=crop_first, ccheight=CENTER_CROP, **properties)
+                frames = iterate_by_frame_two_videos(dis_video_avpvs_crop, ref_video_avpvs_crop, convert=False, openCV=True)
+            else:
+                dis_video_avpvs_crop = convert_and_crop(dis_video, crop_folder + "dis/", crop_first=crop_first, ccheight=CENTER_CROP)
+                frames = ((frame, None) for frame in iterate_by_frame(dis_video_avpvs_crop, convert=False, openCV=True))
+
+            monitor = None
+            if early_stop is not None:
+                monitor = ConvergenceMonitor(count_frames(dis_video_avpvs_crop), **early_stop)
+
+            def func(kind, f, d_frame, r_frame):
+                if kind == "no_ref":
+                    return kind + ":" + f, features[kind][f].calc(d_frame)
+                return kind + ":" + f, features[kind][f].calc_dis_ref(d_frame, r_frame)
+
+            i = 0
+            with ThreadPool(processes=feature_threads()) as pool:
+                for d_frame, r_frame in frames:
+                    starmap = [("no_ref", f, d_frame, None) for f in to_calculate.get("no_ref", [])]
+                    if full_ref:
+                        # full-reference features use RGB frames (see `extract_features_full_ref`), thus features
+                        # of both kinds can not share their values
+                        d_rgb_frame = cv2.cvtColor(d_frame, cv2.COLOR_BGR2RGB)
+                        r_rgb_frame = cv2.cvtColor(r_frame, cv2.COLOR_BGR2RGB)
+                        starmap += [("full_ref", f, d_rgb_frame, r_rgb_frame) for f in to_calculate["full_ref"]]
+                    values = dict(pool.starmap(func, starmap))
+                    i += 1
+                    if monitor is not None and monitor.update(d_frame, values):
+                        lInfo(f"feature values converged, stop after {i} frames of {dis_video} ({monitor.scene_cuts} scene cuts)")
+                        break
+        finally:
+            # also in case of errors, otherwise the temp folder grows
+            shutil.rmtree(crop_folder, ignore_errors=True)
+
+    pooled = {}
+    for kind in features:
+        pooled[kind], _ = __store_and_pool_features(dis_video, features[kind], meta, folders[kind], cache, cache_keys[kind])
+    return pooled.get("no_ref", {}), pooled.get("full_ref", {})
+
+
+def measure_feature_costs(videos, featurenames, temp_folder="./tmp"):
+    """
+    measures the extraction cost of each feature in seconds per frame on a sample of videos,
+    `videos` is a list of dictionaries as returned by `read_database`, in case `src_video` is set,
+    full-reference features are calculated
+
+    returns a dictionary featurename: seconds per frame, the cost of conversion and decoding is stored as `_base`
+    """
+    costs = {f: 0.0 for f in featurenames}
+    costs["_base"] = 0.0
+    number_frames = 0
+    for video in videos:
+        full_ref = "src_video" in video
+        all_feat = all_features() if full_ref else all_no_ref_features()
+        features = {f: all_feat[f] for f in featurenames}
+        lInfo(f"measure feature costs for {video['video']}")
+
+        start = time.perf_counter()
+        crops = [convert_to_avpvs_and_crop(video["video"], f"{temp_folder}/cost/dis/", ccheight=CENTER_CROP)]
+        if full_ref:
+            crops.append(convert_to_avpvs_and_crop(video["src_video"], f"{temp_folder}/cost/ref/", ccheight=CENTER_CROP))
+            frames = iterate_by_frame_two_videos(crops[0], crops[1], convert=False, openCV=True)
+        else:
+            frames = iterate_by_frame(crops[0], convert=False, openCV=True)
+
+        feature_time = 0.0
+        for frame in frames:
+            for f in features:
+                feature_start = time.perf_counter()
+                if full_ref:
+                    features[f].calc_dis_ref(frame[0], frame[1])
+                else:
+                    features[f].calc(frame)
+                duration = time.perf_counter() - feature_start
+                costs[f] += duration
+                feature_time += duration
+            number_frames += 1
+        costs["_base"] += time.perf_counter() - start - feature_time
+        for crop in crops:
+            os.remove(crop)
+    return {f: costs[f] / max(number_frames, 1) for f in costs}
+
+
+def model_featurenames(model_base_path, default_featurenames):
+    """
+    returns the featurenames a model in `model_base_path` was trained with (stored in the info.json of model variants),
+    otherwise `default_featurenames`
+    """
+    info_filename = os.path.join(model_base_path, "info.json")
+    if os.path.isfile(info_filename):
+        with open(info_filename) as info_file:
+            info = json.load(info_file)
+        if "featurenames" in info:
+            return set(info["featurenames"])
+    return default_featurenames
+
+
+# models loaded by `load_models` (per model base path), in case they are loaded before the
+# batch worker processes are forked, the workers share the loaded models
+_LOADED_MODELS = {}
+
+
+def load_models(model_base_path):
+    """
+    loads all stored model types of `model_base_path` once per process:
     - mos
     - classification
     - rating distribution
-    further perform clipping if required and meaningful (e.g. in case of rating dist prediction no clipping is required)
+
+    returns a dictionary with the model type as key and a tuple (kind, model), where kind is "forest" for
+    memory mapped flattened forests (see `pixelmodels.forest`) or "sklearn" for serialized sklearn models
     """
-    df = pd.DataFrame([features])
-    columns = df.columns.difference(["video", "src_video", "mos", "rating_dist"])
-    X = df[sorted(columns)]
-    #X = X.replace([np.inf, -np.inf], np.nan).fillna(0).values
-    lInfo(f"loaded features {len(df)}: shape: {X.shape}")
+    if model_base_path in _LOADED_MODELS:
+        return _LOADED_MODELS[model_base_path]
 
     models = {
         "mos": model_base_path + "/model_regression.npz",
         "class": model_base_path + "/model_class.npz",
         "rating_dist": model_base_path + "/model_rating_dist.npz"
     }
-    results = {}
+    loaded = {}
     for m in models:
-        if os.path.isfile(models[m]):
-            lInfo(f"handle model {m}: {models[m]}")
-            model = load_serialized(models[m])
-            predicted = model.predict(X)
-            # apply clipping if needed
-            if clipping and m != "rating_dist":
-                predicted = np.clip(predicted, 1, 5)
-            # type conversion to float values
-            predicted = [float(x) for x in predicted.flatten().tolist()]
-            # some models have only one value, so just take this one value
-            if len(predicted) == 1:
-                predicted = predicted[0]
-            results[m] = predicted
+        if os.path.isdir(flat_model_filename(models[m])):
+            lInfo(f"load flattened model {m}: {flat_model_filename(models[m])}")
+            loaded[m] = ("forest", load_forest(flat_model_filename(models[m]), mmap=True))
+        elif os.path.isfile(models[m]):
+            lInfo(f"load model {m}: {models[m]}")
+            loaded[m] = ("sklearn", load_serialized(models[m]))
         else:
             lWarn(f"model {m} skipped, there is no trained model for this available, {models[m]}")
+    _LOADED_MODELS[model_base_path] = loaded
+    return loaded
+
+
+def tree_predictions(kind, model, features):
+    """
+    returns the per tree (estimator) mos predictions of a loaded regression model (see `load_models`) for one feature dictionary
+    """
+    if kind == "forest":
+        return forest_tree_values(model, features_to_matrix(model, [features]))[0, :, 0]
+    df = pd.DataFrame([features])
+    X = df[sorted(df.columns)]
+    for _, step in model.steps[:-1]:
+        X = step.transform(X)
+    return np.array([estimator.predict(np.asarray(X))[0] for estimator in model.steps[-1][1].estimators_])
+
+
+def predict_mode0_video_score(video, model_base_path, clipping=True):
+    """
+    cheap first tier of a cascade prediction for hybrid models, the scores are predicted by forests
+    that only use mode0 meta-data features (stored in `model_base_path`/mode0, see `train_mode0_model`),
+    the standard deviation of the per tree mos predictions (`mode0_std`) is a measure of the uncertainty,
+    the prediction has the same keys as `predict_video_score` (mos, class and rating_dist)
+    """
+    mode0_model_path = os.path.join(model_base_path, "mode0")
+    models = load_models(mode0_model_path)
+    msg_assert("mos" in models, f"there is no trained mode0 model in {mode0_model_path}")
+    features = {"meta_" + m: v for m, v in extract_mode0_features(video).items()}
+    kind, model = models["mos"]
+
+    prediction = predict_video_score(features, mode0_model_path, clipping)
+    if "class" not in prediction:
+        # mode0 models with only a mos forest, the classes of the training are the rounded mos values
+        prediction["class"] = float(np.clip(np.round(prediction["mos"]), 1, 5))
+    if "rating_dist" not in prediction:
+        lWarn(f"there is no mode0 rating distribution model in {mode0_model_path}")
+        prediction["rating_dist"] = None
+    prediction["mode0_std"] = float(np.std(tree_predictions(kind, model, features)))
+    prediction["tier"] = "mode0"
+    return prediction
+
+
+def predict_video_score(features, model_base_path, clipping=True):
+    """
+    based on the given features and model_base_path predict scores for all stored model types:
+    - mos
+    - classification
+    - rating distribution
+    further perform clipping if required and meaningful (e.g. in case of rating dist prediction no clipping is required)
+
+    in case a flattened forest is stored next to a model (see `pixelmodels.forest`), it is used for prediction,
+    otherwise the serialized sklearn model is used
+    """
+    results = {}
+    for m, (kind, model) in load_models(model_base_path).items():
+        if kind == "forest":
+            predicted = forest_predict(model, features_to_matrix(model, [features]))
+        else:
+            df = pd.DataFrame([features])
+            if hasattr(model, "feature_names_in_"):
+                # e.g. features of several models are extracted together
+                X = df[list(model.feature_names_in_)]
+            else:
+                columns = df.columns.difference(["video", "src_video", "mos", "rating_dist", "rating_levels"])
+                X = df[sorted(columns)]
+            #X = X.replace([np.inf, -np.inf], np.nan).fillna(0).values
+            lInfo(f"loaded features {len(df)}: shape: {X.shape}")
+            predicted = model.predict(X)
+        # apply clipping if needed
+        if clipping and m != "rating_dist":
+            predicted = np.clip(predicted, 1, 5)
+        # type conversion to float values
+        predicted = [float(x) for x in predicted.flatten().tolist()]
+        # some models have only one value, so just take this one value
+        if len(predicted) == 1:
+            predicted = predicted[0]
+        results[m] = predicted
     results["model"] = model_base_path
     results["date"] = str(datetime.datetime.now())
     results["version"] = get_repo_version()
-    return results
\ No newline at end of file
+    return results
+
+
+# columns of feature tables that are not used as features, e.g. in features.csv of a model folder
+NON_FEATURE_COLUMNS = ["video", "src_video", "mos", "mos_class", "rating_dist", "rating_levels"]
+
+
+def predict_feature_table(df, model_base_path, clipping=True, batch_size=10000):
+    """
+    predicts the scores of all rows of a feature table (DataFrame with one pooled feature vector per row,
+    e.g. `features.csv` of a model folder) for all stored model types (see `predict_video_score`),
+    the predictions of all rows are calculated at once (flattened forests in batches of `batch_size` rows),
+    returns a dictionary model type: list of the predictions of all rows
+    """
+    msg_assert(len(df) > 0, "the feature table is empty")
+    results = {}
+    for m, (kind, model) in load_models(model_base_path).items():
+        if kind == "forest":
+            feature_names = model["feature_names"].tolist()
+            missing = set(feature_names) - set(df.columns)
+            msg_assert(len(missing) == 0, f"features {missing} are required for the model, but missing")
+            X = df[feature_names].to_numpy(dtype=np.float64)
+            predicted = np.concatenate([
+                forest_predict(model, X[i:i + batch_size]) for i in range(0, len(X), batch_size)
+            ])
+        else:
+            if hasattr(model, "feature_names_in_"):
+                X = df[list(model.feature_names_in_)]
+            else:
+                X = df[sorted(df.columns.difference(NON_FEATURE_COLUMNS))]
+            predicted = model.predict(X)
+        predicted = np.asarray(predicted, dtype=np.float64)
+        if clipping and m != "rating_dist":
+            predicted = np.clip(predicted, 1, 5)
+        results[m] = predicted.tolist()
+    lInfo(f"predicted {len(df)} feature vectors with {model_base_path}")
+    return results
+
+
+def video_windows(video, window_length=10):
+    """
+    splits the duration of a video in windows of `window_length` seconds,
+    returns a list of (start, duration) tuples, a short last window (< half window_length) is merged with the previous one
+    """
+    duration = float(ffmpeg.probe(video)["format"]["duration"])
+    starts = list(np.arange(0, duration, window_length))
+    if len(starts) > 1 and duration - starts[-1] < window_length / 2:
+        starts = starts[:-1]
+    ends = starts[1:] + [duration]
+    return [(float(start), float(end - start)) for start, end in zip(starts, ends)]
+
+
+def cut_video_window(video, start, duration, folder):
+    """
+    cuts a window of a video without re-encoding (ffmpeg seeks to the keyframe before `start`,
+    nothing before it is decoded), returns the filename of the window,
+    the name includes a hash of the video path, thus windows of videos with the same name in other folders
+    (e.g. of other databases) do not overwrite each other and do not share stored features
+    """
+    os.makedirs(folder, exist_ok=True)
+    path_hash = hashlib.sha1(os.path.abspath(video).encode()).hexdigest()[:12]
+    window_video = os.path.join(
+        folder,
+        get_filename_without_extension(video) + f"_{path_hash}_window_{start:09.3f}" + os.path.splitext(video)[1]
+    )
+    ffmpeg.input(video, ss=start, t=duration).output(
+        window_video, c="copy", map="0:v:0", avoid_negative_ts="make_zero"
+    ).overwrite_output().run(quiet=True)
+    return window_video
+
+
+def predict_video_window(video, start, duration, temp_folder, predict_function, predict_arguments):
+    """
+    predicts the scores of one window of a video using `predict_function(window_video, *predict_arguments)`,
+    the window is only stored during the prediction
+    """
+    window_video = cut_video_window(video, start, duration, f"{temp_folder}/windows/")
+    try:
+        prediction = predict_function(window_video, *predict_arguments)
+    finally:
+        os.remove(window_video)
+    prediction["window_start"] = start
+    prediction["window_duration"] = duration
+    return prediction
+
+
+def aggregate_window_predictions(predictions):
+    """
+    aggregates per window predictions to one prediction, all numeric values (and lists of values,
+    e.g. rating distributions) are averaged weighted by the window duration,
+    the `class` is the majority vote of the windows weighted by their duration
+    """
+    weights = np.array([p["window_duration"] for p in predictions], dtype=np.float64)
+    weights /= weights.sum()
+    aggregated = {}
+    for key in predictions[0]:
+        if key in ["window_start", "window_duration"]:
+            continue
+        values = [p.get(key) for p in predictions]
+        if key == "class" and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            votes = {}
+            for v, w in zip(values, weights):
+                votes[v] = votes.get(v, 0) + w
+            # ties are resolved by the lower class
+            aggregated[key] = min(votes, key=lambda c: (-votes[c], c))
+        elif all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            aggregated[key] = float(np.dot(weights, values))
+        elif all(isinstance(v, list) and len(v) == len(values[0]) for v in values):
+            aggregated[key] = np.dot(weights, np.array(values, dtype=np.float64)).tolist()
+    return aggregated
+
+
+def predict_windowed(video, predict_function, predict_arguments, window_length=10, temp_folder="./tmp", cpu_count=1):
+    """
+    predicts scores for a long video, the video is split in windows of `window_length` seconds (the models are
+    designed for short videos, e.g. 10 s), all windows are predicted in parallel with `cpu_count` processes,
+    so that memory and temporary files are bounded per window
+
+    returns the aggregated prediction (duration weighted mean) and the per window predictions in `windows`
+    """
+    windows = video_windows(video, window_length)
+    lInfo(f"predict {len(windows)} windows of {video}")
+    items = [[video, start, duration] for start, duration in windows]
+    arguments = [temp_folder, predict_function, predict_arguments]
+    if cpu_count > 1 and len(items) > 1:
+        window_predictions = run_parallel(
+            items=items,
+            function=predict_video_window,
+            arguments=arguments,
+            num_cpus=cpu_count,
+            multi_item=True
+        )
+    else:
+        # e.g. inside batch worker processes, that can not start further processes
+        window_predictions = [predict_video_window(*item, *arguments) for item in items]
+    prediction = aggregate_window_predictions(window_predictions)
+    prediction["windows"] = window_predictions
+    prediction["window_length"] = window_length
+    prediction["model"] = window_predictions[0].get("model")
+    prediction["date"] = str(datetime.datetime.now())
+    prediction["version"] = get_repo_version()
+    return prediction
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# convert -- crop before scale conversion of videos to the center crop of the avpvs
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import time
+from fractions import Fraction
+
+import numpy as np
+
+import ffmpeg
+
+from quat.log import *
+from quat.utils.assertions import *
+from quat.utils.fileutils import get_filename_without_extension
+from quat.ff.convert import convert_to_avpvs_and_crop
+
+from pixelmodels.budget import ffmpeg_options
+from pixelmodels.frames import iterate_planar_frames
+
+# expected difference of the crop before scale conversion compared to the scale before crop conversion
+# (`convert_to_avpvs_and_crop`), in 8 bit code values over all planes of all frames,
+# the differences are caused by the fixed point filter positions of the scaler,
+# measured with `main` (ffmpeg 7.0.2, 360p to 2160p renditions to 3840x2160 yuv422p10le, see README): integer scale
+# ratios are bit exact, otherwise at least 64.2 dB PSNR and at most 1.25 code values difference
+CROP_FIRST_TOLERANCE = {
+    "min_psnr": 60.0,
+    "max_abs_diff": 1.5,
+}
+
+
+def avpvs_height(width, height, src_width, src_height):
+    """
+    height of the avpvs, as calculated by ffmpeg for negative heights (e.g. -2 keeps the aspect ratio with an even height):
+    the aspect ratio height divided by the factor is rounded to the nearest integer (av_rescale), then multiplied
+    """
+    if height > 0:
+        return height
+    factor = abs(height)
+    return (width * src_height + src_width * factor // 2) // (src_width * factor) * factor
+
+
+def crop_window(src_height, height, ccheight, align=2, margin=4):
+    """
+    calculates the crop window in source coordinates that is equivalent to a center crop of `ccheight` lines
+    of the video scaled to `height`,
+    returns the source start line and number of lines, the scaled height of this window and the start line of
+    the center crop in the scaled window,
+    the window is extended by `margin` source lines (more for downscaling) at both sides for the scaler taps and aligned,
+    so that all positions are integers in both coordinate systems and the chroma planes stay aligned,
+    Important: for uncommon scale ratios (e.g. 480 to 2158 lines) this alignment can result in the full frame
+    """
+    scale = Fraction(height, src_height)
+    # source lines that map to integer scaled lines, and even for subsampled chroma
+    step = scale.denominator * align // math.gcd(scale.denominator, align)
+    crop_start = (height - ccheight) // 2
+    taps = margin * max(1, math.ceil(1 / scale))
+
+    src_start = max(0, math.floor(crop_start / scale) - taps)
+    src_start -= src_start % step
+    src_end = min(src_height, math.ceil((crop_start + ccheight) / scale) + taps)
+    src_end = min(src_height, src_end + (-src_end) % step)
+
+    scaled_start = int(src_start * scale)
+    scaled_height = int((src_end - src_start) * scale)
+    return src_start, src_end - src_start, scaled_height, crop_start - scaled_start
+
+
+def convert_to_avpvs_and_crop_first(video, result_folder, width=3840, height=-2, framerate=60, pix_fmt="yuv422p10le", ccheight=360):
+    """
+    same result as `convert_to_avpvs_and_crop` (within CROP_FIRST_TOLERANCE), however only the lines of the
+    source video that are required for the center crop are scaled,
+    in case these are all lines (see `crop_window`, e.g. 854x480 to 3840x2158) `convert_to_avpvs_and_crop` is used,
+    returns the filename of the converted video in `result_folder`
+    """
+    os.makedirs(result_folder, exist_ok=True)
+    stream = [s for s in ffmpeg.probe(video)["streams"] if s["codec_type"] == "video"][0]
+    src_width, src_height = int(stream["width"]), int(stream["height"])
+    height = avpvs_height(width, height, src_width, src_height)
+    msg_assert(ccheight <= height, f"center crop {ccheight} is larger than the avpvs height {height}")
+
+    src_start, src_lines, scaled_height, crop_start = crop_window(src_height, height, ccheight)
+    if src_lines >= src_height:
+        lInfo(f"the crop window of {video} ({src_height} to {height} lines) is the full frame, scale before crop")
+        return convert_to_avpvs_and_crop(video, result_folder, width=width, height=height, framerate=framerate, pix_fmt=pix_fmt, ccheight=ccheight)
+    lInfo(f"crop lines {src_start}-{src_start + src_lines} of {video} before scaling to {width}x{scaled_height}")
+
+    result = os.path.join(result_folder, get_filename_without_extension(video) + "_crop.mkv")
+    (
+        ffmpeg
+        .input(video)
+        .filter("crop", "in_w", src_lines, 0, src_start)
+        .filter("scale", width, scaled_height)
+        .filter("fps", fps=framerate)
+        .filter("crop", "in_w", ccheight, 0, crop_start)
+        .output(result, vcodec="ffvhuff", pix_fmt=pix_fmt, an=None, **ffmpeg_options())
+        .overwrite_output()
+        .run(quiet=True)
+    )
+    return result
+
+
+def convert_and_crop(video, result_folder, crop_first=False, **kwargs):
+    """
+    converts `video` to the center crop of the avpvs, scale before crop (`convert_to_avpvs_and_crop`) or
+    crop before scale (`convert_to_avpvs_and_crop_first`) in case of `crop_first`
+    """
+    if crop_first:
+        return convert_to_avpvs_and_crop_first(video, result_folder, **kwargs)
+    return convert_to_avpvs_and_crop(video, result_folder, **kwargs)
+
+
+def compare_videos(video_a, video_b):
+    """
+    compares two converted videos plane by plane, returns psnr and maximal absolute difference in 8 bit code values
+    """
+    sq_error, values, max_diff = 0.0, 0, 0.0
+    for a, b in zip(iterate_planar_frames(video_a), iterate_planar_frames(video_b)):
+        scale = 1 << (a.bitdepth - 8)
+        for pa, pb in [(a.y, b.y), (a.u, b.u), (a.v, b.v)]:
+            diff = (pa.astype(np.float64) - pb.astype(np.float64)) / scale
+            sq_error += float((diff ** 2).sum())
+            values += diff.size
+            max_diff = max(max_diff, float(np.abs(diff).max()))
+    mse = sq_error / max(values, 1)
+    psnr = float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    return {"psnr": psnr, "max_abs_diff": max_diff}
+
+
+def benchmark(video, temp_folder, **kwargs):
+    """
+    converts `video` with both conversions, returns the runtimes and the differences of the results
+    """
+    result = {"video": video}
+    converted = {}
+    for mode in ["scale_first", "crop_first"]:
+        folder = os.path.join(temp_folder, mode)
+        start = time.time()
+        converted[mode] = convert_and_crop(video, folder, crop_first=(mode == "crop_first"), **kwargs)
+        result[f"{mode}_seconds"] = time.time() - start
+    result["speedup"] = result["scale_first_seconds"] / max(result["crop_first_seconds"], 1e-9)
+    result.update(compare_videos(converted["scale_first"], converted["crop_first"]))
+    result["within_tolerance"] = result["psnr"] >= CROP_FIRST_TOLERANCE["min_psnr"] and result["max_abs_diff"] <= CROP_FIRST_TOLERANCE["max_abs_diff"]
+    for mode in converted:
+        shutil.rmtree(os.path.join(temp_folder, mode), ignore_errors=True)
+    return result
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='benchmark of the crop before scale conversion compared to the scale before crop conversion, e.g. for low resolution renditions',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("video", type=str, nargs="+", help="videos to convert")
+    parser.add_argument("--width", type=int, default=3840, help="width of the avpvs")
+    parser.add_argument("--height", type=int, default=-2, help="height of the avpvs (negative values keep the aspect ratio)")
+    parser.add_argument("--framerate", type=str, default="60", help="framerate of the avpvs")
+    parser.add_argument("--pix_fmt", type=str, default="yuv422p10le", help="pixel format of the avpvs")
+    parser.add_argument("--ccheight", type=int, default=360, help="height of the center crop")
+    parser.add_argument("--temp_folder", type=str, default="./tmp/crop_benchmark", help="temp folder for the converted videos")
+    parser.add_argument("--output_report", type=str, default="crop_benchmark.json", help="report of all runtimes and differences")
+
+    a = vars(parser.parse_args())
+    results = []
+    for video in a["video"]:
+        result = benchmark(
+            video,
+            a["temp_folder"],
+            width=a["width"],
+            height=a["height"],
+            framerate=a["framerate"],
+            pix_fmt=a["pix_fmt"],
+            ccheight=a["ccheight"]
+        )
+        if not result["within_tolerance"]:
+            lWarn(f"crop before scale conversion of {video} exceeds the tolerance {CROP_FIRST_TOLERANCE}")
+        results.append(result)
+        print(json.dumps(result, indent=4))
+
+    with open(a["output_report"], "w") as rfp:
+        json.dump({"tolerance": CROP_FIRST_TOLERANCE, "results": results}, rfp, indent=4)
+    lInfo(f"benchmark report stored in {a['output_report']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# forest -- compact array based random forest inference
+import argparse
+import glob
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from quat.log import *
+from quat.utils.assertions import *
+
+# version of the stored flat forest format
+FOREST_FORMAT_VERSION = 2
+
+
+def flatten_model(model, feature_names=None):
+    """
+    flattens a trained model, e.g. a pipeline of feature selection steps and a random forest as trained by
+    `train_rf_models`, or a plain random forest, to contiguous numpy node arrays
+
+    the order of the input features is fixed by `feature_names` (default is `feature_names_in_` of the model),
+    all selection steps are folded into the node feature indices
+
+    returns a dictionary of numpy arrays:
+        feature_names: used input feature order
+        feature, threshold, left, right: node arrays of all trees (leaf nodes point to themselves)
+        value: per node prediction values, (class probabilities in case of classification)
+        roots: index of the root node of each tree
+        classes: class labels in case of a classification, otherwise empty
+        max_depth: maximal depth of all trees
+        missing_left: per node routing of missing (NaN) feature values, as done by sklearn >= 1.3
+            (only stored if the trees have it, otherwise NaN feature values are rejected by `forest_apply`)
+    """
+    steps = [x[1] for x in model.steps] if hasattr(model, "steps") else [model]
+    if feature_names is None:
+        feature_names = list(steps[0].feature_names_in_)
+    columns = np.arange(len(feature_names))
+    for step in steps[:-1]:
+        columns = columns[step.get_support()]
+    forest = steps[-1]
+    classification = hasattr(forest, "classes_")
+    msg_assert(
+        not classification or forest.n_outputs_ == 1,
+        "multi output classification forests are not supported"
+    )
+
+    trees = [estimator.tree_ for estimator in forest.estimators_]
+    offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+    feature, threshold, left, right, value, missing_left = [], [], [], [], [], []
+    for tree, offset in zip(trees, offsets):
+        nodes = np.arange(tree.node_count)
+        leaf = tree.children_left == -1
+        # leaf nodes point to themselves, thus the traversal can run for a fixed number of steps
+        feature.append(np.where(leaf, 0, columns[np.where(leaf, 0, tree.feature)]))
+        threshold.append(np.where(leaf, 0, tree.threshold))
+        left.append(offset + np.where(leaf, nodes, tree.children_left))
+        right.append(offset + np.where(leaf, nodes, tree.children_right))
+        if hasattr(tree, "missing_go_to_left"):
+            missing_left.append(np.where(leaf, False, np.asarray(tree.missing_go_to_left) != 0))
+        if classification:
+            # same normalization as done by DecisionTreeClassifier.predict_proba
+            proba = tree.value[:, 0, :forest.n_classes_].copy()
+            normalizer = proba.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba /= normalizer
+            value.append(proba)
+        else:
+            value.append(tree.value[:, :, 0])
+
+    index_dtype = np.int32 if offsets[-1] < np.iinfo(np.int32).max else np.int64
+    forest_arrays = {
+        "version": np.array(FOREST_FORMAT_VERSION),
+        "feature_names": np.array(feature_names, dtype=str),
+        "feature": np.concatenate(feature).astype(index_dtype),
+        "threshold": np.concatenate(threshold).astype(np.float64),
+        "left": np.concatenate(left).astype(index_dtype),
+        "right": np.concatenate(right).astype(index_dtype),
+        "value": np.ascontiguousarray(np.concatenate(value), dtype=np.float64),
+        "roots": offsets[:-1].astype(index_dtype),
+        "classes": np.asarray(forest.classes_ if classification else []),
+        "max_depth": np.array(max([tree.max_depth for tree in trees])),
+    }
+    if len(missing_left) == len(trees):
+        forest_arrays["missing_left"] = np.concatenate(missing_left)
+    return forest_arrays
+
+
+def save_forest(forest, folder):
+    """
+    stores a flattened forest (see `flatten_model`) as folder of uncompressed npy files (one per array),
+    thus the arrays can be memory mapped
+    """
+    os.makedirs(folder, exist_ok=True)
+    for k in forest:
+        np.save(os.path.join(folder, k + ".npy"), forest[k])
+
+
+def load_forest(folder, mmap=True):
+    """
+    loads a flattened forest stored with `save_forest`, in case of `mmap` the arrays are memory mapped (read only),
+    so all processes of a host that use the same forest share the memory
+    """
+    forest = {
+        os.path.splitext(os.path.basename(x))[0]: np.load(x, mmap_mode="r" if mmap else None)
+        for x in glob.glob(os.path.join(folder, "*.npy"))
+    }
+    msg_assert(
+        "version" in forest and int(forest["version"]) == FOREST_FORMAT_VERSION,
+        f"forest format of {folder} is not supported"
+    )
+    return forest
+
+
+def features_to_matrix(forest, features):
+    """
+    converts a list of feature dictionaries to a (n_samples x n_features) matrix in the feature order of the forest
+    """
+    feature_names = forest["feature_names"].tolist()
+    for f in features:
+        missing = set(feature_names) - set(f.keys())
+        msg_assert(len(missing) == 0, f"features {missing} are required for the model, but missing")
+    return np.array([[f[name] for name in feature_names] for f in features], dtype=np.float64)
+
+
+def forest_apply(forest, X):
+    """
+    returns the reached leaf node index for each sample and tree, shape (n_samples x n_trees),
+    missing (NaN) feature values are routed as sklearn does, infinite values are rejected (as by sklearn)
+    """
+    # trees compare float32 feature values (as sklearn does)
+    X = np.asarray(X, dtype=np.float64).astype(np.float32)
+    msg_assert(not np.isinf(X).any(), "feature values must not be infinite or too large for float32")
+    missing_left = forest.get("missing_left")
+    msg_assert(
+        missing_left is not None or not np.isnan(X).any(),
+        "feature values must not be NaN, the forest has no routing of missing values"
+    )
+    samples = np.arange(X.shape[0])[:, np.newaxis]
+    nodes = np.repeat(forest["roots"][np.newaxis, :], X.shape[0], axis=0)
+    for _ in range(int(forest["max_depth"])):
+        values = X[samples, forest["feature"][nodes]]
+        go_left = values <= forest["threshold"][nodes]
+        if missing_left is not None:
+            go_left |= np.isnan(values) & missing_left[nodes]
+        nodes = np.where(go_left, forest["left"][nodes], forest["right"][nodes])
+    return nodes
+
+
+def forest_tree_values(forest, X):
+    """
+    returns the per tree prediction values, shape (n_samples x n_trees x n_outputs),
+    in case of classification n_outputs are the class probabilities
+    """
+    return forest["value"][forest_apply(forest, X)]
+
+
+def forest_predict(forest, X):
+    """
+    predicts the values for the (n_samples x n_features) matrix X, the results are equal to the
+    sklearn forest prediction (tree predictions are accumulated in estimator order, as with n_jobs=1)
+    """
+    tree_values = forest_tree_values(forest, X)
+    accumulated = np.zeros((tree_values.shape[0], tree_values.shape[2]), dtype=np.float64)
+    for t in range(tree_values.shape[1]):
+        accumulated += tree_values[:, t]
+    accumulated /= tree_values.shape[1]
+
+    if len(forest["classes"]) > 0:
+        return forest["classes"].take(np.argmax(accumulated, axis=1), axis=0)
+    if accumulated.shape[1] == 1:
+        return accumulated[:, 0]
+    return accumulated
+
+
+def check_forest(forest, model, X):
+    """
+    checks that the flattened `forest` predicts exactly the same values as `model` for the DataFrame X
+    """
+    forest_step = model.steps[-1][1] if hasattr(model, "steps") else model
+    n_jobs = forest_step.n_jobs
+    # sklearn accumulates the trees in a non deterministic order for parallel jobs
+    forest_step.set_params(n_jobs=1)
+    expected = model.predict(X)
+    forest_step.set_params(n_jobs=n_jobs)
+
+    predicted = forest_predict(forest, X[forest["feature_names"].tolist()].values)
+    equal = np.array_equal(np.asarray(expected).reshape(predicted.shape), predicted)
+    if not equal:
+        lWarn("flattened forest predictions differ from the model predictions")
+    return equal
+
+
+def export_forest(model, model_filename, X):
+    """
+    flattens `model` with the feature order of the DataFrame X and stores it next to `model_filename`
+    (see `flat_model_filename`), in case the flattened forest does not predict the same values as the
+    model for X, the forest is not stored and an outdated one is removed, thus the serialized model
+    is used for the predictions, returns True if the forest is stored
+    """
+    folder = flat_model_filename(model_filename)
+    forest = flatten_model(model, list(X.columns))
+    if check_forest(forest, model, X):
+        save_forest(forest, folder)
+        return True
+    lWarn(f"flattened forest of {model_filename} is not stored")
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    return False
+
+
+def flat_model_filename(model_filename):
+    """
+    folder of the flattened forest for a serialized model, e.g. model_class.npz -> model_class_flat
+    """
+    return os.path.splitext(model_filename)[0] + "_flat"
+
+
+def export_model_folder(model_folder):
+    """
+    exports all serialized models (model_*.npz) of a model folder as flattened forests,
+    the feature order is taken from the models
+    """
+    # sklearn is only required for the export, not for the prediction
+    from quat.ml.mlcore import load_serialized
+
+    for model_filename in sorted(glob.glob(os.path.join(model_folder, "model_*.npz"))):
+        lInfo(f"export {model_filename}")
+        save_forest(flatten_model(load_serialized(model_filename)), flat_model_filename(model_filename))
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='export trained models as flattened forests for fast inference',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("model_folder", type=str, nargs="+", help="model folders, e.g. pixelmodels/models/nofu")
+
+    a = vars(parser.parse_args())
+    for model_folder in a["model_folder"]:
+        export_model_folder(model_folder)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
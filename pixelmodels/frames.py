@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# frames -- planar frame source at native bit depth
+import copy
+import re
+
+import numpy as np
+
+import ffmpeg
+
+from quat.log import *
+from quat.utils.assertions import *
+
+from pixelmodels.budget import ffmpeg_options
+
+# planes of the features that support more than colour frames: luma (float32 plane in the 8 bit value range),
+# features that are not listed get colour frames (BGR for no-reference, RGB for full-reference features),
+# the support is checked by `check_planes` before the extraction starts
+FEATURE_CAPABILITIES = {
+    "si": "luma",
+    "ti": "luma",
+    "blur": "luma",
+    "noise": "luma",
+    "blockiness": "luma",
+    "ssim": "luma",
+    "psnr": "luma",
+}
+
+
+def parse_pix_fmt(pix_fmt):
+    """
+    returns horizontal and vertical chroma subsampling and bit depth of a planar yuv pixel format, e.g. yuv422p10le
+    """
+    m = re.match(r"^yuv(420|422|444)p(\d+)?(le)?$", pix_fmt)
+    msg_assert(m is not None, f"pixel format {pix_fmt} is not supported by the planar frame source")
+    subsampling = {"420": (2, 2), "422": (2, 1), "444": (1, 1)}[m.group(1)]
+    bitdepth = int(m.group(2)) if m.group(2) else 8
+    return subsampling[0], subsampling[1], bitdepth
+
+
+class PlanarFrame:
+    """
+    one frame as planes Y, U, V at native bit depth (uint8 or uint16),
+    derived representations (luma, BGR, RGB) are calculated at most once per frame
+    """
+    def __init__(self, y, u, v, bitdepth, subsampling):
+        self.y = y
+        self.u = u
+        self.v = v
+        self.bitdepth = bitdepth
+        self._subsampling = subsampling
+        self._planes = {}
+
+    def luma(self):
+        """
+        luma plane as float32 in the 8 bit value range, the precision of higher bit depths is kept
+        """
+        if "luma" not in self._planes:
+            self._planes["luma"] = self.y.astype(np.float32) / (1 << (self.bitdepth - 8))
+        return self._planes["luma"]
+
+    def bgr(self):
+        """
+        8 bit BGR frame (as read by OpenCV), BT.601 limited range conversion
+        """
+        if "bgr" not in self._planes:
+            scale = np.float32(1 << (self.bitdepth - 8))
+            y = self.y.astype(np.float32) / scale - 16
+            sx, sy = self._subsampling
+            u = np.repeat(np.repeat(self.u, sy, axis=0), sx, axis=1).astype(np.float32) / scale - 128
+            v = np.repeat(np.repeat(self.v, sy, axis=0), sx, axis=1).astype(np.float32) / scale - 128
+            bgr = np.empty(self.y.shape + (3,), dtype=np.float32)
+            bgr[..., 0] = 1.164 * y + 2.017 * u
+            bgr[..., 1] = 1.164 * y - 0.392 * u - 0.813 * v
+            bgr[..., 2] = 1.164 * y + 1.596 * v
+            self._planes["bgr"] = np.clip(np.round(bgr), 0, 255).astype(np.uint8)
+        return self._planes["bgr"]
+
+    def rgb(self):
+        if "rgb" not in self._planes:
+            self._planes["rgb"] = np.ascontiguousarray(self.bgr()[..., ::-1])
+        return self._planes["rgb"]
+
+    def plane(self, name):
+        return {"luma": self.luma, "bgr": self.bgr, "rgb": self.rgb}[name]()
+
+
+def iterate_planar_frames(video):
+    """
+    iterates over all frames of a video as `PlanarFrame`, decoded by ffmpeg at the native pixel format,
+    only one frame is kept in memory
+    """
+    stream = [s for s in ffmpeg.probe(video)["streams"] if s["codec_type"] == "video"][0]
+    width, height, pix_fmt = int(stream["width"]), int(stream["height"]), stream["pix_fmt"]
+    sx, sy, bitdepth = parse_pix_fmt(pix_fmt)
+    dtype = np.uint8 if bitdepth == 8 else np.uint16
+    chroma_shape = (height // sy, width // sx)
+    y_size = width * height
+    c_size = chroma_shape[0] * chroma_shape[1]
+
+    process = ffmpeg.input(video, **ffmpeg_options()).output("pipe:", format="rawvideo", pix_fmt=pix_fmt).run_async(pipe_stdout=True, quiet=True)
+    frame_bytes = (y_size + 2 * c_size) * np.dtype(dtype).itemsize
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            values = np.frombuffer(data, dtype=dtype)
+            yield PlanarFrame(
+                values[:y_size].reshape(height, width),
+                values[y_size:y_size + c_size].reshape(chroma_shape),
+                values[y_size + c_size:].reshape(chroma_shape),
+                bitdepth,
+                (sx, sy)
+            )
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+def feature_planes(featurenames, default):
+    """
+    planes used for each feature, the plane of FEATURE_CAPABILITIES or the `default` colour frame (bgr or rgb)
+    """
+    return {f: FEATURE_CAPABILITIES.get(f, default) for f in featurenames}
+
+
+def check_planes(features, planes, full_ref=False):
+    """
+    fails fast in case a feature does not support its plane of `feature_planes`,
+    each luma feature is calculated on a synthetic luma plane, using a copy of the feature, thus its state is kept
+    """
+    dis = np.random.RandomState(0).uniform(16, 235, (144, 256)).astype(np.float32)
+    ref = np.clip(dis + 4, 16, 235)
+    for f, plane in sorted(planes.items()):
+        if plane != "luma":
+            continue
+        feature = copy.deepcopy(features[f])
+        try:
+            if full_ref:
+                feature.calc_dis_ref(dis, ref)
+            else:
+                feature.calc(dis)
+        except Exception as e:
+            msg_assert(False, f"feature {f} does not support luma planes ({e}), remove it from FEATURE_CAPABILITIES")
+
+
+def prepare_planes(frame, planes):
+    """
+    calculates all required representations of a frame once, before the features are calculated (e.g. in threads)
+    """
+    for plane in set(planes.values()):
+        frame.plane(plane)
+
+
+def calc_planar(features, featurename, planes, frame, ref_frame=None):
+    """
+    calculates a feature for a `PlanarFrame` (and the `ref_frame` for full-reference features)
+    using its plane of `feature_planes`
+    """
+    plane = planes[featurename]
+    if ref_frame is None:
+        return features[featurename].calc(frame.plane(plane))
+    return features[featurename].calc_dis_ref(frame.plane(plane), ref_frame.plane(plane))
@@ -14,12 +14,21 @@ from quat.ml.mlcore import *
 from quat.unsorted import jdump_file
 
 from pixelmodels.train_common import (
-    read_database
+    read_database,
+    read_feature_table
 )
+from pixelmodels.workqueue import run_batch
+from pixelmodels.budget import cpu_budget, report_budget
+from pixelmodels.sink import open_sink
+from pixelmodels.cache import cached_prediction
 from pixelmodels.common import (
     extract_features_full_ref,
+    early_stop_settings,
     get_repo_version,
+    load_models,
+    model_featurenames,
     predict_video_score,
+    predict_feature_table,
     MODEL_BASE_PATH
 )
 
@@ -64,16 +73,24 @@ def fume_features():
     }
 
 
-def fume_predict_video_score(dis_video, ref_video, temp_folder="./tmp", features_temp_folder="./tmp/features", model_path=FUME_MODEL_PATH, clipping=True):
-    features, full_report = extract_features_full_ref(
-        dis_video,
-        ref_video,
-        temp_folder=temp_folder,
-        features_temp_folder=features_temp_folder,
-        featurenames=fume_features(),
-        modelname="train_fume"
-    )
-    return predict_video_score(features, model_path)
+def fume_predict_video_score(dis_video, ref_video, temp_folder="./tmp", features_temp_folder="./tmp/features", model_path=FUME_MODEL_PATH, clipping=True, early_stop=None, cache_folder=None, planar=False, crop_first=False):
+    def predict():
+        features, full_report = extract_features_full_ref(
+            dis_video,
+            ref_video,
+            temp_folder=temp_folder,
+            features_temp_folder=features_temp_folder,
+            featurenames=model_featurenames(model_path, fume_features()),
+            modelname="train_fume",
+            early_stop=early_stop,
+            cache_folder=cache_folder,
+            planar=planar,
+            crop_first=crop_first
+        )
+        return predict_video_score(features, model_path)
+
+    # repeated predictions of the same video content and model are memoized
+    return cached_prediction(cache_folder, [dis_video, ref_video], model_path, {"clipping": clipping, "early_stop": early_stop, "planar": planar, "crop_first": crop_first}, predict)
 
 
 def main(_=[]):
@@ -86,6 +103,11 @@ def main(_=[]):
     parser.add_argument("--feature_folder", type=str, default="./features/fume", help="store features in a file, e.g. for training an own model")
     parser.add_argument("--temp_folder", type=str, default="./tmp/fume", help="temp folder for intermediate results")
     parser.add_argument("--model", type=str, default=FUME_MODEL_PATH, help="specified pre-trained model")
+    parser.add_argument("--cache_folder", type=str, default=None, help="content addressed cache of features and predictions, shared by all models (None disables the cache)")
+    parser.add_argument("--early_stop_tolerance", type=float, default=None, help="stop the frame processing when the running mean and standard deviation of all features change less than this relative tolerance (None processes all frames)")
+    parser.add_argument("--early_stop_min_coverage", type=float, default=0.3, help="minimal ratio of frames that are processed before an early stop")
+    parser.add_argument("--planar_frames", action="store_true", help="decode frames at native bit depth as planes, luma features use the luma plane (features are stored separately)")
+    parser.add_argument("--crop_first", action="store_true", help="crop the lines of the center crop before scaling the videos (faster for high resolutions, equal within the tolerance of pixelmodels_crop_benchmark, features are stored separately)")
 
     subparsers = parser.add_subparsers(
         help='sub commands',
@@ -114,6 +136,29 @@ def main(_=[]):
         help="output report of calculated values, None uses the video name as basis"
     )
 
+    predict_features = subparsers.add_parser(
+        'predict-features',
+        help='predict video quality of precomputed features, e.g. features.csv of a model folder or a feature folder',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    predict_features.add_argument(
+        "features",
+        type=str,
+        help="csv file with one pooled feature vector per row (e.g. features.csv) or feature folder with pooled json files"
+    )
+    predict_features.add_argument(
+        '--batch_size',
+        type=int,
+        default=10000,
+        help="rows that are predicted at once"
+    )
+    predict_features.add_argument(
+        '--output',
+        type=str,
+        default="predictions.csv",
+        help="write all predictions to one .jsonl, .csv or .parquet file"
+    )
+
     batch = subparsers.add_parser(
         'batch',
         help='perform batch prediction of a full database',
@@ -130,6 +175,34 @@ def main(_=[]):
         default=multiprocessing.cpu_count() // 2,
         help='thread/cpu count'
     )
+    batch.add_argument(
+        '--cpu_budget',
+        type=int,
+        default=None,
+        help="cpus used in total, split into cpu_count worker processes, their feature threads, ffmpeg and BLAS/OpenCV threads (None uses all cpus)"
+    )
+    batch.add_argument(
+        '--pin_cpus',
+        action='store_true',
+        help="pin each worker process and its ffmpeg processes to its own cpus"
+    )
+    batch.add_argument(
+        '--queue',
+        type=str,
+        default=None,
+        help="work queue database (e.g. on a shared file system), further hosts can join with pixelmodels_worker"
+    )
+    batch.add_argument(
+        '--no_ledger',
+        action='store_true',
+        help="do not use the job ledger (batch_ledger.sqlite in the output report folder), that stores the predictions of finished videos, so that a restarted batch only predicts the missing videos"
+    )
+    batch.add_argument(
+        '--output',
+        type=str,
+        default=None,
+        help="write all predictions to one .jsonl, .csv or .parquet file (appended as they complete), None writes one report per video into the output report folder"
+    )
     batch.add_argument(
         '--output_report_folder',
         type=str,
@@ -138,6 +211,7 @@ def main(_=[]):
     )
 
     a = vars(parser.parse_args())
+    early_stop = early_stop_settings(a["early_stop_tolerance"], a["early_stop_min_coverage"])
 
     if a["command"] == "predict":
         if a["output_report"] is None:
@@ -149,28 +223,56 @@ def main(_=[]):
             temp_folder=a["temp_folder"],
             features_temp_folder=a["feature_folder"],
             model_path=a["model"],
-            clipping=True
+            clipping=True,
+            early_stop=early_stop,
+            cache_folder=a["cache_folder"],
+            planar=a["planar_frames"],
+            crop_first=a["crop_first"]
         )
         jprint(prediction)
         jdump_file(a["output_report"], prediction)
 
+    if a["command"] == "predict-features":
+        lInfo("bulk prediction of precomputed features")
+        df, videos = read_feature_table(a["features"])
+        # all rows are predicted at once, no video is decoded
+        predictions = predict_feature_table(df, a["model"], clipping=True, batch_size=a["batch_size"])
+        src_videos = df["src_video"].tolist() if "src_video" in df.columns else [None] * len(df)
+        version = get_repo_version()
+        with open_sink(a["output"]) as sink:
+            for i, video in enumerate(videos):
+                result = {m: values[i] for m, values in predictions.items()}
+                result["model"] = a["model"]
+                result["version"] = version
+                sink.write(video, result, src_videos[i])
+
     if a["command"] == "batch":
         lInfo("batch prediction")
+        # one cpu budget for the worker processes, their feature threads, ffmpeg and BLAS/OpenCV threads
+        budget = cpu_budget(a["cpu_budget"], a["cpu_count"], a["pin_cpus"])
+        report_budget(budget, a["output_report_folder"])
+        # load the models once, before the worker processes are started, so that they share them
+        load_models(a["model"])
         videos = [[x["video"], x["src_video"]] for x in read_database(a["database"], full_ref=True)]
-        results = run_parallel(
-            items=videos,
-            function=fume_predict_video_score,
-            arguments=[a["temp_folder"], a["feature_folder"], a["model"], True],
-            num_cpus=a["cpu_count"],
-            multi_item=True
-        )
-        os.makedirs(a["output_report_folder"], exist_ok=True)
-        for i, result in enumerate(results):
-            dn = os.path.normpath(os.path.dirname(videos[i][0])).replace(os.sep, "_")
-            report_filename = dn + get_filename_without_extension(videos[i][0]) + ".json"
-            jdump_file(
-                os.path.join(a["output_report_folder"], report_filename),
-                result
+        with open_sink(a["output"], a["output_report_folder"]) as sink:
+            def write_report(i, result):
+                # reports are written as soon as a prediction is done
+                if result is None:
+                    lWarn(f"prediction of {videos[i][0]} failed, no report is written")
+                    return
+                sink.write(videos[i][0], result, videos[i][1])
+
+            run_batch(
+                items=videos,
+                function=fume_predict_video_score,
+                arguments=[a["temp_folder"], a["feature_folder"], a["model"], True, early_stop, a["cache_folder"], a["planar_frames"], a["crop_first"]],
+                num_cpus=budget["processes"],
+                multi_item=True,
+                queue_file=a["queue"],
+                ledger_file=None if a["no_ledger"] else os.path.join(a["output_report_folder"], "batch_ledger.sqlite"),
+                model_path=a["model"],
+                on_result=write_report,
+                budget=budget
             )
 
 
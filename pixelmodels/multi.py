@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# multi -- predict several video quality models with one feature extraction
+import argparse
+import sys
+import os
+import multiprocessing
+
+from quat.log import *
+from quat.utils.fileutils import *
+from quat.unsorted import *
+from quat.unsorted import jdump_file
+
+from pixelmodels.train_common import (
+    read_database
+)
+from pixelmodels.workqueue import run_batch
+from pixelmodels.budget import cpu_budget, report_budget
+from pixelmodels.sink import open_sink
+from pixelmodels.cache import cached_prediction
+from pixelmodels.common import (
+    early_stop_settings,
+    extract_features_multi,
+    get_repo_version,
+    load_models,
+    model_featurenames,
+    predict_video_score,
+    MODEL_BASE_PATH
+)
+from pixelmodels.nofu import nofu_features
+from pixelmodels.hyfu import hyfu_features
+from pixelmodels.fume import fume_features
+from pixelmodels.hyfr import hyfr_features
+
+# modelname: (default features, full-reference, hybrid)
+MODELS = {
+    "nofu": (nofu_features, False, False),
+    "hyfu": (hyfu_features, False, True),
+    "fume": (fume_features, True, False),
+    "hyfr": (hyfr_features, True, True),
+}
+
+
+def multi_predict_video_score(dis_video, ref_video=None, temp_folder="./tmp", features_temp_folder="./tmp/features", model_base_path=MODEL_BASE_PATH, models=None, clipping=True, early_stop=None, cache_folder=None, crop_first=False):
+    """
+    predicts the scores of all `models` (default: all models that can be used, i.e. full-reference models only in case of a ref_video)
+    for one video, all features are extracted once (union of the features of all models),
+    the models are stored in `model_base_path`/modelname
+    """
+    if models is None:
+        models = [m for m in MODELS if ref_video is not None or not MODELS[m][1]]
+    msg_assert(len(set(models) - set(MODELS)) == 0, f"unknown models {set(models) - set(MODELS)}")
+    msg_assert(ref_video is not None or not any(MODELS[m][1] for m in models), "full-reference models require a ref_video")
+
+    def predict():
+        model_paths = {m: os.path.join(model_base_path, m) for m in models}
+        featurenames = {m: set(model_featurenames(model_paths[m], MODELS[m][0]())) for m in models}
+        no_ref_features, full_ref_features = extract_features_multi(
+            dis_video,
+            ref_video,
+            no_ref_featurenames=set().union(*[featurenames[m] for m in models if not MODELS[m][1]]),
+            full_ref_featurenames=set().union(*[featurenames[m] for m in models if MODELS[m][1]]),
+            temp_folder=temp_folder,
+            features_temp_folder=features_temp_folder,
+            meta=any(MODELS[m][2] for m in models),
+            early_stop=early_stop,
+            cache_folder=cache_folder,
+            crop_first=crop_first
+        )
+        prediction = {}
+        for m in models:
+            features = full_ref_features if MODELS[m][1] else no_ref_features
+            prediction[m] = predict_video_score(features, model_paths[m], clipping)
+        return prediction
+
+    # repeated predictions of the same video content and model are memoized
+    return cached_prediction(cache_folder, [dis_video] if ref_video is None else [dis_video, ref_video], model_base_path, {"clipping": clipping, "models": models, "early_stop": early_stop, "crop_first": crop_first}, predict)
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='multi: predict several video quality models (nofu, hyfu, fume, hyfr) with one feature extraction',
+        epilog=f"stg7 2020 {get_repo_version()}",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--feature_folder", type=str, default="./features/multi", help="store features in a file, e.g. for training an own model")
+    parser.add_argument("--temp_folder", type=str, default="./tmp/multi", help="temp folder for intermediate results")
+    parser.add_argument("--model_base_path", type=str, default=MODEL_BASE_PATH, help="folder of the pre-trained models, each model is stored in a sub folder with its name")
+    parser.add_argument("--cache_folder", type=str, default=None, help="content addressed cache of features and predictions, shared by all models (None disables the cache)")
+    parser.add_argument("--models", type=str, nargs="+", default=None, choices=list(MODELS.keys()), help="models to predict, default: all models that can be used")
+    parser.add_argument("--early_stop_tolerance", type=float, default=None, help="stop the frame processing when the running mean and standard deviation of all features change less than this relative tolerance (None processes all frames)")
+    parser.add_argument("--early_stop_min_coverage", type=float, default=0.3, help="minimal ratio of frames that are processed before an early stop")
+    parser.add_argument("--crop_first", action="store_true", help="crop the lines of the center crop before scaling the videos (faster for high resolutions, equal within the tolerance of pixelmodels_crop_benchmark, features are stored separately)")
+
+    subparsers = parser.add_subparsers(
+        help='sub commands',
+        dest="command"
+    )
+
+    predict = subparsers.add_parser(
+        'predict',
+        help='predict video quality of single video',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    predict.add_argument(
+        'dis_video',
+        type=str,
+        help='video to predict video quality'
+    )
+    predict.add_argument(
+        '--ref_video',
+        type=str,
+        default=None,
+        help='source video, required for the full-reference models'
+    )
+    predict.add_argument(
+        '--output_report',
+        type=str,
+        default=None,
+        help="output report of calculated values, None uses the video name as basis"
+    )
+
+    batch = subparsers.add_parser(
+        'batch',
+        help='perform batch prediction of a full database',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    batch.add_argument(
+        'database',
+        type=str,
+        help='csv file of database, e.g. per_user.csv'
+    )
+    batch.add_argument(
+        '--full_ref',
+        action='store_true',
+        help='use the source videos of the database, required for the full-reference models'
+    )
+    batch.add_argument(
+        '--cpu_count',
+        type=int,
+        default=multiprocessing.cpu_count() // 2,
+        help='thread/cpu count'
+    )
+    batch.add_argument(
+        '--cpu_budget',
+        type=int,
+        default=None,
+        help="cpus used in total, split into cpu_count worker processes, their feature threads, ffmpeg and BLAS/OpenCV threads (None uses all cpus)"
+    )
+    batch.add_argument(
+        '--pin_cpus',
+        action='store_true',
+        help="pin each worker process and its ffmpeg processes to its own cpus"
+    )
+    batch.add_argument(
+        '--queue',
+        type=str,
+        default=None,
+        help="work queue database (e.g. on a shared file system), further hosts can join with pixelmodels_worker"
+    )
+    batch.add_argument(
+        '--no_ledger',
+        action='store_true',
+        help="do not use the job ledger (batch_ledger.sqlite in the output report folder), that stores the predictions of finished videos, so that a restarted batch only predicts the missing videos"
+    )
+    batch.add_argument(
+        '--output',
+        type=str,
+        default=None,
+        help="write all predictions to one .jsonl, .csv or .parquet file (appended as they complete), None writes one report per video into the output report folder"
+    )
+    batch.add_argument(
+        '--output_report_folder',
+        type=str,
+        default="reports/multi",
+        help="folder for output reports of calculated values, video name is used as basis"
+    )
+
+    a = vars(parser.parse_args())
+    early_stop = early_stop_settings(a["early_stop_tolerance"], a["early_stop_min_coverage"])
+
+    if a["command"] == "predict":
+        if a["output_report"] is None:
+            a["output_report"] = get_filename_without_extension(a["dis_video"]) + ".json"
+
+        prediction = multi_predict_video_score(
+            a["dis_video"],
+            a["ref_video"],
+            temp_folder=a["temp_folder"],
+            features_temp_folder=a["feature_folder"],
+            model_base_path=a["model_base_path"],
+            models=a["models"],
+            clipping=True,
+            early_stop=early_stop,
+            cache_folder=a["cache_folder"],
+            crop_first=a["crop_first"]
+        )
+        jprint(prediction)
+        jdump_file(a["output_report"], prediction)
+
+    if a["command"] == "batch":
+        lInfo("batch prediction")
+        # one cpu budget for the worker processes, their feature threads, ffmpeg and BLAS/OpenCV threads
+        budget = cpu_budget(a["cpu_budget"], a["cpu_count"], a["pin_cpus"])
+        report_budget(budget, a["output_report_folder"])
+        models = a["models"] if a["models"] is not None else [m for m in MODELS if a["full_ref"] or not MODELS[m][1]]
+        # load the models once, before the worker processes are started, so that they share them
+        for m in models:
+            load_models(os.path.join(a["model_base_path"], m))
+        videos = [
+            [x["video"], x["src_video"] if a["full_ref"] else None]
+            for x in read_database(a["database"], full_ref=a["full_ref"])
+        ]
+        with open_sink(a["output"], a["output_report_folder"]) as sink:
+            def write_report(i, result):
+                # reports are written as soon as a prediction is done
+                if result is None:
+                    lWarn(f"prediction of {videos[i][0]} failed, no report is written")
+                    return
+                sink.write(videos[i][0], result, videos[i][1])
+
+            run_batch(
+                items=videos,
+                function=multi_predict_video_score,
+                arguments=[a["temp_folder"], a["feature_folder"], a["model_base_path"], models, True, early_stop, a["cache_folder"], a["crop_first"]],
+                num_cpus=budget["processes"],
+                multi_item=True,
+                queue_file=a["queue"],
+                ledger_file=None if a["no_ledger"] else os.path.join(a["output_report_folder"], "batch_ledger.sqlite"),
+                model_path=a["model_base_path"],
+                on_result=write_report,
+                budget=budget
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# pooling -- vectorised temporal pooling of per-frame feature values
+import warnings
+
+import numpy as np
+import scipy.stats
+
+from quat.video import advanced_pooling
+
+# pooling statistics as named by `advanced_pooling` of quat
+QUANTILES = [round(q, 1) for q in np.arange(0, 1.01, 0.1)]
+PARTS = 3
+
+
+def _columns(name, values):
+    """
+    flattens the per-frame `values` of one feature to column names and a (frames x dims) float array,
+    None in case the values can not be represented as one array (e.g. changing dimensions or nested values)
+    """
+    if len(values) == 0:
+        return None
+    first = values[0]
+    if isinstance(first, dict):
+        keys = list(first.keys())
+        if any(not isinstance(v, dict) or list(v.keys()) != keys for v in values):
+            return None
+        rows = [[v[k] for k in keys] for v in values]
+        names = [f"{name}_{k}" for k in keys]
+    elif np.ndim(first) == 0:
+        rows = values
+        names = [name]
+    elif np.ndim(first) == 1:
+        rows = values
+        names = [f"{name}_{i}" for i in range(len(first))]
+    else:
+        return None
+    try:
+        matrix = np.asarray(rows, dtype=np.float64).reshape(len(values), -1)
+    except (TypeError, ValueError):
+        return None
+    if matrix.shape[1] != len(names):
+        return None
+    return names, matrix
+
+
+def pool_matrix(names, matrix):
+    """
+    calculates all pooling statistics for all columns of the (frames x dims) `matrix` at once:
+    mean, std, first_value, last_value, max, skew, kurtosis, iqr, the quantiles 0.0 .. 1.0 (`q`_quantil)
+    and mean and std of PARTS parts of the video (p`i`.mean, p`i`.std),
+    returns a dictionary with `names[i]`_statistic keys
+    """
+    with np.errstate(all="ignore"), warnings.catch_warnings():
+        # e.g. empty parts of videos with less than three frames
+        warnings.simplefilter("ignore", RuntimeWarning)
+        stats = {
+            "mean": matrix.mean(axis=0),
+            "std": matrix.std(axis=0),
+            "first_value": matrix[0],
+            "last_value": matrix[-1],
+            "max": matrix.max(axis=0),
+            "skew": scipy.stats.skew(matrix, axis=0),
+            "kurtosis": scipy.stats.kurtosis(matrix, axis=0),
+            "iqr": scipy.stats.iqr(matrix, axis=0),
+        }
+        quantiles = np.quantile(matrix, QUANTILES, axis=0)
+        for q, values in zip(QUANTILES, quantiles):
+            stats[f"{q}_quantil"] = values
+        for i, part in enumerate(np.array_split(matrix, PARTS)):
+            stats[f"p{i}.mean"] = part.mean(axis=0)
+            stats[f"p{i}.std"] = part.std(axis=0)
+
+    pooled = {}
+    for j, name in enumerate(names):
+        for s, values in stats.items():
+            pooled[f"{name}_{s}"] = float(values[j])
+    return pooled
+
+
+def pool_features(values_by_feature):
+    """
+    pools the per-frame values of all features (dictionary featurename: values) in one vectorised pass,
+    with one (frames x dims) array per number of frames, the feature names and values are the same as
+    of `advanced_pooling` of quat (stats=True, minimal=False): dict values are pooled per key (`name`_key),
+    vector values per dimension (`name`_i), features that can not be represented as array
+    are pooled with `advanced_pooling`
+    """
+    pooled = {}
+    groups = {}
+    for f, values in values_by_feature.items():
+        columns = _columns(f, values)
+        if columns is None:
+            pooled.update(advanced_pooling(values, name=f))
+            continue
+        groups.setdefault(len(values), []).append(columns)
+
+    for group in groups.values():
+        names = [n for columns in group for n in columns[0]]
+        matrix = np.concatenate([columns[1] for columns in group], axis=1)
+        pooled.update(pool_matrix(names, matrix))
+    return pooled
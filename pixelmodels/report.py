@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# report -- evaluation metrics and plots of trained models, based on the stored crossval files
+import argparse
+import json
+import os
+import sys
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+import scipy.stats
+from sklearn.metrics import (
+    accuracy_score,
+    f1_score,
+    matthews_corrcoef,
+    precision_score,
+    recall_score
+)
+
+from quat.log import *
+from quat.utils.assertions import *
+
+# crossval files of `train_rf_models`: model type, plot folder and target name
+CROSSVAL_FILES = {
+    "crossval_regression.csv": ("regression", "_reggression", "mos"),
+    "crossval_class.csv": ("class", "_class", "mos_class"),
+    "crossval_rating_dist.csv": ("dist", "_rating_dist", "rating_dist"),
+}
+
+
+def _pearson(a, b):
+    a = a - a.mean(axis=0)
+    b = b - b.mean(axis=0)
+    return (a * b).sum(axis=0) / np.sqrt((a ** 2).sum(axis=0) * (b ** 2).sum(axis=0))
+
+
+def regression_metrics(truth, predicted):
+    """
+    regression metrics (the same as calculated by `eval_plots_regression` of quat) of all columns
+    of the (n_videos x n_columns) arrays `truth` and `predicted` at once, returns one dictionary per column
+    """
+    truth = np.asarray(truth, dtype=np.float64).reshape(len(truth), -1)
+    predicted = np.asarray(predicted, dtype=np.float64).reshape(len(predicted), -1)
+    error = predicted - truth
+    with np.errstate(all="ignore"):
+        pooled_std = np.sqrt((truth.var(axis=0, ddof=1) + predicted.var(axis=0, ddof=1)) / 2)
+        metrics = {
+            "cohen_d": (truth.mean(axis=0) - predicted.mean(axis=0)) / pooled_std,
+            "kendall": np.array([scipy.stats.kendalltau(truth[:, i], predicted[:, i])[0] for i in range(truth.shape[1])]),
+            "mean_absolute_error": np.abs(error).mean(axis=0),
+            "median_absolute_error": np.median(np.abs(error), axis=0),
+            "pearson": _pearson(truth, predicted),
+            "r2": 1 - (error ** 2).sum(axis=0) / ((truth - truth.mean(axis=0)) ** 2).sum(axis=0),
+            "rmse": np.sqrt((error ** 2).mean(axis=0)),
+            "spearman": _pearson(scipy.stats.rankdata(truth, axis=0), scipy.stats.rankdata(predicted, axis=0)),
+        }
+    return [{k: float(v[i]) for k, v in metrics.items()} for i in range(truth.shape[1])]
+
+
+def class_metrics(truth, predicted):
+    """
+    classification metrics (the same as calculated by `eval_plots_class` of quat)
+    """
+    truth = np.asarray(truth)
+    predicted = np.asarray(predicted)
+    return {
+        "accuracy": float(accuracy_score(truth, predicted)),
+        "f1": float(f1_score(truth, predicted, average="weighted")),
+        "mcc": float(matthews_corrcoef(truth, predicted)),
+        "precision": float(precision_score(truth, predicted, average="weighted", zero_division=0)),
+        "recall": float(recall_score(truth, predicted, average="weighted", zero_division=0)),
+        "rmse": float(np.sqrt(np.mean((truth.astype(np.float64) - predicted.astype(np.float64)) ** 2))),
+    }
+
+
+def dist_parts(cval):
+    """
+    rating levels of a rating distribution crossval DataFrame (columns truth_N and predicted_N)
+    """
+    return [c.replace("truth_", "", 1) for c in cval.columns if c.startswith("truth_")]
+
+
+def cval_metrics(kind, cval):
+    """
+    metrics of one crossval DataFrame, with the keys as stored in info.json by `train_rf_models`
+    """
+    if kind == "class":
+        return {"class_performance": class_metrics(cval["truth"], cval["predicted"])}
+    if kind == "dist":
+        parts = dist_parts(cval)
+        metrics = regression_metrics(
+            cval[[f"truth_{p}" for p in parts]].values,
+            cval[[f"predicted_{p}" for p in parts]].values
+        )
+        return {"regression_performance_dist_" + p: m for p, m in zip(parts, metrics)}
+    return {"regression_performance": regression_metrics(cval["truth"], cval["predicted"])[0]}
+
+
+def crossval_metrics(modelfolder):
+    """
+    metrics of all crossval files of `modelfolder`
+    """
+    metrics = {}
+    for filename, (kind, _, _) in CROSSVAL_FILES.items():
+        if os.path.isfile(os.path.join(modelfolder, filename)):
+            metrics.update(cval_metrics(kind, pd.read_csv(os.path.join(modelfolder, filename))))
+    return metrics
+
+
+def _plot(job):
+    """
+    renders the evaluation plots of one crossval column pair
+    """
+    # matplotlib is only loaded by the report stage
+    from quat.ml.mlcore import eval_plots_class, eval_plots_regression
+
+    kind, truth, predicted, title, folder, plotname = job
+    if kind == "class":
+        eval_plots_class(truth, predicted, title=title, folder=folder)
+    else:
+        eval_plots_regression(truth, predicted, title=title, folder=folder, plotname=plotname)
+    return folder
+
+
+def write_eval_plots(modelfolder, cpu_count=1):
+    """
+    renders the evaluation plots (pdf and png) of all crossval files of `modelfolder` in a process pool
+    of `cpu_count` workers, with the same folders and names as `train_rf_models` used before
+    """
+    info_filename = os.path.join(modelfolder, "info.json")
+    num_trees = json.load(open(info_filename)).get("num_trees") if os.path.isfile(info_filename) else None
+    jobs = []
+    for filename, (kind, folder, target) in CROSSVAL_FILES.items():
+        if not os.path.isfile(os.path.join(modelfolder, filename)):
+            continue
+        cval = pd.read_csv(os.path.join(modelfolder, filename))
+        folder = os.path.join(modelfolder, folder) + "/"
+        if kind == "class":
+            jobs.append((kind, cval["truth"], cval["predicted"], target, folder, None))
+        if kind == "dist":
+            for part in dist_parts(cval):
+                jobs.append((kind, cval[f"truth_{part}"], cval[f"predicted_{part}"], f"{target}_{part}", folder, f"rf_mi_@{num_trees}_dist_{part}"))
+        if kind == "regression":
+            jobs.append((kind, cval["truth"], cval["predicted"], target, folder, f"rf_@{num_trees}"))
+    msg_assert(len(jobs) > 0, f"no crossval files in {modelfolder}")
+
+    lInfo(f"render {len(jobs)} evaluation plots of {modelfolder} using {min(cpu_count, len(jobs))} processes")
+    if cpu_count > 1 and len(jobs) > 1:
+        with mp.Pool(processes=min(cpu_count, len(jobs))) as pool:
+            pool.map(_plot, jobs)
+    else:
+        list(map(_plot, jobs))
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='evaluation metrics and plots of trained models, based on their crossval files',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("model_folder", type=str, nargs="+", help="model folders, e.g. pixelmodels/models/nofu")
+    parser.add_argument("--cpu_count", type=int, default=mp.cpu_count() // 2, help="processes for rendering the plots")
+    parser.add_argument("--no_plots", action="store_true", help="only print the metrics")
+
+    a = vars(parser.parse_args())
+    for model_folder in a["model_folder"]:
+        print(json.dumps({model_folder: crossval_metrics(model_folder)}, indent=4, sort_keys=True))
+        if not a["no_plots"]:
+            write_eval_plots(model_folder, a["cpu_count"])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
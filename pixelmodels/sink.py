@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# sink -- output of batch predictions as they complete
+import abc
+import csv
+import json
+import os
+
+from quat.log import *
+from quat.utils.assertions import *
+from quat.unsorted import jdump_file
+from quat.utils.fileutils import get_filename_without_extension
+
+
+def _record(video, result, src_video=None):
+    """
+    one output record of a prediction, nested values (e.g. rating distributions) are kept
+    """
+    record = {"video": video}
+    if src_video is not None:
+        record["src_video"] = src_video
+    record.update(result)
+    return record
+
+
+def _flat_record(record):
+    """
+    record with scalar values only, nested values are stored as json strings
+    """
+    return {
+        k: json.dumps(v) if isinstance(v, (list, dict)) else v
+        for k, v in record.items()
+    }
+
+
+class Sink(abc.ABC):
+    """
+    base class of all output sinks, `write` is called for each finished prediction
+    """
+    @abc.abstractmethod
+    def write(self, video, result, src_video=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class ReportFolderSink(Sink):
+    """
+    writes one json report per video into a folder, the name is based on the directory and the video name
+    """
+    def __init__(self, folder):
+        self._folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def write(self, video, result, src_video=None):
+        dn = os.path.normpath(os.path.dirname(video)).replace(os.sep, "_")
+        report_filename = dn + get_filename_without_extension(video) + ".json"
+        jdump_file(os.path.join(self._folder, report_filename), result)
+
+
+class JsonlSink(Sink):
+    """
+    appends one json line per prediction to a file, each line is flushed, so that the file can be consumed
+    while the batch is running
+    """
+    def __init__(self, filename):
+        self._fp = open(filename, "w")
+
+    def write(self, video, result, src_video=None):
+        self._fp.write(json.dumps(_record(video, result, src_video)) + "\n")
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class CsvSink(Sink):
+    """
+    appends one row per prediction to a csv file, the columns are defined by the first prediction,
+    a prediction with further keys (e.g. only some videos are predicted in windows) extends the columns,
+    then the written rows are rewritten once with the extended header (empty values for the new columns),
+    nested values (e.g. rating distributions) are stored as json strings
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._fp = open(filename, "w", newline="")
+        self._fieldnames = None
+        self._writer = None
+
+    def _extend(self, keys):
+        self._fp.close()
+        with open(self._filename, newline="") as fp:
+            rows = list(csv.DictReader(fp))
+        self._fieldnames = self._fieldnames + keys
+        lInfo(f"csv columns {keys} added to {self._filename}")
+        self._fp = open(self._filename, "w", newline="")
+        self._writer = csv.DictWriter(self._fp, fieldnames=self._fieldnames)
+        self._writer.writeheader()
+        self._writer.writerows(rows)
+
+    def write(self, video, result, src_video=None):
+        record = _flat_record(_record(video, result, src_video))
+        if self._writer is None:
+            self._fieldnames = list(record.keys())
+            self._writer = csv.DictWriter(self._fp, fieldnames=self._fieldnames)
+            self._writer.writeheader()
+        new_keys = [k for k in record if k not in self._fieldnames]
+        if len(new_keys) > 0:
+            self._extend(new_keys)
+        self._writer.writerow(record)
+        self._fp.flush()
+
+    def close(self):
+        self._fp.close()
+
+
+class ParquetSink(Sink):
+    """
+    writes the predictions to a parquet file in row groups of `row_group_size` predictions (requires pyarrow),
+    the schema is defined by the first row group, nested values are stored as json strings
+    """
+    def __init__(self, filename, row_group_size=100):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            msg_assert(False, "parquet output requires pyarrow, e.g. install it with pip install pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._filename = filename
+        self._row_group_size = row_group_size
+        self._records = []
+        self._writer = None
+
+    def _flush(self):
+        if len(self._records) == 0:
+            return
+        if self._writer is None:
+            table = self._pa.Table.from_pylist(self._records)
+            self._writer = self._pq.ParquetWriter(self._filename, table.schema)
+        else:
+            dropped = set(k for r in self._records for k in r) - set(self._writer.schema.names)
+            if len(dropped) > 0:
+                # the schema of a parquet file can not be extended
+                lWarn(f"values {sorted(dropped)} are not part of the schema of {self._filename} and are not stored")
+            table = self._pa.Table.from_pylist(self._records, schema=self._writer.schema)
+        self._writer.write_table(table)
+        self._records = []
+
+    def write(self, video, result, src_video=None):
+        self._records.append(_flat_record(_record(video, result, src_video)))
+        if len(self._records) >= self._row_group_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def open_sink(output=None, report_folder="reports"):
+    """
+    returns the output sink for batch predictions, based on the extension of `output` (.jsonl, .csv or .parquet),
+    in case `output` is None one json report per video is stored in `report_folder`
+    """
+    if output is None:
+        return ReportFolderSink(report_folder)
+    folder = os.path.dirname(output)
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+    extension = os.path.splitext(output)[1].lower()
+    sinks = {
+        ".jsonl": JsonlSink,
+        ".csv": CsvSink,
+        ".parquet": ParquetSink,
+    }
+    msg_assert(extension in sinks, f"output format {extension} is not supported, use one of {list(sinks.keys())}")
+    lInfo(f"write predictions to {output}")
+    return sinks[extension](output)
@@ -1,7 +1,25 @@
 #!/usr/bin/env python3
+import copy
 import datetime
+import hashlib
+import itertools
+import json
+import random
+import time
+import multiprocessing as mp
 
+import numpy as np
 import pandas as pd
+from sklearn.base import clone
+from sklearn.ensemble import (
+    ExtraTreesClassifier,
+    ExtraTreesRegressor,
+    RandomForestClassifier,
+    RandomForestRegressor
+)
+from sklearn.feature_selection import SelectFromModel
+from sklearn.model_selection import KFold
+from sklearn.pipeline import Pipeline
 
 from quat.log import *
 from quat.utils.assertions import *
@@ -9,12 +27,9 @@ from quat.utils.fileutils import *
 from quat.utils.system import lglob
 from quat.unsorted import jdump_file
 from quat.ml.mlcore import (
-    train_rf_class,
     train_rf_regression,
-    train_rf_multi_regression,
-    eval_plots_class,
-    eval_plots_regression,
-    save_serialized
+    save_serialized,
+    load_serialized
 )
 
 from pixelmodels.common import (
@@ -22,21 +37,40 @@ from pixelmodels.common import (
     extract_features_full_ref,
     get_repo_version
 )
+from pixelmodels.report import (
+    class_metrics,
+    regression_metrics,
+    cval_metrics,
+    write_eval_plots
+)
+from pixelmodels.forest import (
+    flatten_model,
+    forest_predict,
+    export_forest
+)
 
 
+# number of trees of the extra trees forest used for importance based feature selection
+SELECTION_NUM_TREES = 10
 
-def calc_and_store_features(video_and_rating, feature_folder, temp_folder, features=None, modelname="nofu", meta=False):
+
+def calc_and_store_features(video_and_rating, feature_folder, temp_folder, features=None, modelname="nofu", meta=False, cache_folder=None, planar=False, crop_first=False):
     """
     calcualtes and stores features of the given video, in case features are already stored, reuse the stored ones
 
     video_and_rating is a dictionary containing:
         video_and_rating["video"]: video_filename_path
         video_and_rating["mos"]: mos score
-        video_and_rating["rating_dist"]: rating_dist values
+        video_and_rating["rating_dist"]: rating_dist values (counts per rating level)
+        video_and_rating["rating_levels"]: rating levels of the rating_dist values (optional)
         video_and_rating["mos_class"]: classification score
 
         in case of a full-reference video quality model:
         video_and_rating["src_video"]: source video
+
+    in case of a `cache_folder` the content addressed feature cache is used (see `pixelmodels.cache`)
+    if `planar` is true, the frames are decoded at native bit depth as planes (see `pixelmodels.frames`)
+    if `crop_first` is true, only the source lines of the center crop are scaled (see `pixelmodels.convert`)
     """
     msg_assert(features is not None, "features need to be defined", "features ok")
     json_assert(video_and_rating, ["video", "mos", "rating_dist", "mos_class"])
@@ -64,7 +98,10 @@ def calc_and_store_features(video_and_rating, feature_folder, temp_folder, featu
             feature_folder,
             features,
             modelname,
-            meta
+            meta,
+            cache_folder=cache_folder,
+            planar=planar,
+            crop_first=crop_first
         )
     else:
         pooled_features, full_features = extract_features_no_ref(
@@ -73,7 +110,10 @@ def calc_and_store_features(video_and_rating, feature_folder, temp_folder, featu
             feature_folder,
             features,
             modelname,
-            meta
+            meta,
+            cache_folder=cache_folder,
+            planar=planar,
+            crop_first=crop_first
         )
 
     if pooled_features is None or full_features is None:
@@ -85,6 +125,8 @@ def calc_and_store_features(video_and_rating, feature_folder, temp_folder, featu
 
     pooled_features["mos"] = video_and_rating["mos"]
     pooled_features["rating_dist"] = video_and_rating["rating_dist"]
+    if "rating_levels" in video_and_rating:
+        pooled_features["rating_levels"] = video_and_rating["rating_levels"]
     pooled_features["mos_class"] = video_and_rating["mos_class"]
 
     jdump_file(full_features_filename, full_features)
@@ -103,7 +145,8 @@ def read_database(database, full_ref=False):
         video
         mos
         mos_class
-        rating_dist
+        rating_dist: counts of the individual ratings per rating level
+        rating_levels: rating levels of rating_dist
         src_video: optional
     """
     df = pd.read_csv(database)
@@ -115,24 +158,27 @@ def read_database(database, full_ref=False):
     user_cols = [x for x in df.columns if "user" in x]
     if len(user_cols) == 0:
         lWarn("rating distribution cannot be used for training, they are not part of the given database file")
+    # dense (n_videos x n_levels) matrix of rating counts
+    ratings = df[user_cols].to_numpy(dtype=np.float64)
+    rating_levels = np.unique(ratings[~np.isnan(ratings)])
+    rating_counts = rating_dist_counts(ratings, rating_levels)
+    rating_levels = unify_rating_levels(rating_levels)
 
     videos = []
     dirname_database = os.path.dirname(database)
-    for _, i in df.iterrows():
+    for row, (_, i) in enumerate(df.iterrows()):
         video_filename_path = os.path.join(
             dirname_database,
             "segments",
             i["video_name"]
         )
-        rating_dist = {}
-        for ucol in user_cols:
-            rating_dist[i[ucol]] = rating_dist.get(i[ucol], 0) + 1
         assert_file(video_filename_path, True)
         video = {
             "video": video_filename_path,
             "mos": i[mos_col],  # will be handled as regression
             "mos_class": int(round(i[mos_col], 0)),  # will be handled as classicication
-            "rating_dist": rating_dist,  # will be handled as multi instance regression
+            "rating_dist": rating_counts[row].tolist(),  # will be handled as multi instance regression
+            "rating_levels": rating_levels,
         }
         if full_ref:
             src_video_pattern = dirname_database + f"/../src_videos/*"
@@ -165,53 +211,296 @@ def load_features(feature_folder):
     return features
 
 
-def convert_dist(y_values):
+# version of the stored feature matrix format, a change forces a rebuild
+FEATURE_MATRIX_VERSION = 1
+
+
+def _feature_file_signature(features_filename, hash_check=False):
+    """
+    signature of a pooled feature file used for change detection,
+    either based on modification time and size or on a sha1 hash of the content
+    """
+    stat = os.stat(features_filename)
+    if not hash_check:
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    with open(features_filename, "rb") as feature_file:
+        sha1 = hashlib.sha1(feature_file.read()).hexdigest()
+    return {"size": stat.st_size, "sha1": sha1}
+
+
+def load_feature_matrix(feature_folder, hash_check=False):
+    """
+    loads feature values from a folder as DataFrame (one row per pooled json file, indexed by filename),
+    the matrix is persisted in the feature folder (`feature_matrix.pkl` and `feature_matrix.idx`),
+    thus only new or changed json files are parsed, and rows of removed files are dropped.
+    changes are detected by modification time and size, or in case of `hash_check` by a sha1 hash.
+    Important: there is no filtering, all json files of this folder will be used
+    """
+    assert_dir(feature_folder, True)
+    matrix_filename = os.path.join(feature_folder, "feature_matrix.pkl")
+    index_filename = os.path.join(feature_folder, "feature_matrix.idx")
+
+    index = {"version": FEATURE_MATRIX_VERSION, "revision": 0, "hash_check": hash_check, "files": {}}
+    df = pd.DataFrame()
+    if os.path.isfile(matrix_filename) and os.path.isfile(index_filename):
+        with open(index_filename) as index_file:
+            stored_index = json.load(index_file)
+        if stored_index.get("version") == FEATURE_MATRIX_VERSION and stored_index.get("hash_check") == hash_check:
+            index = stored_index
+            df = pd.read_pickle(matrix_filename)
+        else:
+            lInfo("stored feature matrix is outdated, it will be rebuild")
+
+    current_files = {
+        os.path.basename(features_filename): _feature_file_signature(features_filename, hash_check)
+        for features_filename in lglob(feature_folder + "/*.json")
+    }
+    changed = sorted([x for x in current_files if index["files"].get(x) != current_files[x]])
+    removed = sorted([x for x in index["files"] if x not in current_files])
+    lInfo(f"feature matrix revision {index['revision']}: {len(changed)} new or changed, {len(removed)} removed feature files")
+    if len(changed) == 0 and len(removed) == 0:
+        return df
+
+    df = df.drop(index=[x for x in changed + removed if x in df.index])
+    new_features = []
+    for features_filename in changed:
+        with open(os.path.join(feature_folder, features_filename)) as feature_file:
+            new_features.append(json.load(feature_file))
+    if len(new_features) > 0:
+        df = pd.concat([df, pd.DataFrame(new_features, index=changed)])
+    df = df.sort_index()
+
+    index["files"] = current_files
+    index["revision"] += 1
+    index["date"] = str(datetime.datetime.now())
+    df.to_pickle(matrix_filename)
+    jdump_file(index_filename, index)
+    return df
+
+
+def read_feature_table(features, hash_check=False):
+    """
+    reads pooled features for bulk predictions, either a csv file (e.g. `features.csv` of a model folder)
+    or a feature folder of pooled json files (using the persisted feature matrix, see `load_feature_matrix`),
+    returns the DataFrame and the identifiers of the rows (video column, json filename or csv row number)
+    """
+    if os.path.isdir(features):
+        df = load_feature_matrix(features, hash_check=hash_check)
+        ids = df["video"].tolist() if "video" in df.columns else [str(x) for x in df.index]
+    else:
+        df = pd.read_csv(features)
+        ids = df["video"].tolist() if "video" in df.columns else [f"{features}:{i}" for i in range(len(df))]
+    lInfo(f"read {len(df)} feature vectors from {features}")
+    return df, ids
+
+
+def rating_dist_counts(ratings, rating_levels):
+    """
+    counts for each row of the (n_videos x n_users) `ratings` matrix how often each of the `rating_levels` occurs,
+    missing ratings (nan) are ignored, returns a (n_videos x n_levels) matrix
+    """
+    counts = np.zeros((ratings.shape[0], len(rating_levels)), dtype=np.int64)
+    for j, level in enumerate(rating_levels):
+        counts[:, j] = (ratings == level).sum(axis=1)
+    return counts
+
+
+def unify_rating_levels(rating_levels):
     """
-    convert and unify distribution values of individual ratings
+    converts rating levels to a plain list, integer valued levels are stored as int
     """
-    def unify_dist(y, range_values):
-        sum_ = sum([y[x] for x in y])
-        for x in range_values:
-            y[x] = y.get(x, 0) / sum_
-        return y
-    range_values = set(sum([list(y.keys()) for y in y_values], []))
-    values = [unify_dist(y, range_values) for y in y_values]
-    return pd.DataFrame(values)
+    return [int(x) if float(x).is_integer() else float(x) for x in rating_levels]
+
 
+def convert_dist(y_values, rating_levels=None):
+    """
+    convert and unify distribution values of individual ratings,
+    to a dense (n_videos x n_levels) DataFrame of relative frequencies,
+    columns are the sorted union of all used rating levels
 
-def histogram_based_dataset_balancing(df):
+    y_values are per video rating counts, either lists with the corresponding `rating_levels`
+    (one list of levels per video), or dictionaries (rating level: count) as stored by older versions
+    """
+    y_values = list(y_values)
+    rating_levels = [None] * len(y_values) if rating_levels is None else list(rating_levels)
+
+    rows, levels, counts = [], [], []
+    for row, (y, l) in enumerate(zip(y_values, rating_levels)):
+        if isinstance(y, dict):
+            l = list(y.keys())
+            y = list(y.values())
+        if not isinstance(y, (list, tuple, np.ndarray)) or len(y) == 0:
+            continue
+        rows.append(np.full(len(y), row))
+        levels.append(np.asarray(l, dtype=np.float64))
+        counts.append(np.asarray(y, dtype=np.float64))
+    if len(rows) == 0:
+        return pd.DataFrame(index=range(len(y_values)))
+
+    rows = np.concatenate(rows)
+    levels = np.concatenate(levels)
+    counts = np.concatenate(counts)
+    valid = ~np.isnan(levels)
+    unique_levels, cols = np.unique(levels[valid], return_inverse=True)
+
+    dist = np.zeros((len(y_values), len(unique_levels)), dtype=np.float64)
+    np.add.at(dist, (rows[valid], cols), counts[valid])
+    sums = dist.sum(axis=1, keepdims=True)
+    dist = dist / np.where(sums == 0, 1, sums)
+    return pd.DataFrame(dist, columns=unify_rating_levels(unique_levels))
+
+
+def histogram_based_dataset_balancing(df, mode="replicate", target="mos"):
     """
     use rounded mos values to balance dataset,
     used for testing of different dataset variations during model development
+
+    rows of a rounded target group that is smaller than the mean of the smallest and largest group size
+    are repeated, depending on `mode` the result is:
+        replicate: balanced DataFrame (repeated groups are appended)
+        indices: row positions of `df` that build the balanced dataset
+        weights: per-row sample weights (number of repetitions of each row)
     """
+    msg_assert(mode in ["replicate", "indices", "weights"], f"balancing mode {mode} is not supported")
     lInfo("balance dataset")
-    def plot_hist(x):
-        hist = {}
-        for i in x:
-            hist[i] = hist.get(i, 0) + 1
-        print({x: hist[x] for x in sorted(hist.keys())})
+    round_target = df[target].round(0).to_numpy()
+    groups, group_ids, group_sizes = np.unique(round_target, return_inverse=True, return_counts=True)
+    lInfo(f"before {dict(zip(groups.tolist(), group_sizes.tolist()))}")
 
     # balance dataset a bit:
-    max_grp_size = 0
-    min_grp_size = len(df)
-
-    df["round_target"] = df["mos"].round(0)
-    lInfo("before")
-    plot_hist(df["round_target"])
-    for i, g in df.groupby(by="round_target"):
-        max_grp_size = max(len(g), max_grp_size)
-        min_grp_size = min(len(g), min_grp_size)
-    min_size = (max_grp_size + min_grp_size) // 2
-
-    new_df = pd.DataFrame()
-    for i, g in df.groupby(by="round_target"):
-        new_df = new_df.append(g, ignore_index=True)
-        if len(g) < min_size:
-            for _ in range(max(min_size // len(g), 1)):
-                new_df = new_df.append(g, ignore_index=True)
-    lInfo("after")
-    plot_hist(new_df["round_target"])
-    return new_df
+    min_size = (group_sizes.max() + group_sizes.min()) // 2
+    repetitions = 1 + np.where(group_sizes < min_size, np.maximum(min_size // group_sizes, 1), 0)
+    lInfo(f"after {dict(zip(groups.tolist(), (group_sizes * repetitions).tolist()))}")
+
+    if mode == "weights":
+        return repetitions[group_ids].astype(np.float64)
+
+    # each group is repeated as a block, groups are ordered by rounded target value
+    order = np.argsort(group_ids, kind="stable")
+    group_rows = np.split(order, np.cumsum(group_sizes)[:-1])
+    indices = np.concatenate([np.tile(rows, r) for rows, r in zip(group_rows, repetitions)])
+    if mode == "indices":
+        return indices
+    return df.iloc[indices].reset_index(drop=True)
+
+
+def rf_pipeline(kind, num_trees=60, threshold="0.0001*mean", forest_params=None, n_jobs=-1):
+    """
+    random forest pipeline (feature selection followed by the forest) as trained by
+    `train_rf_regression`, `train_rf_class` and `train_rf_multi_regression`,
+    `forest_params` are further parameters of the forest (e.g. max_depth, max_features)
+
+    kind is one of regression, class or multi_regression,
+    returns the pipeline and the name of the forest step
+    """
+    msg_assert(kind in ["regression", "class", "multi_regression"], f"model kind {kind} is not supported")
+    forest_params = forest_params if forest_params is not None else {}
+    if kind == "class":
+        step = "classifier"
+        selection = ExtraTreesClassifier(n_estimators=SELECTION_NUM_TREES, n_jobs=n_jobs)
+        forest = RandomForestClassifier(n_estimators=num_trees, criterion="entropy", n_jobs=n_jobs, **forest_params)
+    else:
+        step = "regressor"
+        selection = ExtraTreesRegressor(n_estimators=SELECTION_NUM_TREES, n_jobs=n_jobs)
+        forest = RandomForestRegressor(n_estimators=num_trees, n_jobs=n_jobs, **forest_params)
+    pipeline = Pipeline([
+        ("feature_selection", SelectFromModel(selection, threshold=threshold)),
+        (step, forest)
+    ])
+    return pipeline, step
+
+
+def train_rf_weighted(X, Y, kind, sample_weight, num_trees=60, threshold="0.0001*mean", folds=10, forest_params=None, n_jobs=-1, seed=42):
+    """
+    train a random forest pipeline (see `rf_pipeline`) similar to
+    `train_rf_regression`, `train_rf_class` and `train_rf_multi_regression`, however using per-sample weights,
+    e.g. from `histogram_based_dataset_balancing(df, mode="weights")` (None: all samples have the same weight),
+    and further `forest_params`,
+    the cross validation uses shuffled folds (`seed`), because the rows are ordered by database
+
+    kind is one of regression, class or multi_regression,
+    returns a dictionary with randomforest, crossval, number_features and used_features
+    """
+    pipeline, step = rf_pipeline(kind, num_trees, threshold, forest_params, n_jobs)
+
+    def fit(model, rows):
+        if sample_weight is None:
+            return model.fit(X.iloc[rows], Y.iloc[rows])
+        weights = np.asarray(sample_weight, dtype=np.float64)[rows]
+        return model.fit(
+            X.iloc[rows],
+            Y.iloc[rows],
+            feature_selection__sample_weight=weights,
+            **{f"{step}__sample_weight": weights}
+        )
+
+    predicted = np.zeros(Y.shape, dtype=np.float64)
+    for train, test in KFold(n_splits=folds, shuffle=True, random_state=seed).split(X):
+        predicted[test] = fit(clone(pipeline), train).predict(X.iloc[test])
+    fit(pipeline, np.arange(len(X)))
+    if kind == "class":
+        # class labels keep their type, e.g. integer classes in crossval_class.csv
+        predicted = predicted.astype(Y.dtype)
+
+    if kind == "multi_regression":
+        crossval = pd.concat([
+            pd.DataFrame(Y.values, columns=[f"truth_{c}" for c in Y.columns]),
+            pd.DataFrame(predicted, columns=[f"predicted_{c}" for c in Y.columns])
+        ], axis=1)
+    else:
+        crossval = pd.DataFrame({"predicted": predicted, "truth": Y.values})
+    return {
+        "randomforest": pipeline,
+        "crossval": crossval,
+        "number_features": X.shape[1],
+        "used_features": float(pipeline.named_steps["feature_selection"].get_support().sum())
+    }
+
+
+# training data shared with the worker processes of `train_rf_models`,
+# it is handed over once per worker by `_init_train_worker` (inherited on fork),
+# thus the feature matrix is not pickled for each training task
+_TRAIN_DATA = {}
+
+
+def _init_train_worker(X, targets, sample_weight=None, n_jobs=-1):
+    """
+    initialize a training worker with the shared feature matrix `X` and the target columns,
+    optionally with balancing per-sample weights
+    """
+    _TRAIN_DATA["X"] = X
+    _TRAIN_DATA["targets"] = targets
+    _TRAIN_DATA["sample_weight"] = sample_weight
+    _TRAIN_DATA["n_jobs"] = n_jobs
+
+
+def _train_target(task):
+    """
+    train one random forest for a given task (target model, repetition, seed, num_trees, threshold, forest_params),
+    the used data is taken from the shared training data
+    """
+    model, repetition, seed, num_trees, threshold, forest_params = task
+    # sklearn uses the global numpy random state if no random_state is set,
+    # so seeding here makes each repetition deterministic
+    random.seed(seed)
+    np.random.seed(seed)
+
+    X = _TRAIN_DATA["X"]
+    Y = _TRAIN_DATA["targets"][model]  # target column is the model name
+
+    kind = "regression"  # default case: regression
+    if "_class" in model:
+        kind = "class"
+    if "_dist" in model:
+        kind = "multi_regression"
+    lInfo(f"train {model} as {kind}, repetition #{repetition}")
+
+    # all tasks are trained the same way, independent of the number of workers (only n_jobs differs),
+    # thus the crossval results of a seed do not depend on `cpu_count`
+    return model, repetition, train_rf_weighted(
+        X, Y, kind, _TRAIN_DATA["sample_weight"], num_trees, threshold,
+        forest_params=forest_params, n_jobs=_TRAIN_DATA["n_jobs"], seed=seed
+    )
 
 
 def train_rf_models(features,
@@ -219,13 +508,37 @@ def train_rf_models(features,
         num_trees=60,
         threshold="0.0001*mean",
         target_cols=["mos", "rating_dist", "mos_class"],
-        exclude_cols=["video", "src_video"] + ["mos", "rating_dist", "mos_class"],
+        exclude_cols=["video", "src_video", "rating_levels"] + ["mos", "rating_dist", "mos_class"],
         modelfolder="models",
-        train_repetitions=1):
+        train_repetitions=1,
+        cpu_count=1,
+        seed=42,
+        balancing=None,
+        featurenames=None,
+        info=None,
+        forest_params=None,
+        plots=True):
     """
     train several random forest models (for each traget column one model,
     depending on the given input values) to predict video quality
+
+    all target models and repetitions are trained in a process pool of `cpu_count` workers,
+    repetition r uses the seed `seed + r` (also for the shuffled cross validation folds of `train_rf_weighted`),
+    thus the results do not depend on `cpu_count`, evaluation and storing of the models is
+    performed afterwards in the order of repetitions and targets,
+    finally the stored models are exported as flattened forests for fast inference (see `pixelmodels.forest`)
+
+    in case of `balancing` (replicate or weights) `histogram_based_dataset_balancing` is applied as per-sample weights
+    of the forests, replicate uses the number of repetitions of each row as integer weight (the same as weights),
+    thus the rows are not copied and a repeated row is never in the train and the test fold of the cross validation
+
+    `featurenames` (the used features for extraction) and `info` (additional values) are stored in info.json,
+    `forest_params` are further parameters of the forests (e.g. max_depth, max_features, see `tune_rf_models`)
+
+    the metrics of the cross validations are stored in info.json, the evaluation plots are rendered afterwards
+    in parallel (`plots`, see `pixelmodels.report.write_eval_plots`), thus they do not block the training
     """
+    start = time.time()
     os.makedirs(modelfolder, exist_ok=True)
 
     df = pd.DataFrame(features)
@@ -242,10 +555,20 @@ def train_rf_models(features,
         "targets": target_cols,
         "num_trees": num_trees,
         "threshold": threshold,
+        "forest_params": forest_params,
         "models_to_train": models_to_train,
+        "train_repetitions": train_repetitions,
+        "seed": seed,
+        "balancing": str(balancing),
         "repo_version": get_repo_version(),
         "date": str(datetime.datetime.now()),
     }
+    if featurenames is not None:
+        params["featurenames"] = sorted(featurenames)
+    if all(isinstance(x, str) for x in df.index):
+        # pooled feature files (see `load_feature_matrix`) the models are trained on, used by `grow_rf_models`
+        params["feature_files"] = list(df.index)
+    params.update(info if info is not None else {})
 
     models = {
         "regression": modelfolder + "/model_regression.npz",
@@ -255,69 +578,541 @@ def train_rf_models(features,
 
     feature_cols = df.columns.difference(target_cols + exclude_cols)
 
-    # df = histogram_based_dataset_balancing(df)
-
     X = df[sorted(feature_cols)]
-    for r in range(train_repetitions):
-        lInfo(f"run train repetition #{r}")
-        for model in models_to_train:
-            Y = df[model]  # target column is the model name
+    targets = {model: df[model] for model in models_to_train}
+    if "rating_dist" in targets:
+        # dense (n_videos x n_levels) rating distribution matrix
+        targets["rating_dist"] = convert_dist(
+            df["rating_dist"],
+            df["rating_levels"] if "rating_levels" in df.columns else None
+        ).set_index(df.index)
+        if targets["rating_dist"].shape[1] == 0:
+            lWarn("rating distributions are empty, thus they cannot be used for training")
+            del targets["rating_dist"]
+            models_to_train.remove("rating_dist")
+    sample_weight = None
+    if balancing in ["replicate", "weights"]:
+        sample_weight = histogram_based_dataset_balancing(df, mode="weights")
+    tasks = [
+        (model, r, seed + r, num_trees, threshold, forest_params)
+        for r in range(train_repetitions)
+        for model in models_to_train
+    ]
+    num_workers = max(1, min(cpu_count, len(tasks)))
+    lInfo(f"train {len(tasks)} models using {num_workers} processes")
+    pool = None
+    if num_workers == 1:
+        _init_train_worker(X, targets, sample_weight)
+        trained = map(_train_target, tasks)
+    else:
+        # the forests of a worker use one job, because the workers already use the cpus
+        pool = mp.Pool(
+            processes=num_workers,
+            initializer=_init_train_worker,
+            initargs=(X, targets, sample_weight, 1)
+        )
+        trained = pool.imap(_train_target, tasks)
+
+    final_models = {}
+    try:
+        for model, r, result in trained:
+            lInfo(f"evaluate {model} of train repetition #{r}")
 
             if "_class" in model:
-                lInfo(f"train {model} as classification")
-                result = train_rf_class(X, Y, num_trees, threshold)
                 save_serialized(result["randomforest"], models["_class"])
+                final_models["_class"] = result["randomforest"]
                 cval = result["crossval"]
                 if clipping:
                     cval["predicted"] = cval["predicted"].clip(1, 5)
-                metrics = eval_plots_class(cval["truth"], cval["predicted"], title=model, folder=modelfolder + "/_class/")
+                metrics = class_metrics(cval["truth"], cval["predicted"])
                 cval.to_csv(modelfolder + "/crossval_class.csv", index=False)
                 params["class_performance"] = params.get("class_performance", []) + [metrics]
                 continue
             if "_dist" in model:
-                lInfo(f"train {model} as multi instance regression")
-                Y = convert_dist(Y.values)
-                Y = Y[sorted(Y.columns)]
-                result = train_rf_multi_regression(X, Y, num_trees, threshold)
                 save_serialized(result["randomforest"], models["_dist"])
+                final_models["_dist"] = result["randomforest"]
                 cval = result["crossval"]
 
-                # perform per pair (predicted_N, truth_N) eval plots
-                for c in cval.columns:
-                    if "predicted" in c:
-                        continue
-                    truth_col = c
-                    predicted_col = truth_col.replace("truth", "predicted")
-                    part = truth_col.replace("truth_", "")
-                    metrics = eval_plots_regression(
-                        cval[truth_col],
-                        cval[predicted_col],
-                        title=model + f"_{part}",
-                        folder=modelfolder + "/_rating_dist/",
-                        plotname=f"rf_mi_@{num_trees}_dist_{part}"
-                    )
-                    params["regression_performance_dist_" + part] = params.get("regression_performance_dist_" + part, []) + [metrics]
+                # metrics of all pairs (predicted_N, truth_N) at once
+                for key, metrics in cval_metrics("dist", cval).items():
+                    params[key] = params.get(key, []) + [metrics]
                 cval.to_csv(modelfolder + "/crossval_rating_dist.csv", index=False)
                 continue
             # default case: regression
-            lInfo(f"train {model} as regression")
-
-            result = train_rf_regression(X, Y, num_trees, threshold)
             save_serialized(result["randomforest"], models["regression"])
+            final_models["regression"] = result["randomforest"]
             cval = result["crossval"]
             if clipping:
                 cval["predicted"] = cval["predicted"].clip(1, 5)
-            metrics = eval_plots_regression(
-                cval["truth"],
-                cval["predicted"],
-                title=model,
-                folder=modelfolder + "/_reggression/",
-                plotname=f"rf_@{num_trees}"
-            )
+            metrics = regression_metrics(cval["truth"], cval["predicted"])[0]
             cval.to_csv(modelfolder + "/crossval_regression.csv", index=False)
             metrics["number_features"] = result["number_features"]
             metrics["used_features"] = result["used_features"]
             params["regression_performance"] = params.get("regression_performance", []) +[metrics]
+    finally:
+        # the workers are also stopped in case a training task fails
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    # export flattened forests with the fixed feature order of X
+    for m in final_models:
+        export_forest(final_models[m], models[m], X)
 
     # store general model info
     jdump_file(modelfolder + "/info.json", params)
+    lInfo(f"training of {modelfolder} done in {time.time() - start:.1f} s")
+
+    # evaluation plots are rendered after the training, based on the crossval files
+    if plots:
+        write_eval_plots(modelfolder, cpu_count)
+
+
+def feature_groups(columns, featurenames):
+    """
+    maps each pooled feature column to the name of the feature it is calculated by,
+    mode0 meta-data based columns are mapped to `meta`
+    """
+    # longest names first, e.g. cubrow.0.3 must not be mapped to cubrow.0
+    names = sorted(featurenames, key=len, reverse=True)
+    groups = {}
+    for column in columns:
+        if column.startswith("meta_"):
+            groups[column] = "meta"
+            continue
+        for f in names:
+            if column == f or column.startswith(f + "_"):
+                groups[column] = f
+                break
+    return groups
+
+
+def pareto_front(candidates):
+    """
+    marks candidates (dictionaries with pearson and cost) that are not dominated by another candidate,
+    i.e. no other candidate is at least as accurate and at least as fast and better in one of both
+    """
+    for c in candidates:
+        c["pareto"] = not any(
+            o["pearson"] >= c["pearson"] and o["cost"] <= c["cost"] and (o["pearson"] > c["pearson"] or o["cost"] < c["cost"])
+            for o in candidates
+        )
+    return candidates
+
+
+def cost_aware_feature_search(df, featurenames, feature_costs, num_trees=60, threshold="0.0001*mean", target="mos",
+        exclude_cols=["video", "src_video", "rating_levels"] + ["mos", "rating_dist", "mos_class"], forest_params=None):
+    """
+    greedy backward elimination of features, in each step the feature with the lowest ratio of
+    importance (of the trained regression forest) to extraction cost (seconds per frame, see
+    `pixelmodels.common.measure_feature_costs`) is removed
+
+    returns the evaluated candidates (featurenames, cost, fps, pearson, rmse of the cross validation, pareto)
+    """
+    feature_cols = sorted(df.columns.difference(exclude_cols))
+    groups = feature_groups(feature_cols, featurenames)
+    selected = set(featurenames)
+    candidates = []
+    while len(selected) > 0:
+        cols = [c for c in feature_cols if groups.get(c) in selected | {"meta"}]
+        X = df[cols]
+        if forest_params is None:
+            result = train_rf_regression(X, df[target], num_trees, threshold)
+        else:
+            result = train_rf_weighted(X, df[target], "regression", None, num_trees, threshold, forest_params=forest_params)
+        cval = result["crossval"]
+        cost = feature_costs.get("_base", 0) + sum(feature_costs.get(f, 0) for f in selected)
+        candidate = {
+            "featurenames": sorted(selected),
+            "cost": cost,
+            "fps": 1 / cost if cost > 0 else float("inf"),
+            "pearson": float(np.corrcoef(cval["truth"], cval["predicted"])[0, 1]),
+            "rmse": float(np.sqrt(np.mean((cval["truth"] - cval["predicted"]) ** 2))),
+        }
+        lInfo(f"cost aware search: {len(selected)} features, {candidate['fps']:.2f} frames/s, pearson {candidate['pearson']:.3f}")
+        candidates.append(candidate)
+
+        # importance of each feature, summed over all of its (selected) columns
+        model = result["randomforest"]
+        used_cols = np.array(cols)
+        for step in model.steps[:-1]:
+            used_cols = used_cols[step[1].get_support()]
+        importance = {f: 0.0 for f in selected}
+        for c, i in zip(used_cols, model.steps[-1][1].feature_importances_):
+            if groups[c] in importance:
+                importance[groups[c]] += i
+        selected.remove(min(selected, key=lambda f: importance[f] / max(feature_costs.get(f, 0), 1e-9)))
+    return pareto_front(candidates)
+
+
+def train_cost_aware_variants(features, featurenames, feature_costs, modelfolder="models",
+        num_trees=60, search_num_trees=60, threshold="0.0001*mean", cost_tolerance=0.02, cpu_count=1, plots=True,
+        forest_params=None):
+    """
+    performs a cost aware feature search and trains a `fast` model variant (stored in `modelfolder`-fast),
+    using the fastest pareto optimal feature set with a cross validation pearson correlation that is at most
+    `cost_tolerance` below the one of all features,
+    all candidates are stored in `modelfolder`/cost_aware_candidates.json,
+    `forest_params` (e.g. of `tune_rf_models`) are used for the search and the model variant
+    """
+    df = pd.DataFrame(features)
+    candidates = cost_aware_feature_search(df, featurenames, feature_costs, search_num_trees, threshold, forest_params=forest_params)
+    os.makedirs(modelfolder, exist_ok=True)
+    jdump_file(os.path.join(modelfolder, "cost_aware_candidates.json"), {
+        "feature_costs": feature_costs,
+        "candidates": candidates
+    })
+
+    full = candidates[0]
+    fast = min(
+        [c for c in candidates if c["pareto"] and c["pearson"] >= full["pearson"] - cost_tolerance],
+        key=lambda c: c["cost"]
+    )
+    variant_folder = os.path.normpath(modelfolder) + "-fast"
+    lInfo(f"train fast model variant with {len(fast['featurenames'])} features in {variant_folder}")
+    groups = feature_groups(df.columns, featurenames)
+    unused_cols = [c for c in groups if groups[c] not in set(fast["featurenames"]) | {"meta"}]
+    train_rf_models(
+        df.drop(columns=unused_cols),
+        num_trees=num_trees,
+        threshold=threshold,
+        modelfolder=variant_folder,
+        cpu_count=cpu_count,
+        featurenames=fast["featurenames"],
+        info={
+            "expected_fps": fast["fps"],
+            "expected_cost_per_frame": fast["cost"],
+            "search_pearson": fast["pearson"],
+            "search_rmse": fast["rmse"],
+        },
+        plots=plots,
+        forest_params=forest_params
+    )
+    return candidates
+
+
+def train_mode0_model(features, modelfolder="models", num_trees=60, threshold="0.0001*mean", cpu_count=1, plots=True):
+    """
+    trains forests only based on the mode0 meta-data features (meta_*) for mos, rating_dist and mos_class
+    (as far as they are part of the features), so that the cascade returns the same values as the full model,
+    they are stored in `modelfolder`/mode0 and used as first tier of cascade predictions of hybrid models
+    """
+    df = pd.DataFrame(features)
+    meta_cols = [c for c in df.columns if c.startswith("meta_")]
+    msg_assert(len(meta_cols) > 0, "mode0 features are required for a mode0 model")
+    target_cols = [c for c in ["mos", "rating_dist", "mos_class"] if c in df.columns]
+    train_rf_models(
+        df[meta_cols + target_cols + [c for c in ["rating_levels"] if c in df.columns]],
+        num_trees=num_trees,
+        threshold=threshold,
+        target_cols=target_cols,
+        modelfolder=os.path.join(modelfolder, "mode0"),
+        cpu_count=cpu_count,
+        plots=plots
+    )
+
+
+# search space of `tune_rf_models`, None values of max_depth and max_features are the sklearn defaults
+TUNE_SPACE = {
+    "num_trees": [60, 120, 240, 480],
+    "max_depth": [None, 12, 20],
+    "max_features": [None, "sqrt", 0.3],
+    "threshold": ["0.0001*mean", "0.5*mean", "mean"],
+}
+
+
+def tune_candidates(space=TUNE_SPACE, num_candidates=27, seed=42):
+    """
+    samples `num_candidates` parameter sets of the grid `space` (all of them in case the grid is smaller)
+    """
+    keys = sorted(space.keys())
+    grid = [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+    if num_candidates < len(grid):
+        grid = random.Random(seed).sample(grid, num_candidates)
+    return grid
+
+
+def candidate_forest_params(candidate):
+    """
+    forest parameters of a tuning candidate for `train_rf_models`, None in case all are sklearn defaults
+    """
+    params = {k: candidate[k] for k in ["max_depth", "max_features"] if candidate.get(k) is not None}
+    return params if len(params) > 0 else None
+
+
+def inference_latency(model, X, repeats=30):
+    """
+    median latency in seconds of the prediction of one feature vector (as for one video)
+    with the flattened forest of the trained `model`
+    """
+    forest = flatten_model(model, list(X.columns))
+    row = X.iloc[:1].to_numpy(dtype=np.float64)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        forest_predict(forest, row)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+# tuning data shared with the worker processes of `tune_rf_models` (see `_TRAIN_DATA`)
+_TUNE_DATA = {}
+
+
+def _init_tune_worker(X, y):
+    _TUNE_DATA["X"] = X
+    _TUNE_DATA["y"] = y
+
+
+def _tune_candidate(task):
+    """
+    cross validation of one candidate on the given rows of the shared tuning data,
+    the forests use one job, because the candidates are evaluated in parallel
+    """
+    index, candidate, rows, folds, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+
+    X = _TUNE_DATA["X"].iloc[rows]
+    y = _TUNE_DATA["y"].iloc[rows]
+    start = time.time()
+    result = train_rf_weighted(
+        X, y, "regression", None, candidate["num_trees"], candidate["threshold"],
+        folds=folds, forest_params=candidate_forest_params(candidate), n_jobs=1, seed=seed
+    )
+    train_time = time.time() - start
+    cval = result["crossval"]
+    pearson = float(np.corrcoef(cval["truth"], cval["predicted"])[0, 1])
+    return index, {
+        "pearson": pearson if np.isfinite(pearson) else -1.0,
+        "rmse": float(np.sqrt(np.mean((cval["truth"] - cval["predicted"]) ** 2))),
+        "train_time": train_time,
+        "latency_ms": 1000 * inference_latency(result["randomforest"], X),
+        "used_features": result["used_features"],
+    }
+
+
+def tune_rf_models(features, modelfolder="models", target="mos", space=TUNE_SPACE, num_candidates=27, eta=3,
+        min_rows=60, folds=5, latency_tolerance=0.005, cpu_count=1, seed=42,
+        exclude_cols=["video", "src_video", "rating_levels"] + ["mos", "rating_dist", "mos_class"]):
+    """
+    successive halving search of the random forest parameters (num_trees, max_depth, max_features and
+    the threshold of the feature selection) for the `target` regression:
+    all candidates are cross validated on a small random subset of the rows, the best 1/`eta` of them on an
+    `eta` times larger subset and so on, until the remaining candidates are evaluated on all rows,
+    the candidates of each rung are evaluated in a process pool of `cpu_count` workers
+
+    each evaluation reports the cross validation accuracy (pearson, rmse), the training time and
+    the inference latency of one feature vector with the flattened forest (latency_ms)
+
+    the selected candidate is the fastest one of the last rung, that is at most `latency_tolerance` pearson
+    correlation below the best one, all evaluations are stored in `modelfolder`/tune_candidates.json,
+    returns the selected candidate (see `candidate_forest_params` for `train_rf_models`)
+    """
+    df = pd.DataFrame(features)
+    msg_assert(len(df) >= folds, f"at least {folds} videos are required for tuning")
+    X = df[sorted(df.columns.difference(exclude_cols))]
+    y = df[target]
+    candidates = tune_candidates(space, num_candidates, seed)
+    # the last rung keeps about `eta` candidates, to select between their accuracy and latency
+    rungs = max(0, int(np.floor(np.log(len(candidates)) / np.log(eta))) - 1)
+    order = np.random.RandomState(seed).permutation(len(df))
+
+    pool = None
+    if cpu_count > 1:
+        pool = mp.Pool(processes=cpu_count, initializer=_init_tune_worker, initargs=(X, y))
+    else:
+        _init_tune_worker(X, y)
+
+    evaluations = []
+    alive = list(range(len(candidates)))
+    try:
+        for rung in range(rungs + 1):
+            rows = len(df) if rung == rungs else min(len(df), max(min_rows, int(len(df) * eta ** (rung - rungs))))
+            lInfo(f"tune rung {rung}: {len(alive)} candidates on {rows} videos")
+            tasks = [(i, candidates[i], order[:rows], folds, seed) for i in alive]
+            results = dict(pool.imap_unordered(_tune_candidate, tasks) if pool is not None else map(_tune_candidate, tasks))
+            for i in alive:
+                evaluation = dict(candidates[i], rung=rung, rows=rows, **results[i])
+                lInfo(f"candidate {candidates[i]}: pearson {evaluation['pearson']:.3f}, rmse {evaluation['rmse']:.3f}, latency {evaluation['latency_ms']:.2f} ms")
+                evaluations.append(evaluation)
+            if rung < rungs:
+                alive = sorted(alive, key=lambda i: results[i]["pearson"], reverse=True)[:max(1, int(np.ceil(len(alive) / eta)))]
+    finally:
+        # the workers are also stopped in case an evaluation fails
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    final = [e for e in evaluations if e["rung"] == rungs]
+    best = max(e["pearson"] for e in final)
+    selected = min([e for e in final if e["pearson"] >= best - latency_tolerance], key=lambda e: e["latency_ms"])
+    lInfo(f"selected candidate: {selected}")
+
+    os.makedirs(modelfolder, exist_ok=True)
+    jdump_file(os.path.join(modelfolder, "tune_candidates.json"), {
+        "space": space,
+        "eta": eta,
+        "folds": folds,
+        "latency_tolerance": latency_tolerance,
+        "evaluations": evaluations,
+        "selected": selected,
+    })
+    return selected
+
+
+# stored models of `train_rf_models`: target column and model file
+MODEL_FILES = {
+    "regression": ("mos", "model_regression.npz"),
+    "_class": ("mos_class", "model_class.npz"),
+    "_dist": ("rating_dist", "model_rating_dist.npz"),
+}
+
+
+def _grow_forest(forest, Xs, Y, add_trees, seed):
+    """
+    returns a copy of the trained `forest` with `add_trees` further trees that are trained on `Xs`, `Y`
+    (sklearn warm start), the previous trees are kept unchanged
+    """
+    grown = copy.deepcopy(forest)
+    random.seed(seed)
+    np.random.seed(seed)
+    grown.set_params(warm_start=True, n_estimators=len(grown.estimators_) + add_trees)
+    grown.fit(Xs, Y)
+    grown.set_params(warm_start=False)
+    return grown
+
+
+def _previous_rows(df, params, feature_cols, modelfolder):
+    """
+    positional indices of the rows of `df` that the stored models are already trained on,
+    based on the feature files of info.json, or for older models the rows of features.csv
+    """
+    if "feature_files" in params:
+        return np.flatnonzero(df.index.isin(params["feature_files"]))
+    lWarn("info.json does not store the trained feature files, the rows are matched with features.csv")
+    previous = pd.read_csv(os.path.join(modelfolder, "features.csv"))
+
+    def row_hashes(values):
+        return pd.util.hash_pandas_object(values[feature_cols].astype(np.float64).round(9), index=False)
+
+    return np.flatnonzero(row_hashes(df).isin(set(row_hashes(previous))).values)
+
+
+def grow_rf_models(features, modelfolder="models", add_trees=30, data="combined", clipping=True, folds=10, seed=42, plots=True, cpu_count=1):
+    """
+    incremental training of the models stored by `train_rf_models` in `modelfolder`, e.g. after the features of
+    a further database are added to the feature folder:
+    the forest of each model grows by `add_trees` trees (sklearn warm start), that are trained on the `combined`
+    (previous and new videos) or only on the `new` videos (not for classification, that needs all classes),
+    the feature selection and the previous trees are kept
+
+    the evaluation is a cross validation over the new videos, for each fold the previous forest grows
+    on the training rows, thus no tree is trained on the evaluated videos,
+    the models, flattened forests, features.csv and crossval files are updated,
+    info.json records each increment (see `increments`), the evaluation plots are rendered afterwards (`plots`)
+    """
+    msg_assert(data in ["combined", "new"], f"incremental training data {data} is not supported")
+    df = pd.DataFrame(features)
+    with open(os.path.join(modelfolder, "info.json")) as info_file:
+        params = json.load(info_file)
+    models = {
+        m: (target, os.path.join(modelfolder, filename))
+        for m, (target, filename) in MODEL_FILES.items()
+        if os.path.isfile(os.path.join(modelfolder, filename)) and target in df.columns
+    }
+    msg_assert(len(models) > 0, f"no stored models in {modelfolder} that can be trained incrementally")
+
+    feature_cols = None
+    increment = {
+        "date": str(datetime.datetime.now()),
+        "repo_version": get_repo_version(),
+        "added_trees": add_trees,
+        "data": data,
+        "seed": seed,
+        "num_trees": {},
+    }
+    for m, (target, model_filename) in models.items():
+        model = load_serialized(model_filename)
+        steps = model.steps if hasattr(model, "steps") else [("forest", model)]
+        forest = steps[-1][1]
+        if feature_cols is None:
+            feature_cols = list(steps[0][1].feature_names_in_)
+            missing = set(feature_cols) - set(df.columns)
+            msg_assert(len(missing) == 0, f"features {missing} are required for the models, but missing")
+            previous_rows = _previous_rows(df, params, feature_cols, modelfolder)
+            new_rows = np.setdiff1d(np.arange(len(df)), previous_rows)
+            lInfo(f"incremental training: {len(previous_rows)} previous and {len(new_rows)} new videos")
+            if len(new_rows) < 2:
+                lWarn("less than two new videos, the models are not changed")
+                return
+            increment["previous_videos"] = int(len(previous_rows))
+            increment["new_videos"] = int(len(new_rows))
+            X = df[feature_cols]
+
+        if target == "rating_dist":
+            dist = convert_dist(df["rating_dist"], df["rating_levels"] if "rating_levels" in df.columns else None)
+            levels = [str(c) for c in dist.columns]
+            Y = dist.values
+            if Y.shape[1] != forest.n_outputs_:
+                lWarn(f"rating levels of the new data differ, {model_filename} is not changed")
+                continue
+        else:
+            Y = df[target].values
+        if hasattr(forest, "classes_") and set(np.unique(Y).tolist()) != set(forest.classes_.tolist()):
+            lWarn(f"classes of the new data differ, {model_filename} is not changed")
+            continue
+
+        # the feature selection is kept, thus the selected features are calculated once
+        Xs = X
+        for _, step in steps[:-1]:
+            Xs = step.transform(Xs)
+        Xs = np.asarray(Xs)
+        # warm start requires all classes in the training data, thus classification forests use the combined data
+        combined = data == "combined" or hasattr(forest, "classes_")
+        train_rows = np.concatenate([previous_rows, new_rows]) if combined else new_rows
+
+        predicted = np.zeros((len(new_rows), ) + Y.shape[1:], dtype=np.float64)
+        for train, test in KFold(n_splits=min(folds, len(new_rows)), shuffle=True, random_state=seed).split(new_rows):
+            rows = np.concatenate([previous_rows, new_rows[train]]) if combined else new_rows[train]
+            fold_forest = _grow_forest(forest, Xs[rows], Y[rows], add_trees, seed)
+            predicted[test] = fold_forest.predict(Xs[new_rows[test]])
+        if hasattr(forest, "classes_"):
+            predicted = predicted.astype(Y.dtype)
+
+        grown = _grow_forest(forest, Xs[train_rows], Y[train_rows], add_trees, seed)
+        if hasattr(model, "steps"):
+            model.steps[-1] = (steps[-1][0], grown)
+        else:
+            model = grown
+        save_serialized(model, model_filename)
+        export_forest(model, model_filename, X)
+        increment["num_trees"][target] = len(grown.estimators_)
+        lInfo(f"{model_filename} grown to {len(grown.estimators_)} trees")
+
+        Y_new = Y[new_rows]
+        if m == "_dist":
+            cval = pd.concat([
+                pd.DataFrame(Y_new, columns=[f"truth_{c}" for c in levels]),
+                pd.DataFrame(predicted, columns=[f"predicted_{c}" for c in levels])
+            ], axis=1)
+            cval.to_csv(modelfolder + "/crossval_rating_dist.csv", index=False)
+        else:
+            cval = pd.DataFrame({"predicted": predicted, "truth": Y_new})
+            if clipping:
+                cval["predicted"] = cval["predicted"].clip(1, 5)
+            cval.to_csv(modelfolder + ("/crossval_class.csv" if m == "_class" else "/crossval_regression.csv"), index=False)
+        for key, metrics in cval_metrics({"_dist": "dist", "_class": "class"}.get(m, "regression"), cval).items():
+            params[key] = [metrics]
+            increment[key] = metrics
+
+    df.to_csv(os.path.join(modelfolder, "features.csv"), index=False)
+    if all(isinstance(x, str) for x in df.index):
+        params["feature_files"] = list(df.index)
+    if len(increment["num_trees"]) > 0:
+        params["num_trees"] = max(increment["num_trees"].values())
+    params["increments"] = params.get("increments", []) + [increment]
+    jdump_file(os.path.join(modelfolder, "info.json"), params)
+
+    if plots:
+        write_eval_plots(modelfolder, cpu_count)
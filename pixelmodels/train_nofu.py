@@ -4,10 +4,14 @@ import sys
 import multiprocessing
 
 from quat.log import *
-from quat.parallel import run_parallel
 
-from pixelmodels.common import get_repo_version
+from pixelmodels.common import (
+    get_repo_version,
+    measure_feature_costs
+)
 from pixelmodels.train_common import *
+from pixelmodels.workqueue import run_batch
+from pixelmodels.budget import cpu_budget, report_budget
 from pixelmodels.nofu import (
     nofu_features,
     NOFU_MODEL_PATH
@@ -24,32 +28,96 @@ def main(_=[]):
     parser.add_argument("--temp_folder", type=str, default="tmp/train_nofu", help="temp folder")
     parser.add_argument("--train_repetitions", type=int, default=1, help="number of repeatitions for training")
     parser.add_argument("--model", type=str, default=NOFU_MODEL_PATH, help="output model folder")
+    parser.add_argument("--feature_hash_check", action="store_true", help="detect changed feature files by content hash instead of modification time")
+    parser.add_argument("--balancing", type=str, default=None, choices=["replicate", "weights"], help="balance the training data based on rounded mos values, by sample weights (replicate: the number of repetitions of each row as integer weight, the same as weights)")
+    parser.add_argument("--cost_aware", action="store_true", help="perform a cost aware feature search and train a fast model variant (stored in MODEL-fast)")
+    parser.add_argument("--cost_sample", type=int, default=5, help="number of videos used to measure the feature extraction costs")
+    parser.add_argument("--cost_tolerance", type=float, default=0.02, help="maximal allowed loss of pearson correlation for the fast model variant")
+    parser.add_argument("--cache_folder", type=str, default=None, help="content addressed feature cache, shared by all models (None disables the cache)")
+    parser.add_argument("--queue", type=str, default=None, help="work queue database (e.g. on a shared file system) for the feature extraction, further hosts can join with pixelmodels_worker")
+    parser.add_argument("--planar_frames", action="store_true", help="decode frames at native bit depth as planes, luma features use the luma plane (use a separate feature folder, the model requires the same setting for predictions)")
+    parser.add_argument("--crop_first", action="store_true", help="crop the lines of the center crop before scaling the videos (equal within the tolerance of pixelmodels_crop_benchmark, use a separate feature folder, the model should be used with the same setting)")
     parser.add_argument('--cpu_count', type=int, default=multiprocessing.cpu_count() // 2, help='thread/cpu count')
+    parser.add_argument("--cpu_budget", type=int, default=None, help="cpus used in total by the feature extraction, split into cpu_count worker processes, their feature threads, ffmpeg and BLAS/OpenCV threads (None uses all cpus)")
+    parser.add_argument("--pin_cpus", action="store_true", help="pin each feature extraction process and its ffmpeg processes to its own cpus")
+    parser.add_argument("--tune", action="store_true", help="search the forest parameters (trees, depth, max_features, selection threshold) with successive halving before training, instead of using 120 trees (stored in MODEL/tune_candidates.json)")
+    parser.add_argument("--tune_candidates", type=int, default=27, help="number of parameter sets that are evaluated by the search")
+    parser.add_argument("--tune_tolerance", type=float, default=0.005, help="the fastest candidate (inference latency) within this pearson correlation to the best one is selected")
+    parser.add_argument("--incremental", action="store_true", help="grow the forests of the stored models with further trees on the new videos of the feature folder (sklearn warm start), instead of a full training")
+    parser.add_argument("--add_trees", type=int, default=30, help="number of trees that are added to each forest in incremental training")
+    parser.add_argument("--incremental_data", type=str, default="combined", choices=["combined", "new"], help="train the added trees on all videos or only on the new ones")
+    parser.add_argument("--no_plots", action="store_true", help="do not render the evaluation plots after the training (they can be rendered later with pixelmodels_report)")
 
     a = vars(parser.parse_args())
+    if a["tune"] and a["incremental"]:
+        parser.error("--tune can not be combined with --incremental, the grown forests keep the parameters of the stored models")
 
     # read videos with training targets
     train_videos = read_database(a["database"])
     lInfo(f"train on {len(train_videos)} videos")
 
-    run_parallel(
+    budget = cpu_budget(a["cpu_budget"], a["cpu_count"], a["pin_cpus"])
+    report_budget(budget)
+    run_batch(
         items=train_videos,
         function=calc_and_store_features,
-        arguments=[a["feature_folder"], a["temp_folder"], nofu_features(), "nofu"],
-        num_cpus=a["cpu_count"]
+        arguments=[a["feature_folder"], a["temp_folder"], nofu_features(), "nofu", False, a["cache_folder"], a["planar_frames"], a["crop_first"]],
+        num_cpus=budget["processes"],
+        queue_file=a["queue"],
+        budget=budget
     )
 
     # read all features from feature folder
-    features = load_features(a["feature_folder"])
+    features = load_feature_matrix(a["feature_folder"], hash_check=a["feature_hash_check"])
     lInfo(f"loaded {len(features)} feature values")
 
-    train_rf_models(
-        features,
-        num_trees=120,
-        threshold="0.0001*mean",
-        modelfolder=a["model"],
-        train_repetitions=a["train_repetitions"]
-    )
+    num_trees, threshold, forest_params = 120, "0.0001*mean", None
+    if a["incremental"]:
+        grow_rf_models(
+            features,
+            modelfolder=a["model"],
+            add_trees=a["add_trees"],
+            data=a["incremental_data"],
+            cpu_count=a["cpu_count"],
+            plots=not a["no_plots"]
+        )
+    else:
+        if a["tune"]:
+            tuned = tune_rf_models(
+                features,
+                modelfolder=a["model"],
+                num_candidates=a["tune_candidates"],
+                latency_tolerance=a["tune_tolerance"],
+                cpu_count=a["cpu_count"]
+            )
+            num_trees, threshold, forest_params = tuned["num_trees"], tuned["threshold"], candidate_forest_params(tuned)
+
+        train_rf_models(
+            features,
+            num_trees=num_trees,
+            threshold=threshold,
+            modelfolder=a["model"],
+            train_repetitions=a["train_repetitions"],
+            cpu_count=a["cpu_count"],
+            balancing=a["balancing"],
+            forest_params=forest_params,
+            plots=not a["no_plots"]
+        )
+
+    if a["cost_aware"]:
+        feature_costs = measure_feature_costs(train_videos[:a["cost_sample"]], nofu_features(), a["temp_folder"])
+        train_cost_aware_variants(
+            features,
+            nofu_features(),
+            feature_costs,
+            modelfolder=a["model"],
+            num_trees=num_trees,
+            threshold=threshold,
+            cost_tolerance=a["cost_tolerance"],
+            cpu_count=a["cpu_count"],
+            plots=not a["no_plots"],
+            forest_params=forest_params
+        )
 
 
 
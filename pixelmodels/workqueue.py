@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# workqueue -- SQLite based work queue for batch processing on several processes or hosts
+import argparse
+import hashlib
+import importlib
+import json
+import multiprocessing as mp
+import os
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+from quat.log import *
+from quat.parallel import run_parallel
+
+from pixelmodels.budget import (
+    apply_budget,
+    cpu_budget,
+    init_worker,
+    report_budget,
+    scoped_budget
+)
+from pixelmodels.cache import model_hash
+
+# default lease duration of a claimed job in seconds, the lease is renewed by a heartbeat while the job is running
+LEASE_SECONDS = 300
+# number of tries of a job, before it is marked as failed
+MAX_ATTEMPTS = 3
+
+
+def function_name(function):
+    """
+    returns the importable name (module:qualname) of a function, so that workers on other hosts can resolve it
+    """
+    module = function.__module__
+    if module == "__main__":
+        # e.g. started with python -m pixelmodels.nofu
+        spec = getattr(sys.modules["__main__"], "__spec__", None)
+        module = spec.name if spec is not None else module
+    return f"{module}:{function.__qualname__}"
+
+
+def resolve_function(name):
+    """
+    resolves a function by its name (module:qualname), see `function_name`
+    """
+    module, qualname = name.split(":")
+    function = importlib.import_module(module)
+    for part in qualname.split("."):
+        function = getattr(function, part)
+    return function
+
+
+def _stable_json(value):
+    if callable(value):
+        return function_name(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return str(value)
+
+
+def job_id(item, function=None, arguments=[], key=None):
+    """
+    stable id of a job (item, function and arguments), thus enqueueing the same jobs again does not create new jobs,
+    `key` are further values that the results depend on (e.g. the hash of a model file), but are not arguments
+    """
+    job = [item] if function is None else [item, function_name(function), arguments]
+    if key is not None:
+        job.append(key)
+    return hashlib.sha1(json.dumps(job, sort_keys=True, default=_stable_json).encode()).hexdigest()
+
+
+class WorkQueue:
+    """
+    persistent work queue stored in a SQLite database,
+    any number of worker processes (also on several hosts using a shared file system) claim jobs with a lease,
+    running jobs renew their lease with heartbeats, jobs with an expired lease (e.g. crashed workers)
+    are claimed again, failed jobs are retried up to `max_attempts` times
+    """
+    def __init__(self, queue_file, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self._queue_file = queue_file
+        self._lease_seconds = lease_seconds
+        self._max_attempts = max_attempts
+        folder = os.path.dirname(queue_file)
+        if folder != "":
+            os.makedirs(folder, exist_ok=True)
+        with self._connect() as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    function TEXT,
+                    item BLOB,
+                    arguments BLOB,
+                    status TEXT,
+                    attempts INTEGER,
+                    worker TEXT,
+                    lease_until REAL,
+                    result BLOB,
+                    error TEXT,
+                    updated REAL
+                )
+            """)
+
+    def _connect(self):
+        con = sqlite3.connect(self._queue_file, timeout=60, isolation_level=None)
+        con.execute("PRAGMA busy_timeout = 60000")
+        return _Transaction(con)
+
+    def enqueue(self, items, function, arguments=[], retry_failed=True, key=None):
+        """
+        adds jobs `function(item, *arguments)` for all items, already existing jobs are kept (e.g. done jobs of
+        a previous run are not processed again), in case of `retry_failed` failed jobs are set to pending again,
+        `key` is part of the job ids (see `job_id`),
+        returns the job ids in the order of the items
+        """
+        ids = [job_id(item, function, arguments, key) for item in items]
+        name = function_name(function)
+        now = time.time()
+        with self._connect() as con:
+            con.executemany(
+                "INSERT OR IGNORE INTO jobs VALUES (?, ?, ?, ?, 'pending', 0, NULL, 0, NULL, NULL, ?)",
+                [(i, name, pickle.dumps(item), pickle.dumps(arguments), now) for i, item in zip(ids, items)]
+            )
+            if retry_failed:
+                con.executemany(
+                    "UPDATE jobs SET status = 'pending', attempts = 0, updated = ? WHERE id = ? AND status = 'failed'",
+                    [(now, i) for i in ids]
+                )
+        return ids
+
+    def release(self, ids=None):
+        """
+        sets all running jobs (or the given ones) to pending again, only meaningful if no other worker is running,
+        e.g. to resume a local batch after a crash without waiting for the leases to expire
+        """
+        now = time.time()
+        with self._connect() as con:
+            if ids is None:
+                con.execute("UPDATE jobs SET status = 'pending', lease_until = 0, updated = ? WHERE status = 'running'", (now,))
+                return
+            con.executemany(
+                "UPDATE jobs SET status = 'pending', lease_until = 0, updated = ? WHERE id = ? AND status = 'running'",
+                [(now, i) for i in set(ids)]
+            )
+
+    def prune(self, ids):
+        """
+        removes all jobs that are not done and not one of the given ones, e.g. pending or failed jobs of an
+        earlier batch with other items or options, thus the workers only process the given jobs
+        """
+        keep = set(ids)
+        with self._connect() as con:
+            stale = [x[0] for x in con.execute("SELECT id FROM jobs WHERE status != 'done'").fetchall() if x[0] not in keep]
+            con.executemany("DELETE FROM jobs WHERE id = ?", [(i, ) for i in stale])
+        return len(stale)
+
+    def claim(self, worker):
+        """
+        claims the next job for `worker`, returns (id, function, item, arguments) or None in case no job is available
+        """
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = 'failed', error = 'lease expired', updated = ? "
+                "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, self._max_attempts)
+            )
+            row = con.execute(
+                "SELECT id, function, item, arguments FROM jobs "
+                "WHERE status = 'pending' OR (status = 'running' AND lease_until < ?) ORDER BY rowid LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            con.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (worker, now + self._lease_seconds, now, row[0])
+            )
+        return row[0], row[1], pickle.loads(row[2]), pickle.loads(row[3])
+
+    def heartbeat(self, id, worker):
+        """
+        renews the lease of a running job
+        """
+        now = time.time()
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (now + self._lease_seconds, now, id, worker)
+            )
+
+    def complete(self, id, worker, result):
+        """
+        stores the result of a job
+        """
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, updated = ? WHERE id = ? AND worker = ?",
+                (pickle.dumps(result), time.time(), id, worker)
+            )
+
+    def fail(self, id, worker, error):
+        """
+        marks a job as failed, it is retried in case it has remaining attempts
+        """
+        with self._connect() as con:
+            con.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, lease_until = 0, updated = ? WHERE id = ? AND worker = ?",
+                (self._max_attempts, error, time.time(), id, worker)
+            )
+
+    def status(self):
+        """
+        returns the number of jobs per status
+        """
+        with self._connect() as con:
+            return dict(con.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+    def finished(self, ids=None):
+        """
+        checks if all jobs (or the given ones) are done or failed
+        """
+        with self._connect() as con:
+            rows = con.execute("SELECT id, status FROM jobs").fetchall()
+        ids = None if ids is None else set(ids)
+        return all(status in ["done", "failed"] for id, status in rows if ids is None or id in ids)
+
+    def done(self):
+        """
+        returns the ids of all done jobs
+        """
+        with self._connect() as con:
+            return set(x[0] for x in con.execute("SELECT id FROM jobs WHERE status = 'done'").fetchall())
+
+    def results(self, ids):
+        """
+        returns the results of the given jobs, None for not finished or failed jobs
+        """
+        unique_ids = sorted(set(ids))
+        rows = {}
+        with self._connect() as con:
+            # chunks, because of the limited number of SQLite query parameters
+            for i in range(0, len(unique_ids), 500):
+                chunk = unique_ids[i:i + 500]
+                rows.update(con.execute(
+                    f"SELECT id, result FROM jobs WHERE status = 'done' AND id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall())
+        return [pickle.loads(rows[id]) if id in rows else None for id in ids]
+
+    def errors(self):
+        """
+        returns the error messages of all failed jobs
+        """
+        with self._connect() as con:
+            return dict(con.execute("SELECT id, error FROM jobs WHERE status = 'failed'").fetchall())
+
+
+class _Transaction:
+    """
+    wraps a connection, so that all statements of a `with` block are one (exclusive) transaction
+    """
+    def __init__(self, con):
+        self._con = con
+
+    def __enter__(self):
+        self._con.execute("BEGIN IMMEDIATE")
+        return self._con
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._con.execute("ROLLBACK" if exc_type is not None else "COMMIT")
+        self._con.close()
+
+
+def work(queue_file, worker=None, poll_interval=5, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+    """
+    processes jobs of a queue until all jobs are done or failed,
+    while jobs of other workers are running, the worker waits, in case their lease expires it takes them over
+    """
+    worker = worker if worker is not None else f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_file, lease_seconds, max_attempts)
+    processed = 0
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            if queue.finished():
+                break
+            time.sleep(poll_interval)
+            continue
+        id, name, item, arguments = job
+        stop_heartbeat = threading.Event()
+
+        def heartbeat():
+            while not stop_heartbeat.wait(lease_seconds / 3):
+                try:
+                    queue.heartbeat(id, worker)
+                except sqlite3.OperationalError as e:
+                    # e.g. the database is locked longer than the busy timeout, the next beat tries again
+                    lWarn(f"heartbeat of job {id} on {worker} failed: {e}")
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            result = resolve_function(name)(*item, *arguments)
+            queue.complete(id, worker, result)
+        except Exception as e:
+            lWarn(f"job {id} failed on {worker}: {e}")
+            queue.fail(id, worker, traceback.format_exc())
+        finally:
+            stop_heartbeat.set()
+            heartbeat_thread.join()
+        processed += 1
+    lInfo(f"worker {worker} finished after {processed} jobs")
+    return processed
+
+
+def _budget_work(budget, worker_index, queue_file, poll_interval):
+    apply_budget(budget, worker_index)
+    return work(queue_file, None, poll_interval)
+
+
+def run_queue(items, function, arguments, queue_file, num_workers=1, multi_item=False, poll_interval=5, recover=False, exclusive=False, on_result=None, budget=None, key=None):
+    """
+    runs `function(item, *arguments)` for all items using the work queue `queue_file` and `num_workers` local
+    worker processes, further workers can be started on other hosts (`pixelmodels_worker queue_file`),
+    with `num_workers=0` all jobs are processed by such external workers
+
+    the queue is persistent, done jobs of a previous (e.g. crashed) run are not processed again,
+    `recover` releases the running jobs of a previous run (only for queues without other workers),
+    in case of `exclusive` the queue is only used by this batch, jobs of earlier batches that are not done
+    are removed (e.g. a job ledger, where changed options create new jobs),
+    `on_result(index, result)` is called as soon as the job of an item is done (also for already done jobs),
+    the cpu `budget` (see `pixelmodels.budget`) is applied to each local worker,
+    `key` is part of the job ids, e.g. the hash of the used model (see `job_id`)
+
+    returns the results in the order of the items (None for failed jobs), in case of `on_result` the results
+    are only passed to it, so that they are not all kept in memory
+    """
+    items = [list(item) if multi_item else [item] for item in items]
+    queue = WorkQueue(queue_file)
+    ids = [job_id(item, function, arguments, key) for item in items]
+    if exclusive:
+        pruned = queue.prune(ids)
+        if pruned > 0:
+            lInfo(f"queue {queue_file}: removed {pruned} unfinished jobs of earlier batches")
+    if recover:
+        queue.release(ids)
+    ids = queue.enqueue(items, function, arguments, key=key)
+    lInfo(f"queue {queue_file}: {queue.status()}")
+
+    indices = {}
+    for index, id in enumerate(ids):
+        indices.setdefault(id, []).append(index)
+    reported = set()
+
+    def report_done():
+        if on_result is None:
+            return
+        new = sorted((queue.done() & set(indices)) - reported)
+        for id, result in zip(new, queue.results(new)):
+            for index in indices[id]:
+                on_result(index, result)
+            reported.add(id)
+
+    workers = [mp.Process(target=_budget_work, args=(budget, i, queue_file, poll_interval)) for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    while any(w.is_alive() for w in workers) or not queue.finished(ids):
+        report_done()
+        time.sleep(poll_interval)
+    for w in workers:
+        w.join()
+    report_done()
+
+    for id, error in queue.errors().items():
+        if id in ids:
+            lWarn(f"job {id} failed: {error}")
+    if on_result is not None:
+        return None
+    return queue.results(ids)
+
+
+def run_batch(items, function, arguments, num_cpus, multi_item=False, queue_file=None, ledger_file=None, on_result=None, budget=None, model_path=None):
+    """
+    runs a batch either with `run_parallel`, or in case of a `queue_file` using a shared work queue,
+    or in case of a `ledger_file` using a local work queue as job ledger (done jobs are skipped in a later run),
+    `on_result(index, result)` is called for each finished job, then nothing is returned,
+    the cpu `budget` (see `pixelmodels.budget`, with `num_cpus` processes) is applied to all worker processes,
+    the content hash of the models in `model_path` is part of the queued jobs, thus a retrained model
+    (at the same path) creates new jobs instead of reusing the results of the previous model
+    """
+    key = None if model_path is None or (queue_file is None and ledger_file is None) else model_hash(model_path)
+    if queue_file is not None:
+        return run_queue(items, function, arguments, queue_file, num_workers=num_cpus, multi_item=multi_item, on_result=on_result, budget=budget, key=key)
+    if ledger_file is not None:
+        return run_queue(
+            items, function, arguments, ledger_file,
+            num_workers=num_cpus, multi_item=multi_item, poll_interval=1, recover=True, exclusive=True,
+            on_result=on_result, budget=budget, key=key
+        )
+    if on_result is None and budget is None:
+        return run_parallel(
+            items=items,
+            function=function,
+            arguments=arguments,
+            num_cpus=num_cpus,
+            multi_item=multi_item
+        )
+    tasks = [(function, index, item if multi_item else [item], arguments) for index, item in enumerate(items)]
+    results = None
+    if on_result is None:
+        # results in the order of the items, as `run_parallel`
+        results = [None] * len(tasks)
+
+        def on_result(index, result):
+            results[index] = result
+    if num_cpus == 1:
+        # no worker processes, so the function itself can use processes (they inherit the budget, no pinning),
+        # the budget only applies during the batch, the calling process is restored afterwards
+        with scoped_budget(budget):
+            for index, result in map(_call_indexed, tasks):
+                on_result(index, result)
+    else:
+        # results are passed to on_result in the order they complete
+        with mp.Pool(num_cpus, initializer=init_worker, initargs=(budget, mp.Value("i", 0))) as pool:
+            for index, result in pool.imap_unordered(_call_indexed, tasks):
+                on_result(index, result)
+    return results
+
+
+def _call_indexed(task):
+    function, index, item, arguments = task
+    return index, function(*item, *arguments)
+
+
+def main(_=[]):
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        description='worker for batch jobs stored in a work queue (see --queue option of the batch commands)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("queue", type=str, help="work queue database, e.g. on a shared file system")
+    parser.add_argument("--cpu_count", type=int, default=mp.cpu_count() // 2, help="number of worker processes")
+    parser.add_argument("--cpu_budget", type=int, default=None, help="cpus of this host used by all workers, split into worker processes, feature threads, ffmpeg and BLAS/OpenCV threads (None uses all cpus)")
+    parser.add_argument("--pin_cpus", action="store_true", help="pin each worker process and its ffmpeg processes to its own cpus")
+    parser.add_argument("--poll_interval", type=float, default=5, help="seconds to wait for jobs of other workers")
+    parser.add_argument("--status", action="store_true", help="only print the number of jobs per status")
+
+    a = vars(parser.parse_args())
+    if a["status"]:
+        print(json.dumps(WorkQueue(a["queue"]).status(), indent=4))
+        return
+    budget = cpu_budget(a["cpu_budget"], a["cpu_count"], a["pin_cpus"])
+    report_budget(budget)
+    workers = [mp.Process(target=_budget_work, args=(budget, i, a["queue"], a["poll_interval"])) for i in range(budget["processes"])]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
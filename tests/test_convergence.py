@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import numpy as np
+
+from pixelmodels.common import ConvergenceMonitor
+
+
+def frame(value):
+    return np.full((64, 64), value, dtype=np.uint8)
+
+
+def run(monitor, values):
+    for i, value in enumerate(values):
+        if monitor.update(frame(100), {"ti": value}):
+            return i + 1
+    return None
+
+
+def test_stops_for_stationary_values():
+    monitor = ConvergenceMonitor(1000)
+    assert run(monitor, [1.0, 2.0] * 500) is not None
+
+
+def test_missing_value_does_not_converge():
+    # a strongly non-stationary signal after one missing value must not be treated as converged
+    monitor = ConvergenceMonitor(1000)
+    values = [None] + [float(i ** 2) for i in range(1, 1000)]
+    assert run(monitor, values) is None
+    count, mean, _ = monitor._stats["ti"]
+    assert count[0] == 999
+    assert np.isfinite(mean).all()
+
+
+def test_missing_values_are_skipped():
+    monitor = ConvergenceMonitor(1000)
+    values = [None if i % 7 == 0 else [1.0, 2.0][i % 2] for i in range(1000)]
+    assert run(monitor, values) is not None
+    _, mean, _ = monitor._stats["ti"]
+    np.testing.assert_allclose(mean, [1.5], atol=0.05)
+
+
+def test_only_missing_values_never_converge():
+    monitor = ConvergenceMonitor(100)
+    assert run(monitor, [float("nan")] * 100) is None
+
+
+def test_scene_cut_resets_statistics():
+    monitor = ConvergenceMonitor(100)
+    for _ in range(20):
+        monitor.update(frame(0), {"ti": 1.0})
+    monitor.update(frame(200), {"ti": 5.0})
+    count, mean, _ = monitor._stats["ti"]
+    assert monitor.scene_cuts == 1
+    assert count[0] == 1
+    np.testing.assert_allclose(mean, [5.0])
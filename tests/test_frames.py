@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+from pixelmodels.frames import (
+    FEATURE_CAPABILITIES,
+    PlanarFrame,
+    calc_planar,
+    check_planes,
+    feature_planes
+)
+
+
+class ColourOnly:
+    def __init__(self):
+        self.calls = 0
+
+    def calc(self, frame):
+        assert frame.ndim == 3, "colour frames are required"
+        self.calls += 1
+        return float(frame.mean())
+
+
+class LumaOnly(ColourOnly):
+    def calc(self, frame):
+        assert frame.ndim == 2 and frame.dtype == np.float32, "luma planes are required"
+        self.calls += 1
+        return float(frame.mean())
+
+    def calc_dis_ref(self, dis, ref):
+        return self.calc(dis) - self.calc(ref)
+
+
+def frame(bitdepth=10):
+    y = np.full((8, 8), 512 if bitdepth == 10 else 128, dtype=np.uint16 if bitdepth == 10 else np.uint8)
+    uv = np.full((4, 4), 1 << (bitdepth - 1), dtype=y.dtype)
+    return PlanarFrame(y, uv, uv, bitdepth, (2, 2))
+
+
+def test_feature_planes():
+    planes = feature_planes(["si", "ssim", "fft"], "rgb")
+    assert planes == {"si": "luma", "ssim": "luma", "fft": "rgb"}
+
+
+def test_calc_planar_uses_declared_planes():
+    features = {"si": LumaOnly(), "fft": ColourOnly()}
+    planes = feature_planes(features.keys(), "bgr")
+    f = frame()
+    assert calc_planar(features, "si", planes, f) == 128
+    assert calc_planar(features, "fft", planes, f) > 0
+    assert calc_planar({"si": LumaOnly()}, "si", planes, f, frame()) == 0
+
+
+def test_check_planes_keeps_feature_state():
+    features = {"si": LumaOnly(), "fft": ColourOnly()}
+    check_planes(features, feature_planes(features.keys(), "bgr"))
+    check_planes(features, feature_planes(features.keys(), "rgb"), full_ref=True)
+    assert features["si"].calls == 0
+
+
+def test_check_planes_fails_fast():
+    with pytest.raises(BaseException, match="does not support luma planes"):
+        check_planes({"si": ColourOnly()}, {"si": "luma"})
+
+
+def test_listed_features_support_luma_planes():
+    # the declared capabilities of the quat features
+    from pixelmodels.common import all_features
+
+    features = all_features()
+    planes = {f: "luma" for f in FEATURE_CAPABILITIES}
+    full_ref = {f for f in planes if f in ["ssim", "psnr"]}
+    check_planes(features, {f: p for f, p in planes.items() if f not in full_ref})
+    check_planes(features, planes, full_ref=True)
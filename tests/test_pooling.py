@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import numpy as np
+import pytest
+
+from pixelmodels.pooling import (
+    pool_features,
+    QUANTILES
+)
+
+
+def reference(values_by_feature):
+    # the trained models are based on the pooling of quat
+    video = pytest.importorskip("quat.video")
+    pooled = {}
+    for f, values in values_by_feature.items():
+        pooled.update(video.advanced_pooling(values, name=f))
+    return pooled
+
+
+def assert_same_pooling(values_by_feature):
+    expected = reference(values_by_feature)
+    pooled = pool_features(values_by_feature)
+    assert set(pooled.keys()) == set(expected.keys())
+    for k in expected:
+        assert isinstance(pooled[k], float)
+        np.testing.assert_allclose(pooled[k], float(expected[k]), rtol=1e-9, atol=1e-12, equal_nan=True, err_msg=k)
+
+
+def features(frames, seed=0):
+    rng = np.random.RandomState(seed)
+    return {
+        "si": list(rng.rand(frames)),
+        "ti": [float(x) for x in rng.rand(frames) * 100],
+        "colorfulness": [list(x) for x in rng.rand(frames, 3)],
+        "blockiness": [{"h": float(h), "v": float(v)} for h, v in rng.rand(frames, 2)],
+    }
+
+
+def test_names():
+    pooled = pool_features({"si": [1, 2, 3, 4]})
+    assert list(pooled.keys()) == [
+        "si_mean", "si_std", "si_first_value", "si_last_value", "si_max", "si_skew", "si_kurtosis", "si_iqr"
+    ] + [f"si_{q}_quantil" for q in QUANTILES] + [
+        "si_p0.mean", "si_p0.std", "si_p1.mean", "si_p1.std", "si_p2.mean", "si_p2.std"
+    ]
+    assert "si_0.0_quantil" in pooled and "si_1.0_quantil" in pooled
+    assert pooled["si_first_value"] == 1 and pooled["si_last_value"] == 4 and pooled["si_max"] == 4
+    assert pooled["si_p0.mean"] == 1.5
+
+
+def test_vector_and_dict_names():
+    pooled = pool_features({"c": [[1, 2], [3, 4]], "b": [{"h": 1, "v": 2}, {"h": 3, "v": 4}]})
+    assert "c_0_mean" in pooled and "c_1_mean" in pooled
+    assert "b_h_mean" in pooled and "b_v_mean" in pooled
+    assert pooled["c_1_mean"] == 3 and pooled["b_h_max"] == 3
+
+
+def test_nan_values():
+    values = features(20)
+    values["si"][3] = np.nan
+    values["colorfulness"][0][1] = np.nan
+    pooled = pool_features(values)
+    assert np.isnan(pooled["si_mean"]) and not np.isnan(pooled["ti_mean"])
+    assert np.isnan(pooled["colorfulness_1_first_value"]) and not np.isnan(pooled["colorfulness_0_first_value"])
+
+
+def test_short_series():
+    # videos with two frames have an empty part
+    pooled = pool_features({"si": [1.0, 2.0]})
+    assert np.isnan(pooled["si_p2.mean"])
+
+
+@pytest.mark.parametrize("frames", [2, 3, 4, 17, 120])
+def test_same_as_quat(frames):
+    assert_same_pooling(features(frames))
+
+
+def test_same_as_quat_different_number_of_frames():
+    values = features(30)
+    values.update({f"short_{k}": v for k, v in features(7, seed=1).items()})
+    assert_same_pooling(values)
+
+
+def test_same_as_quat_nan_values():
+    values = features(20)
+    values["si"][3] = np.nan
+    values["colorfulness"][0][1] = np.nan
+    values["blockiness"][19]["v"] = np.nan
+    assert_same_pooling(values)
+
+
+def test_same_as_quat_not_vectorisable_features():
+    # these features are pooled by quat
+    values = {
+        "ragged_dict": [{"a": 1, "b": 2}, {"a": 3, "b": 4, "c": 5}],
+        "nested": [{"a": {"x": 1}}, {"a": {"x": 2}}],
+        "si": [1.0, 2.0, 3.0],
+    }
+    assert_same_pooling(values)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from pixelmodels.train_common import train_rf_models
+
+
+def features(videos=60, seed=0):
+    rng = np.random.RandomState(seed)
+    rows = []
+    for i in range(videos):
+        x = rng.rand(4)
+        mos = float(np.clip(1 + 4 * x[0] + 0.3 * rng.randn(), 1, 5))
+        rows.append({
+            "video": f"video_{i}",
+            "si_mean": x[0],
+            "ti_mean": x[1],
+            "noise_mean": x[2],
+            "blur_mean": x[3],
+            "mos": mos,
+            "mos_class": int(round(mos)),
+            "rating_dist": {"1": int(5 - mos), "5": int(mos)},
+            "rating_levels": [1, 5],
+        })
+    return rows
+
+
+def train(folder, cpu_count):
+    train_rf_models(features(), num_trees=10, modelfolder=str(folder), train_repetitions=2, cpu_count=cpu_count, plots=False)
+    crossval = {f: pd.read_csv(os.path.join(folder, f)) for f in sorted(os.listdir(folder)) if f.startswith("crossval_")}
+    with open(os.path.join(folder, "info.json")) as info_file:
+        info = json.load(info_file)
+    return crossval, info
+
+
+def test_crossval_does_not_depend_on_cpu_count(tmp_path):
+    crossval_1, info_1 = train(tmp_path / "cpu1", 1)
+    crossval_2, info_2 = train(tmp_path / "cpu2", 2)
+
+    assert list(crossval_1.keys()) == ["crossval_class.csv", "crossval_rating_dist.csv", "crossval_regression.csv"]
+    assert crossval_1.keys() == crossval_2.keys()
+    for f in crossval_1:
+        pd.testing.assert_frame_equal(crossval_1[f], crossval_2[f], check_exact=False, rtol=1e-12)
+    for key in ["regression_performance", "class_performance"]:
+        assert info_1[key] == info_2[key]
+
+
+def test_replicate_balancing_does_not_copy_rows(tmp_path):
+    crossval = {}
+    for balancing in ["replicate", "weights"]:
+        folder = tmp_path / balancing
+        train_rf_models(features(), num_trees=10, modelfolder=str(folder), target_cols=["mos"], balancing=balancing, plots=False)
+        crossval[balancing] = pd.read_csv(folder / "crossval_regression.csv")
+    # one crossval row per video, thus a repeated video is never in the train and the test fold
+    assert len(crossval["replicate"]) == len(features())
+    pd.testing.assert_frame_equal(crossval["replicate"], crossval["weights"])
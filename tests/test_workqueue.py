@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import multiprocessing as mp
+import sqlite3
+import time
+
+import pytest
+
+from pixelmodels.workqueue import (
+    MAX_ATTEMPTS,
+    WorkQueue,
+    run_batch,
+    run_queue,
+    work
+)
+
+
+def square(x, calls_file):
+    """
+    test job, each call is logged in `calls_file`
+    """
+    with open(calls_file, "a") as calls:
+        calls.write(f"{x}\n")
+    time.sleep(0.01)
+    return x * x
+
+
+def failing(x, calls_file):
+    with open(calls_file, "a") as calls:
+        calls.write(f"{x}\n")
+    raise ValueError(f"job {x} fails")
+
+
+def slow(x, seconds):
+    time.sleep(seconds)
+    return x
+
+
+def calls(calls_file):
+    with open(calls_file) as f:
+        return [int(x) for x in f.read().split()]
+
+
+@pytest.fixture
+def queue_file(tmp_path):
+    return str(tmp_path / "queue.sqlite")
+
+
+def test_parallel_workers_run_each_job_once(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    queue = WorkQueue(queue_file)
+    queue.enqueue([[x] for x in range(40)], square, [calls_file])
+
+    workers = [mp.Process(target=work, args=(queue_file, f"worker{i}", 0.01)) for i in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert sorted(calls(calls_file)) == list(range(40))
+    assert queue.status() == {"done": 40}
+
+
+def test_enqueue_keeps_done_jobs(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    queue = WorkQueue(queue_file)
+    ids = queue.enqueue([[2], [3]], square, [calls_file])
+    work(queue_file, "worker", 0.01)
+    assert queue.enqueue([[2], [3]], square, [calls_file]) == ids
+    work(queue_file, "worker", 0.01)
+    assert calls(calls_file) == [2, 3]
+    assert queue.results(ids) == [4, 9]
+
+
+def test_expired_lease_is_taken_over(queue_file, tmp_path):
+    queue = WorkQueue(queue_file, lease_seconds=0.2)
+    id = queue.enqueue([[1]], square, [str(tmp_path / "calls.log")])[0]
+
+    assert queue.claim("crashed")[0] == id
+    # the lease is still valid, the job is not claimed twice
+    assert queue.claim("other") is None
+    time.sleep(0.3)
+    assert queue.claim("other")[0] == id
+
+    # the results of the former worker are ignored
+    queue.complete(id, "crashed", "stale")
+    assert queue.status() == {"running": 1}
+    queue.complete(id, "other", 1)
+    assert queue.results([id]) == [1]
+
+
+def test_heartbeat_renews_lease(queue_file):
+    queue = WorkQueue(queue_file, lease_seconds=0.2)
+    id = queue.enqueue([[1]], slow, [0])[0]
+    queue.claim("worker")
+    for _ in range(3):
+        time.sleep(0.1)
+        queue.heartbeat(id, "worker")
+    assert queue.claim("other") is None
+
+
+def test_expired_lease_fails_after_max_attempts(queue_file, tmp_path):
+    queue = WorkQueue(queue_file, lease_seconds=0.05)
+    id = queue.enqueue([[1]], square, [str(tmp_path / "calls.log")])[0]
+    for attempt in range(MAX_ATTEMPTS):
+        assert queue.claim(f"crashed{attempt}")[0] == id
+        time.sleep(0.1)
+    assert queue.claim("other") is None
+    assert queue.status() == {"failed": 1}
+    assert queue.errors()[id] == "lease expired"
+
+
+def test_failing_job_is_retried_until_failed(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    queue = WorkQueue(queue_file)
+    id = queue.enqueue([[7]], failing, [calls_file])[0]
+    work(queue_file, "worker", 0.01)
+
+    assert calls(calls_file) == [7] * MAX_ATTEMPTS
+    assert queue.status() == {"failed": 1}
+    assert "job 7 fails" in queue.errors()[id]
+    assert queue.results([id]) == [None]
+
+    # enqueued again, failed jobs get new attempts
+    queue.enqueue([[7]], failing, [calls_file])
+    assert queue.status() == {"pending": 1}
+
+
+def test_heartbeat_survives_locked_database(queue_file, monkeypatch):
+    beats = []
+
+    def heartbeat(self, id, worker):
+        beats.append(id)
+        if len(beats) == 1:
+            raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(WorkQueue, "heartbeat", heartbeat)
+
+    queue = WorkQueue(queue_file, lease_seconds=0.15)
+    queue.enqueue([[1]], slow, [0.4])
+    work(queue_file, "worker", 0.01, lease_seconds=0.15)
+
+    assert len(beats) >= 2
+    assert queue.status() == {"done": 1}
+
+
+def test_run_queue_keeps_item_order(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    items = [5, 3, 1, 4, 3, 2]
+    results = run_queue(items, square, [calls_file], queue_file, num_workers=3, poll_interval=0.05)
+    assert results == [x * x for x in items]
+    # the duplicated item is one job
+    assert sorted(calls(calls_file)) == [1, 2, 3, 4, 5]
+
+
+def test_run_queue_on_result(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    items = [4, 2, 6]
+    results = {}
+
+    def on_result(index, result):
+        results[index] = result
+    assert run_queue(items, square, [calls_file], queue_file, num_workers=2, poll_interval=0.05, on_result=on_result) is None
+    assert results == {0: 16, 1: 4, 2: 36}
+
+
+def test_exclusive_queue_skips_earlier_batches(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    queue = WorkQueue(queue_file)
+    queue.enqueue([[9]], failing, [calls_file])
+    queue.enqueue([[8]], square, [calls_file])
+    queue.claim("crashed")
+
+    results = run_queue([1, 2], square, [calls_file], queue_file, num_workers=1, poll_interval=0.05, recover=True, exclusive=True)
+    assert results == [1, 4]
+    assert calls(calls_file) == [1, 2]
+    assert queue.status() == {"done": 2}
+
+
+def test_changed_model_creates_new_jobs(queue_file, tmp_path):
+    calls_file = str(tmp_path / "calls.log")
+    model = tmp_path / "model"
+    model.mkdir()
+    (model / "model_regression.npz").write_bytes(b"first")
+
+    def run():
+        return run_batch([2, 3], square, [calls_file], 1, ledger_file=queue_file, model_path=str(model))
+    assert run() == [4, 9]
+    assert run() == [4, 9]
+    assert calls(calls_file) == [2, 3]
+
+    # retrained model at the same path
+    (model / "model_regression.npz").write_bytes(b"second")
+    assert run() == [4, 9]
+    assert calls(calls_file) == [2, 3, 2, 3]